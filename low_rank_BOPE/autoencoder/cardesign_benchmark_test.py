@@ -220,6 +220,10 @@ def run_cardesign_benchmark(
         logger.debug(f"After {istage}th BO stage, train_X and train_Y shape: {train_X.shape}, {train_Y.shape}")
         mll_outcome = ExactMarginalLogLikelihood(outcome_model.likelihood, outcome_model)
 
+    # shut down the worker pool of problems that have one, e.g. the robot
+    if hasattr(problem, "close"):
+        problem.close()
+
     return {
         "problem_name": problem_name,
         "strategy_name": strategy_name,
@@ -50,6 +50,7 @@ def make_problem_and_util_func(
             dim = int(input_dim),
             max_timesteps = int(max_timesteps),
             record_pos_every_n=int(record_pos_every_n),
+            n_workers=options.get("n_workers", 1),
         )
 
         util_func = RobotUtil(
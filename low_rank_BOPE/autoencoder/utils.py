@@ -31,25 +31,22 @@ def gen_comps(
     """
     assert comp_noise_type is None, "do not support comp noise now"
 
-    cpu_util = util_vals.cpu()
-
-    comp_pairs = []
-    for i in range(cpu_util.shape[0] // 2):
-        i1 = i * 2
-        i2 = i * 2 + 1
-        if cpu_util[i1] > cpu_util[i2]:
-            new_comp = [i1, i2]
-            util_diff = cpu_util[i1] - cpu_util[i2]
-        else:
-            new_comp = [i2, i1]
-            util_diff = cpu_util[i2] - cpu_util[i1]
-
-        new_comp = torch.tensor(new_comp, device=util_vals.device, dtype=torch.long)
-        comp_pairs.append(new_comp)
-
-    comp_pairs = torch.stack(comp_pairs)
+    # view the first 2 * (num_outcomes // 2) utilities as consecutive pairs
+    num_pairs = util_vals.shape[0] // 2
+    util_pairs = util_vals.reshape(util_vals.shape[0], -1)[: 2 * num_pairs, 0].reshape(
+        num_pairs, 2
+    )
+    pair_indices = torch.arange(
+        2 * num_pairs, device=util_vals.device, dtype=torch.long
+    ).view(num_pairs, 2)
+
+    # the first of each pair wins only if its utility is strictly larger
+    first_wins = util_pairs[:, 0] > util_pairs[:, 1]
+    comp_pairs = torch.where(
+        first_wins.unsqueeze(-1), pair_indices, pair_indices.flip(-1)
+    )
 
-    return comp_pairs
+    return comp_pairs.contiguous()
 
 
 def generate_random_pref_data(problem, n, outcome_model, util_func):
@@ -1,9 +1,12 @@
 #!/usr/bin/env python3
 
 import copy
+import multiprocessing
 import os
+import pickle
 import random
 import time
+import zlib
 from collections import defaultdict
 from typing import List
 
@@ -14,7 +17,6 @@ import torch
 from botorch.acquisition.objective import LearnedObjective
 from botorch.acquisition.preference import AnalyticExpectedUtilityOfBestOption
 from botorch.fit import fit_gpytorch_mll
-from botorch.models.multitask import KroneckerMultiTaskGP
 from botorch.models.pairwise_gp import (PairwiseGP,
                                         PairwiseLaplaceMarginalLogLikelihood)
 from botorch.models.transforms.input import (ChainedInputTransform,
@@ -28,14 +30,20 @@ from gpytorch.mlls.exact_marginal_log_likelihood import \
     ExactMarginalLogLikelihood
 from sklearn.linear_model import LinearRegression
 
+from low_rank_BOPE.src.caching import CachedProblem
 from low_rank_BOPE.src.diagnostics import (check_outcome_model_fit,
                                            check_util_model_fit,
+                                           evaluate_model_fit,
                                            mc_max_outcome_error,
-                                           mc_max_util_error)
-from low_rank_BOPE.src.models import MultitaskGPModel, make_modified_kernel
+                                           mc_max_util_error,
+                                           TestSetRegistry)
+from low_rank_BOPE.src.models import (FastPairwiseGP, LowRankKroneckerGP,
+                                      LowRankKroneckerMarginalLogLikelihood,
+                                      make_modified_kernel)
 from low_rank_BOPE.src.pref_learning_helpers import (  # find_max_posterior_mean, # TODO: later see if we want the error-handled version;; fit_pref_model, # TODO: later see if we want the error-handled version
-    ModifiedFixedSingleSampleModel, find_true_optimal_utility,
-    fit_outcome_model, gen_comps, gen_exp_cand)
+    IncrementalPairwiseGP, ModifiedFixedSingleSampleModel,
+    find_true_optimal_utility, fit_batched_outcome_models, fit_outcome_model,
+    gen_comps, gen_exp_cand)
 from low_rank_BOPE.src.transforms import (InputCenter,
                                           LinearProjectionInputTransform,
                                           LinearProjectionOutcomeTransform,
@@ -63,6 +71,17 @@ class BopeExperiment:
         "latent_dim": None,
         "min_stdv": 100000,
         "true_axes": None, # specify these for synthetic problems
+        "n_workers": 1, # number of processes to spread methods / PE strategies over
+        "torch_threads_per_worker": 1, # torch intra-op threads in each worker process
+        "warm_start_pref_model": True, # warm-start utility model refits within a PE session
+        "test_set_registry_size": 4, # max number of diagnostic test sets kept in memory
+        "cache_outcomes": False, # memoize the problem's outcomes on disk (deterministic problems only), see src/caching.py
+        "outcome_cache_dir": None, # defaults to caching.DEFAULT_CACHE_DIR
+        "latent_space_acqf": False, # draw outcome samples in the latent space in acqf optimization, see get_latent_space_models()
+        "log_model_fit": False, # log outcome / util model fit metrics at every PE checkpoint, see evaluate_model_fit()
+        "lmc_inference": "kronecker", # "kronecker" (exact) or "cg" marginal likelihood of the mtgp / lmc outcome models, see LowRankKroneckerGP
+        "fast_util_posterior": True, # serve util posteriors in acqf optimization from cached solves, see FastPairwiseGP
+        "util_posterior_truncation_rank": None, # if not None, truncate the util posterior variance cache to this rank (crude, inflates variances), see FastPairwiseGP
     }
 
     def __init__(
@@ -94,6 +113,8 @@ class BopeExperiment:
 
         # pre-specified experiment metadata
         self.problem = problem.double()
+        if self.cache_outcomes:
+            self.problem = CachedProblem(self.problem, cache_dir=self.outcome_cache_dir)
         self.util_func = util_func
         self.pe_strategies = pe_strategies
         self.outcome_dim = problem.outcome_dim
@@ -119,11 +140,15 @@ class BopeExperiment:
 
         # logging models and results
         self.outcome_models_dict = {}  # by method
+        self.prefit_outcome_models = {}  # by method, (model, fitting time) fitted outside of this experiment
         self.pref_data_dict = defaultdict(dict)  # by (method, pe_strategy)
+        self.pref_model_managers = defaultdict(dict)  # by (method, pe_strategy)
         self.PE_time_dict = defaultdict(dict)
         self.PE_session_results = defaultdict(dict) # deps on method and pe strategy
         self.final_candidate_results = defaultdict(dict) # deps on method and pe strategy
         self.outcome_model_fitting_results = defaultdict(dict) # only deps on method
+        # noiseless test sets shared by the diagnostics of all methods
+        self.test_set_registry = TestSetRegistry(max_size=self.test_set_registry_size)
 
         # specify outcome and input transforms, covariance modules
         self.transforms_covar_dict = {
@@ -156,11 +181,6 @@ class BopeExperiment:
                 "input_tf": Normalize(self.outcome_dim),
                 "covar_module": make_modified_kernel(ard_num_dims=self.outcome_dim),
             },
-            "lmc2": {
-                "outcome_tf": Standardize(self.outcome_dim),
-                "input_tf": Normalize(self.outcome_dim),
-                "covar_module": make_modified_kernel(ard_num_dims=self.outcome_dim),
-            },
         }
         # for synthetic problems only, when we know the true outcome subspace
         if self.true_axes is not None:
@@ -193,6 +213,9 @@ class BopeExperiment:
             .to(torch.double)
             .detach()
         )
+        # seed the observation noise by trial, so that the data do not depend on
+        # what ran before, e.g. other trials in run_batched_BOPE_loops()
+        torch.manual_seed(self.trial_idx)
         self.Y = self.problem(self.X).detach()
 
         if compute_util:
@@ -229,35 +252,22 @@ class BopeExperiment:
         """
         print(f"Fitting outcome model using {method}")
         start_time = time.time()
-        if method == "mtgp":
-            outcome_model = KroneckerMultiTaskGP(
-                self.X,
-                self.Y,
-                outcome_transform=copy.deepcopy(
-                    self.transforms_covar_dict[method]["outcome_tf"]
-                ),
-                rank=1,  # TODO: update
-            )
-            icm_mll = ExactMarginalLogLikelihood(
-                outcome_model.likelihood, outcome_model
-            )
-            fit_gpytorch_mll(icm_mll)
-
-        elif method == "lmc":
-            outcome_model = MultitaskGPModel(
+        if method in ("mtgp", "lmc"):
+            # both are ICM models fitted with Kronecker inference, see LowRankKroneckerGP;
+            # "mtgp" with a rank-1 task covariance, "lmc" with rank latent_dim
+            outcome_model = LowRankKroneckerGP(
                 train_X = self.X,
                 train_Y = self.Y,
-                latent_dim = self.latent_dim,
-                rank = 1,
+                latent_dim = 1 if method == "mtgp" else self.latent_dim,
+                inference = self.lmc_inference,
                 outcome_transform=copy.deepcopy(
                     self.transforms_covar_dict[method]["outcome_tf"]
                 ),
             ).to(self.dtype)
-            lcm_mll = ExactMarginalLogLikelihood(
+            icm_mll = LowRankKroneckerMarginalLogLikelihood(
                 outcome_model.likelihood, outcome_model
             )
-            # fit_gpytorch_scipy(lcm_mll, options={"maxls": 30})
-            fit_gpytorch_mll(lcm_mll)
+            fit_gpytorch_mll(icm_mll)
 
         elif method == "pcr":
             P, _, V = torch.svd(self.Y)
@@ -290,6 +300,11 @@ class BopeExperiment:
                 outcome_transform=self.transforms_covar_dict[method]["outcome_tf"],
             )
 
+        elif method in self.prefit_outcome_models:
+            # e.g. fitted jointly with other trials in run_batched_BOPE_loops()
+            outcome_model, prefit_time = self.prefit_outcome_models.pop(method)
+            start_time -= prefit_time
+
         else: # method is 'st' or 'pca'
             outcome_model = fit_outcome_model(
                 self.X,
@@ -298,7 +313,9 @@ class BopeExperiment:
             )
         
         model_fitting_time = time.time() - start_time
-        rel_mse = check_outcome_model_fit(outcome_model, self.problem, n_test=1000)
+        rel_mse = check_outcome_model_fit(
+            outcome_model, self.problem, n_test=1000, seed=self.trial_idx,
+            test_set_registry=self.test_set_registry)
         self.outcome_model_fitting_results[method] = {
             "model_fitting_time": model_fitting_time,
             "rel_mse": rel_mse
@@ -378,6 +395,20 @@ class BopeExperiment:
 
         return util_model
 
+    def get_pref_model(self, method, pe_strategy):
+        r"""Fit the utility model on the current preference data of 
+        (method, pe_strategy), reusing / warm-starting from the model fitted
+        in the previous call for the same (method, pe_strategy).
+        """
+        if pe_strategy not in self.pref_model_managers[method]:
+            self.pref_model_managers[method][pe_strategy] = IncrementalPairwiseGP(
+                warm_start=self.warm_start_pref_model,
+                input_transform=self.transforms_covar_dict[method]["input_tf"],
+                covar_module=self.transforms_covar_dict[method]["covar_module"],
+            )
+        train_Y, train_comps = self.pref_data_dict[method][pe_strategy]
+        return self.pref_model_managers[method][pe_strategy].fit(train_Y, train_comps)
+
     def run_pref_learning(self, method, pe_strategy):
 
         acqf_vals = []
@@ -394,13 +425,7 @@ class BopeExperiment:
 
             for _ in range(3):
                 try:
-                    pref_model = self.fit_pref_model(
-                        train_Y,
-                        train_comps,
-                        input_transform=self.transforms_covar_dict[method]["input_tf"],
-                        covar_module=self.transforms_covar_dict[method]["covar_module"],
-                        # likelihood=likelihood,
-                    )
+                    pref_model = self.get_pref_model(method, pe_strategy)
                     # TODO: commented out to accelerate things
                     # pref_model_acc = check_pref_model_fit(
                     #     pref_model, problem=problem, util_func=util_func, n_test=1000, batch_eval=batch_eval
@@ -485,25 +510,26 @@ class BopeExperiment:
 
         within_result = {}
 
-        pref_model = self.fit_pref_model(
-            Y=train_Y,
-            comps=train_comps,
-            input_transform=self.transforms_covar_dict[method]["input_tf"],
-            covar_module=self.transforms_covar_dict[method]["covar_module"]
-        )
+        pref_model = self.get_pref_model(method, pe_strategy)
         sampler = SobolQMCNormalSampler(num_pref_samples)
-        pref_obj = LearnedObjective(pref_model=pref_model, sampler=sampler)
+        pref_obj = LearnedObjective(
+            pref_model=FastPairwiseGP(pref_model, truncation_rank=self.util_posterior_truncation_rank)
+            if self.fast_util_posterior else pref_model,
+            sampler=sampler,
+        )
 
         # find experimental candidate(s) that maximize the posterior mean utility
-        post_mean_cand_X = gen_exp_cand(
-            outcome_model=self.outcome_models_dict[method],
+        post_mean_cand_X, _ = gen_exp_cand(
+            model=self.outcome_models_dict[method],
             objective=pref_obj,
             problem=self.problem,
             q=1,
             acqf_name="posterior_mean",
-            seed=self.trial_idx
+            seed=self.trial_idx,
+            latent_space=self.latent_space_acqf,
         )
-        post_mean_cand_Y = self.outcome_models_dict[method].posterior(post_mean_cand_X).mean
+        post_mean_cand_Y = self.outcome_models_dict[method].posterior(
+            post_mean_cand_X).mean.detach()
 
         true_util = self.util_func(
             self.problem.evaluate_true(post_mean_cand_X)).item()
@@ -519,6 +545,16 @@ class BopeExperiment:
             "pe_strategy": pe_strategy,
             "method": method,
         }
+        if self.log_model_fit:
+            within_result.update(evaluate_model_fit(
+                problem=self.problem,
+                util_func=self.util_func,
+                n_test=1000,
+                outcome_model=self.outcome_models_dict[method],
+                util_model=pref_model,
+                seed=self.trial_idx,
+                test_set_registry=self.test_set_registry,
+            ))
 
         return within_result
 
@@ -526,29 +562,26 @@ class BopeExperiment:
 
         train_Y, train_comps = self.pref_data_dict[method][pe_strategy]
 
-        pref_model = self.fit_pref_model(
-            Y=train_Y,
-            comps=train_comps,
-            input_transform=self.transforms_covar_dict[method]["input_tf"],
-            covar_module=self.transforms_covar_dict[method]["covar_module"]
-        )
+        pref_model = self.get_pref_model(method, pe_strategy)
         # log accuracy of final utility model
         util_model_acc = check_util_model_fit(
             pref_model, self.problem, self.util_func, 
-            n_test=1000, batch_eval=True)
+            n_test=1000, batch_eval=True, seed=self.trial_idx,
+            test_set_registry=self.test_set_registry)
 
         sampler = SobolQMCNormalSampler(1)
         pref_obj = LearnedObjective(pref_model=pref_model, sampler=sampler)
 
         # find experimental candidate(s) that maximize the posterior mean utility
-        cand_X = gen_exp_cand(
-            outcome_model=self.outcome_models_dict[method],
+        cand_X, _ = gen_exp_cand(
+            model=self.outcome_models_dict[method],
             objective=pref_obj,
             problem=self.problem,
             q=1,
             acqf_name="qNEI",
             X=self.X,
-            seed=self.trial_idx
+            seed=self.trial_idx,
+            latent_space=self.latent_space_acqf,
         )
 
         qneiuu_util = self.util_func(self.problem.evaluate_true(cand_X)).item()
@@ -582,15 +615,19 @@ class BopeExperiment:
 
         max_outcome_error = mc_max_outcome_error(
             problem=self.problem,
-            axes_learned=axes,
-            n_test=n_test
+            projection=axes,
+            n_test=n_test,
+            seed=self.trial_idx,
+            test_set_registry=self.test_set_registry
         )
         
         max_util_error = mc_max_util_error(
             problem=self.problem,
-            axes_learned=axes,
+            projection=axes,
             util_func=self.util_func,
-            n_test=n_test
+            n_test=n_test,
+            seed=self.trial_idx,
+            test_set_registry=self.test_set_registry
         )
         
         self.outcome_model_fitting_results[method].update(
@@ -614,25 +651,31 @@ class BopeExperiment:
         self.generate_random_pref_data(method, n=1)
 
         for pe_strategy in self.pe_strategies:
+            self.run_PE_session(method, pe_strategy)
+
+    def run_PE_session(self, method, pe_strategy):
+        r"""Run one PE session for (method, pe_strategy), starting from the
+        preference data already stored in self.pref_data_dict.
+        """
 
-            start_time = time.time()
+        start_time = time.time()
 
-            print(f"===== Running PE using {method} with {pe_strategy} =====")
+        print(f"===== Running PE using {method} with {pe_strategy} =====")
 
-            self.PE_session_results[method][pe_strategy] = []
+        self.PE_session_results[method][pe_strategy] = []
 
+        self.PE_session_results[method][pe_strategy].append(
+            self.find_max_posterior_mean(method, pe_strategy)
+        )
+        for j in range(self.n_check_post_mean):
+            self.run_pref_learning(method, pe_strategy)
             self.PE_session_results[method][pe_strategy].append(
                 self.find_max_posterior_mean(method, pe_strategy)
             )
-            for j in range(self.n_check_post_mean):
-                self.run_pref_learning(method, pe_strategy)
-                self.PE_session_results[method][pe_strategy].append(
-                    self.find_max_posterior_mean(method, pe_strategy)
-                )
-            
-            # log time required to do PE
-            PE_time = time.time() - start_time
-            self.PE_time_dict[method][pe_strategy] = PE_time # will be logged later
+
+        # log time required to do PE
+        PE_time = time.time() - start_time
+        self.PE_time_dict[method][pe_strategy] = PE_time # will be logged later
 
 
     def run_second_experimentation_stage(self, method):
@@ -649,25 +692,303 @@ class BopeExperiment:
         # have a flag for whether the fitting is successful or not
 
         # all methods use the same initial experimentation data
-        self.generate_random_experiment_data(
-            self.initial_experimentation_batch,
-            compute_util=True
-        )
+        # (which may have been generated already, e.g. in run_batched_BOPE_loops())
+        if getattr(self, "X", None) is None:
+            self.generate_random_experiment_data(
+                self.initial_experimentation_batch,
+                compute_util=True
+            )
+
+        if self.n_workers > 1:
+            self.run_parallel_BOPE_loop()
+            return
 
         for method in self.methods:
             try:
                 print(f"============= Running {method} =============")
-                self.run_first_experimentation_stage(method)
-                self.run_PE_stage(method)
-                self.run_second_experimentation_stage(method)
-
-            
-                torch.save(self.PE_session_results, self.output_path +
-                        'PE_session_results_trial=' + str(self.trial_idx) + '.th')
-                torch.save(self.final_candidate_results, self.output_path +
-                        'final_candidate_results_trial=' + str(self.trial_idx) + '.th')
-                torch.save(self.outcome_model_fitting_results, self.output_path +
-                        'outcome_model_fitting_results_trial=' + str(self.trial_idx) + '.th')
+                self.run_first_stage_task(method)
+                for pe_strategy in self.pe_strategies:
+                    self.run_PE_task(method, pe_strategy)
+
+                self.save_results()
             except:
                 print(f"============= {method} failed, skipping =============")
-                continue
\ No newline at end of file
+                continue
+
+    def seed_task(self, method, pe_strategy=None):
+        r"""Seed the random number generators for the first stage of `method`
+        (if pe_strategy is None) or for PE with `pe_strategy`. The seed only
+        depends on the trial and on the names of the method and PE strategy,
+        so the results of a task do not depend on which other methods and
+        strategies are run, on whether tasks run serially or on how they are
+        scheduled onto workers, see run_parallel_BOPE_loop().
+        """
+        # a stable hash; Python's hash() of a str changes between processes
+        task_seed = zlib.crc32(f"{self.trial_idx}/{method}/{pe_strategy}".encode())
+        torch.manual_seed(task_seed)
+        np.random.seed(task_seed)
+        random.seed(task_seed)
+
+    def run_first_stage_task(self, method):
+        r"""Fit the outcome model for `method` (unless it is already fitted)
+        and draw the initial preference data."""
+        self.seed_task(method)
+        if method not in self.outcome_models_dict:
+            self.run_first_experimentation_stage(method)
+        self.generate_random_pref_data(method, n=1)
+
+    def run_PE_task(self, method, pe_strategy):
+        r"""Run PE with `pe_strategy` and generate the final candidate."""
+        self.seed_task(method, pe_strategy)
+        self.run_PE_session(method, pe_strategy)
+        print(f"===== Generating final candidate using {method} with {pe_strategy} =====")
+        self.generate_final_candidate(method, pe_strategy)
+
+    def run_parallel_BOPE_loop(self):
+        r"""Spread the BOPE loop over `self.n_workers` processes.
+
+        "pca" is run in this process first, since its learned latent_dim and
+        random projection / subset transforms are used by other methods.
+        The experiment is then sent to each worker once, and the first stage
+        of the remaining methods is run in parallel (one task per method),
+        followed by PE and the final candidate (one task per
+        (method, pe_strategy) pair); PE tasks only carry the outcome model
+        and preference data of their method. Tasks are seeded the same way as
+        in the serial loop, so results do not depend on `n_workers`. Results
+        are merged back in self.methods x self.pe_strategies order and saved
+        after every task, same as in the serial loop.
+        """
+
+        fitted_methods = []
+        if "pca" in self.methods:
+            try:
+                print("============= Running pca =============")
+                self.run_first_stage_task("pca")
+                fitted_methods.append("pca")
+            except:
+                print("============= pca failed, skipping =============")
+
+        # state of the methods fitted in workers, to be sent with their PE tasks
+        method_states = {}
+        self.clear_prediction_caches()
+        # use spawn so that workers do not inherit torch / OpenMP thread state
+        ctx = multiprocessing.get_context("spawn")
+        with ctx.Pool(
+            processes=self.n_workers,
+            initializer=_init_parallel_worker,
+            # pickled here once, rather than through torch's shared memory
+            # reducers for every worker
+            initargs=(pickle.dumps(self),),
+        ) as pool:
+            first_stage_tasks = [
+                ("first_stage", method, None, None)
+                for method in self.methods if method != "pca"
+            ]
+            for task, result in zip(
+                first_stage_tasks, 
+                pool.imap(_run_parallel_task, first_stage_tasks)
+            ):
+                method = task[1]
+                if result is None:
+                    print(f"============= {method} failed, skipping =============")
+                    continue
+                self.outcome_model_fitting_results[method] = result["outcome_model_fitting_results"]
+                if result["PE_results"] is not None:
+                    # the worker could not send back the outcome model and
+                    # has run PE for all strategies itself
+                    for pe_strategy, PE_result in result["PE_results"].items():
+                        self.merge_PE_result(method, pe_strategy, PE_result)
+                    self.save_results()
+                    continue
+                method_states[method] = result["method_state"]
+                self.set_method_state(method, result["method_state"])
+                fitted_methods.append(method)
+
+            self.clear_prediction_caches()
+            PE_tasks = [
+                ("PE", method, pe_strategy, method_states.get(method))
+                for method in self.methods if method in fitted_methods
+                for pe_strategy in self.pe_strategies
+            ]
+            for task, result in zip(
+                PE_tasks, pool.imap(_run_parallel_task, PE_tasks)
+            ):
+                _, method, pe_strategy, _ = task
+                if result is None:
+                    print(f"============= {method} with {pe_strategy} failed, skipping =============")
+                    continue
+                self.merge_PE_result(method, pe_strategy, result)
+                self.save_results()
+
+    def get_method_state(self, method):
+        r"""State of `method` that PE with it depends on, see set_method_state()."""
+        return {
+            "outcome_model": self.outcome_models_dict[method],
+            "pref_data": self.pref_data_dict[method],
+            "transforms_covar": self.transforms_covar_dict.get(method),
+            "pcr_axes": getattr(self, "pcr_axes", None) if method == "pcr" else None,
+        }
+
+    def set_method_state(self, method, state):
+        self.outcome_models_dict[method] = state["outcome_model"]
+        self.pref_data_dict[method] = state["pref_data"]
+        if state["transforms_covar"] is not None:
+            self.transforms_covar_dict[method] = state["transforms_covar"]
+        if state["pcr_axes"] is not None:
+            self.pcr_axes = state["pcr_axes"]
+
+    def merge_PE_result(self, method, pe_strategy, PE_result):
+        self.PE_session_results[method][pe_strategy] = PE_result["PE_session_results"]
+        self.PE_time_dict[method][pe_strategy] = PE_result["PE_time"]
+        self.pref_data_dict[method][pe_strategy] = PE_result["pref_data"]
+        self.final_candidate_results[method][pe_strategy] = PE_result["final_candidate_results"]
+
+    def clear_prediction_caches(self):
+        r"""Drop the gpytorch prediction caches of the problem and outcome models.
+        These hold non-leaf tensors, which cannot be sent to worker processes.
+        """
+        for model in [self.problem, *self.outcome_models_dict.values()]:
+            for module in model.modules():
+                if isinstance(module, gpytorch.models.ExactGP):
+                    module.prediction_strategy = None
+
+    def save_results(self):
+        torch.save(self.PE_session_results, self.output_path +
+                'PE_session_results_trial=' + str(self.trial_idx) + '.th')
+        torch.save(self.final_candidate_results, self.output_path +
+                'final_candidate_results_trial=' + str(self.trial_idx) + '.th')
+        torch.save(self.outcome_model_fitting_results, self.output_path +
+                'outcome_model_fitting_results_trial=' + str(self.trial_idx) + '.th')
+
+
+def run_batched_BOPE_loops(experiments: List[BopeExperiment]) -> None:
+    r"""Run the BOPE loop for several trials of the same problem, e.g. one
+    BopeExperiment per trial_idx. The outcome models of "st", "pca" and 
+    "random_linear_proj" are fitted for all trials at once, as a single 
+    batched GP; everything else runs trial by trial as in run_BOPE_loop().
+    Data and tasks are seeded per experiment, so the results of a trial do not
+    depend on the other trials in the batch.
+    Args:
+        experiments: list of BopeExperiments, typically differing only in trial_idx
+    """
+
+    for experiment in experiments:
+        experiment.generate_random_experiment_data(
+            experiment.initial_experimentation_batch,
+            compute_util=True
+        )
+
+    _prefit_batched_outcome_models(experiments, "st")
+    _prefit_batched_outcome_models(experiments, "pca")
+
+    # random_linear_proj transforms are only created after pca is fitted
+    for experiment in experiments:
+        if "pca" in experiment.methods:
+            try:
+                # seeded per experiment, same as in run_BOPE_loop()
+                experiment.run_first_stage_task("pca")
+            except:
+                print(f"============= pca failed for trial {experiment.trial_idx} =============")
+    _prefit_batched_outcome_models(experiments, "random_linear_proj")
+
+    for experiment in experiments:
+        experiment.run_BOPE_loop()
+
+
+def _prefit_batched_outcome_models(experiments, method):
+    experiments = [
+        experiment for experiment in experiments 
+        if method in experiment.methods 
+        and method in experiment.transforms_covar_dict
+        and method not in experiment.outcome_models_dict
+    ]
+    if len(experiments) == 0:
+        return
+
+    print(f"Fitting outcome models using {method} for {len(experiments)} trials")
+    start_time = time.time()
+    try:
+        outcome_models = fit_batched_outcome_models(
+            X_list=[experiment.X for experiment in experiments],
+            Y_list=[experiment.Y for experiment in experiments],
+            outcome_transforms=[
+                experiment.transforms_covar_dict[method]["outcome_tf"]
+                for experiment in experiments
+            ],
+        )
+    except (ValueError, RuntimeError) as error:
+        # fall back to fitting the models one by one in each experiment
+        print(f"Batched outcome model fitting failed for {method}: ", error)
+        return
+    model_fitting_time = (time.time() - start_time) / len(experiments)
+
+    for experiment, outcome_model in zip(experiments, outcome_models):
+        experiment.prefit_outcome_models[method] = (outcome_model, model_fitting_time)
+
+
+# experiment of this worker process of run_parallel_BOPE_loop()
+_WORKER_EXPERIMENT = None
+
+
+def _init_parallel_worker(pickled_experiment):
+    global _WORKER_EXPERIMENT
+    _WORKER_EXPERIMENT = pickle.loads(pickled_experiment)
+    torch.set_num_threads(_WORKER_EXPERIMENT.torch_threads_per_worker)
+
+
+def _run_parallel_task(task):
+    r"""Worker for BopeExperiment.run_parallel_BOPE_loop().
+
+    Args:
+        task: tuple of (stage, method, pe_strategy, method_state), where stage
+            is "first_stage" (fit the outcome model for `method` and draw the 
+            initial preference data) or "PE" (run PE with `pe_strategy` and 
+            generate the final candidate), and method_state is the state of
+            `method` fitted in another worker (see get_method_state()), or None
+    Returns:
+        dict of results to be merged back into the experiment in the parent
+        process, or None if the task failed
+    """
+    stage, method, pe_strategy, method_state = task
+    experiment = _WORKER_EXPERIMENT
+
+    try:
+        if stage == "first_stage":
+            print(f"============= Running {method} =============")
+            experiment.run_first_stage_task(method)
+            experiment.clear_prediction_caches()
+            result = {
+                "method_state": experiment.get_method_state(method),
+                "outcome_model_fitting_results": experiment.outcome_model_fitting_results[method],
+                "PE_results": None,
+            }
+            try:
+                pickle.dumps(result["method_state"]["outcome_model"])
+            except (AttributeError, pickle.PicklingError):
+                # some models (e.g. with lambdas in their likelihood) cannot be
+                # sent back to the parent, so finish this method here instead
+                result["method_state"] = None
+                result["PE_results"] = {}
+                for pe in experiment.pe_strategies:
+                    experiment.run_PE_task(method, pe)
+                    result["PE_results"][pe] = _collect_PE_result(
+                        experiment, method, pe
+                    )
+            return result
+        else:
+            if method_state is not None:
+                experiment.set_method_state(method, method_state)
+            experiment.run_PE_task(method, pe_strategy)
+            return _collect_PE_result(experiment, method, pe_strategy)
+    except Exception as error:
+        print(f"{stage} for {method} {pe_strategy} failed in worker: ", error)
+        return None
+
+
+def _collect_PE_result(experiment, method, pe_strategy):
+    return {
+        "PE_session_results": experiment.PE_session_results[method][pe_strategy],
+        "PE_time": experiment.PE_time_dict[method][pe_strategy],
+        "pref_data": experiment.pref_data_dict[method][pe_strategy],
+        "final_candidate_results": experiment.final_candidate_results[method][pe_strategy],
+    }
@@ -5,7 +5,7 @@ import os
 import random
 import time
 from collections import defaultdict
-from typing import List, Optional
+from typing import List, Optional, Tuple
 import traceback
 
 import botorch
@@ -29,7 +29,9 @@ from botorch.utils.sampling import draw_sobol_samples
 from gpytorch.mlls.exact_marginal_log_likelihood import \
     ExactMarginalLogLikelihood
 from sklearn.linear_model import LinearRegression
+from torch import Tensor
 
+from low_rank_BOPE.src.caching import CachedProblem
 from low_rank_BOPE.src.diagnostics import (best_and_avg_util_in_subspace,
                                            check_outcome_model_fit,
                                            check_overall_fit,
@@ -37,13 +39,17 @@ from low_rank_BOPE.src.diagnostics import (best_and_avg_util_in_subspace,
                                            get_function_statistics,
                                            mc_max_outcome_error,
                                            mc_max_util_error, 
-                                           compute_grassmannian)
-from low_rank_BOPE.src.models import MultitaskGPModel, make_modified_kernel
+                                           TestSetRegistry,
+                                           compute_grassmannian,
+                                           evaluate_model_fit)
+from low_rank_BOPE.src.models import (FastPairwiseGP, MultitaskGPModel,
+                                      make_modified_kernel)
 from low_rank_BOPE.src.pref_learning_helpers import (
     ModifiedFixedSingleSampleModel, find_true_optimal_utility, gen_comps,
     gen_exp_cand)
 from low_rank_BOPE.src.transforms import (LinearProjectionInputTransform,
                                           LinearProjectionOutcomeTransform,
+                                          IncrementalPCA,
                                           SubsetOutcomeTransform,
                                           compute_weights, fit_pca,
                                           generate_random_projection)
@@ -52,6 +58,79 @@ from low_rank_BOPE.src.transforms import (LinearProjectionInputTransform,
 def defaultdict_list():
     return defaultdict(list)
 
+
+def rotate_lengthscales(
+    lengthscale: Tensor,
+    old_projection: Tensor,
+    new_projection: Tensor,
+    default_lengthscale: Optional[Tensor] = None,
+) -> Tensor:
+    r"""
+    Carry the ARD lengthscales of a kernel on an old subspace over to a new
+    subspace. With R = V_new V_old^T, the RBF precision diag(1/l_old^2) in old
+    coordinates is R diag(1/l_old^2) R^T in new coordinates; we keep its diagonal:
+        l_new_j = 1 / sqrt(sum_k R_jk^2 / l_old_k^2 + (1 - sum_k R_jk^2) / l_default^2),
+    where the last term gives the part of new axis j outside the old subspace
+    the default lengthscale.
+
+    Args:
+        lengthscale: `latent_dim_old` tensor of lengthscales on the old subspace
+        old_projection: `latent_dim_old x outcome_dim` tensor, rows span the old subspace
+        new_projection: `latent_dim_new x outcome_dim` tensor, rows span the new subspace
+        default_lengthscale: lengthscale for directions outside the old subspace;
+            if None, these directions are ignored
+    Returns:
+        `latent_dim_new` tensor of lengthscales on the new subspace
+    """
+    R_squared = torch.square(new_projection @ torch.transpose(old_projection, -2, -1))
+    precision = R_squared @ (1 / torch.square(lengthscale))
+    if default_lengthscale is not None:
+        precision = precision + (1 - R_squared.sum(dim=-1)).clamp_min(0) \
+            / torch.square(default_lengthscale)
+    return 1 / torch.sqrt(precision)
+
+
+class SubspaceTracker:
+    r"""
+    Decide whether the subspace of a retraining method moved enough to
+    rebuild the transforms and refit the models on it.
+    """
+
+    def __init__(self, tolerance: float = 1e-3):
+        r"""
+        Args:
+            tolerance: the new subspace is only adopted if its Grassmannian
+                distance to the current one is at least `tolerance`
+                (or if the latent dimension changed)
+        """
+        self.tolerance = tolerance
+        self.grassmannian = {} # [(method, pe_strategy)] = last Grassmannian distance
+
+    def update(
+        self, key: Tuple[str, str], prev_projection: Optional[Tensor], projection: Tensor
+    ) -> Tuple[Tensor, bool]:
+        r"""
+        Compare a newly fitted projection with the current one.
+
+        Args:
+            key: (method, pe_strategy)
+            prev_projection: `latent_dim_old x outcome_dim` current projection,
+                None if there is none yet
+            projection: `latent_dim x outcome_dim` newly fitted projection
+        Returns:
+            projection: the projection to use from now on
+            changed: whether it differs from `prev_projection`
+        """
+        if prev_projection is None:
+            self.grassmannian[key] = None
+            return projection, True
+
+        _, _, g = compute_grassmannian(prev_projection, projection)
+        self.grassmannian[key] = g
+        if prev_projection.shape == projection.shape and g < self.tolerance:
+            return prev_projection, False
+        return projection, True
+
 class RetrainingBopeExperiment:
 
     attr_list = {
@@ -77,6 +156,16 @@ class RetrainingBopeExperiment:
         "wpca_options": {"k": 10, "num_points_to_discard": 2},
         "compute_true_opt": False,
         "save_results": True,
+        "test_set_registry_size": 4, # max number of diagnostic test sets kept in memory
+        "cache_outcomes": False, # memoize the problem's outcomes on disk (deterministic problems only), see src/caching.py
+        "outcome_cache_dir": None, # defaults to caching.DEFAULT_CACHE_DIR
+        "svd_method": "full", # "full", "randomized", or "incremental" (update PCA as data are appended)
+        "subspace_tolerance": 1e-3, # don't refit models on a new subspace closer than this (Grassmannian distance)
+        "warm_start_util_kernel": True, # initialize util kernel on a new subspace from the previous fit
+        "latent_space_acqf": False, # draw outcome samples in the latent space in acqf optimization, see get_latent_space_models()
+        "log_model_fit": False, # log outcome / util model fit metrics at every PE checkpoint, see evaluate_model_fit()
+        "fast_util_posterior": True, # serve util posteriors in acqf optimization from cached solves, see FastPairwiseGP
+        "util_posterior_truncation_rank": None, # if not None, truncate the util posterior variance cache to this rank (crude, inflates variances), see FastPairwiseGP
     }
 
     def __init__(
@@ -110,6 +199,8 @@ class RetrainingBopeExperiment:
 
         # pre-specified experiment metadata
         self.problem = problem.double()
+        if self.cache_outcomes:
+            self.problem = CachedProblem(self.problem, cache_dir=self.outcome_cache_dir)
         self.util_func = util_func
         self.pe_strategies = pe_strategies
         self.outcome_dim = problem.outcome_dim
@@ -152,6 +243,11 @@ class RetrainingBopeExperiment:
         self.subspace_diagnostics = defaultdict(defaultdict_list) # [(method, pe_strategy)][diag_metric] = list
         # self.util_postmean_landscape = defaultdict(list) # [(method, pe_strategy)] = list of statistics tuples
         self.time_consumption = defaultdict(defaultdict_list) # [(method, pe_strategy)][time_metric] = list
+        # noiseless test sets shared by the diagnostics of all methods
+        self.test_set_registry = TestSetRegistry(max_size=self.test_set_registry_size)
+        # [(method, pe_strategy)] = (IncrementalPCA, data it was fit on), for svd_method="incremental"
+        self.incremental_pca_dict = {}
+        self.subspace_tracker = SubspaceTracker(tolerance=self.subspace_tolerance)
         
         # initialize progress checkpoint dict
         self.progress = {}
@@ -222,18 +318,55 @@ class RetrainingBopeExperiment:
                 }
 
 
+    @property
+    def refit_svd_method(self) -> str:
+        r"""
+        SVD method for PCA fits that cannot be updated incrementally,
+        e.g., weighted PCA whose weights change as the utility model is refit.
+        """
+        return "full" if self.svd_method == "incremental" else self.svd_method
+
+    def fit_incremental_pca(self, method: str, pe_strategy: str, train_Y: Tensor) -> Tensor:
+        r"""
+        Fit (unweighted) PCA on train_Y. If train_Y extends the data of the
+        previous fit for (method, pe_strategy) by appended rows, only the new
+        rows are added to the decomposition; otherwise it is refit.
+
+        Args:
+            method: method name
+            pe_strategy: preference exploration strategy
+            train_Y: `num_samples x outcome_dim` tensor of data
+        Returns:
+            pca_axes: `latent_dim x outcome_dim` tensor where each row is a pca axis
+        """
+        ipca, fitted_Y = self.incremental_pca_dict.get((method, pe_strategy), (None, None))
+        if ipca is None or fitted_Y.shape[0] > train_Y.shape[0] \
+                or not torch.equal(train_Y[: fitted_Y.shape[0]], fitted_Y):
+            ipca = IncrementalPCA(standardize=self.standardize)
+            fitted_Y = train_Y[:0]
+        if train_Y.shape[0] > fitted_Y.shape[0]:
+            ipca.partial_fit(train_Y[fitted_Y.shape[0]:])
+        self.incremental_pca_dict[(method, pe_strategy)] = (ipca, train_Y)
+
+        return ipca.get_axes(var_threshold=self.pca_var_threshold, num_PCs=self.num_PCs)
+
     def compute_projections(self, method: str, pe_strategy: str):
         r"""
         - Compute projections to subspace for given method and pe_strategy. 
         - Store the projection in self.projections_dict (append to list).
         - Update self.transforms_covar_dict with the computed projection.
         - Save subspace diagnostics in self.subspace_diagnostics.
+
+        Returns:
+            False if the new subspace is within self.subspace_tolerance of the 
+            current one, in which case the current subspace, transforms and 
+            kernel are kept and the models need not be refit; True otherwise.
         """
 
         logger.info(f"    -- Computing subspace for method [{method}] and pe_strategy [{pe_strategy}]")
 
         if method == "random_search":
-            return
+            return False
         
         projection = None
 
@@ -251,13 +384,17 @@ class RetrainingBopeExperiment:
             
             logger.debug(f"        -- shape of Y_selected for computing subspace: {Y_selected.shape}")
             
-            projection = fit_pca(
-                Y_selected,
-                var_threshold=self.pca_var_threshold, 
-                num_PCs=self.num_PCs,
-                weights=None,
-                standardize=self.standardize
-            ) 
+            if self.svd_method == "incremental":
+                projection = self.fit_incremental_pca(method, pe_strategy, Y_selected)
+            else:
+                projection = fit_pca(
+                    Y_selected,
+                    var_threshold=self.pca_var_threshold, 
+                    num_PCs=self.num_PCs,
+                    weights=None,
+                    standardize=self.standardize,
+                    svd_method=self.svd_method,
+                ) 
 
             if method == "pca": # i.e., no retraining, just fit subspace once
                 self.initial_latent_dim = projection.shape[0]
@@ -279,7 +416,8 @@ class RetrainingBopeExperiment:
                 var_threshold=self.pca_var_threshold,
                 num_PCs=self.num_PCs,
                 weights=weights,
-                standardize=self.standardize
+                standardize=self.standardize,
+                svd_method=self.refit_svd_method,
             ) 
 
         elif method.startswith("wpca_est"):
@@ -306,7 +444,8 @@ class RetrainingBopeExperiment:
                 var_threshold=self.pca_var_threshold, 
                 num_PCs=self.num_PCs,
                 weights=weights,
-                standardize=self.standardize
+                standardize=self.standardize,
+                svd_method=self.refit_svd_method,
             ) 
 
         elif method == "st":
@@ -377,7 +516,8 @@ class RetrainingBopeExperiment:
                     train_Y,
                     var_threshold=self.pca_var_threshold, 
                     weights=None,
-                    standardize=self.standardize
+                    standardize=self.standardize,
+                    svd_method=self.refit_svd_method,
                 ) 
 
         elif method == "random_linear_proj":
@@ -403,7 +543,24 @@ class RetrainingBopeExperiment:
             }
 
         if projection is not None:
+            prev_projection = self.projections_dict[(method, pe_strategy)][-1] \
+                if len(self.projections_dict[(method, pe_strategy)]) > 0 else None
+            projection, subspace_changed = self.subspace_tracker.update(
+                (method, pe_strategy), prev_projection, projection)
             self.projections_dict[(method, pe_strategy)].append(projection)
+            if not subspace_changed:
+                logger.info(f"        -- Subspace moved less than {self.subspace_tolerance}, keeping it")
+                self.subspace_diagnostics[(method, pe_strategy)]["latent_dim"].append(projection.shape[0])
+                return False
+
+            covar_module = make_modified_kernel(ard_num_dims=projection.shape[0])
+            if self.warm_start_util_kernel and (method, pe_strategy) in self.util_models_dict:
+                self.warm_start_kernel(
+                    covar_module, 
+                    self.util_models_dict[(method, pe_strategy)],
+                    projection,
+                    self.pref_data_dict[(method, pe_strategy)]["Y"],
+                )
 
             self.transforms_covar_dict[(method, pe_strategy)] = {
                 "outcome_tf": ChainedOutcomeTransform(
@@ -418,12 +575,51 @@ class RetrainingBopeExperiment:
                         "normalize": Normalize(projection.shape[0])
                     }
                 ),
-                "covar_module": make_modified_kernel(ard_num_dims=projection.shape[0]),
+                "covar_module": covar_module,
             }
 
             # save subspace diagnostics
             self.subspace_diagnostics[(method, pe_strategy)]["latent_dim"].append(projection.shape[0])
 
+        return True
+
+    def warm_start_kernel(
+        self,
+        covar_module: torch.nn.Module,
+        util_model: PairwiseGP,
+        projection: Tensor,
+        train_Y: Tensor,
+    ):
+        r"""
+        Initialize the hyperparameters of a util kernel on the new subspace 
+        from the util model fitted on the previous subspace: the outputscale 
+        is copied and the lengthscales are rotated into the new basis. 
+        Lengthscales are converted to and from the units of the projected 
+        outcomes, since the util model normalizes its inputs after projecting.
+
+        Args:
+            covar_module: kernel from make_modified_kernel() on the new subspace,
+                modified in place
+            util_model: util model fitted on a previous subspace
+            projection: `latent_dim x outcome_dim` new projection
+            train_Y: `num_samples x outcome_dim` outcomes the util model is fit on
+        """
+        old_kernel = util_model.covar_module
+        prev_projection = util_model.input_transform["projection"].projection_matrix
+        old_range = util_model.input_transform["normalize"].coefficient.squeeze(0)
+        projected_Y = train_Y @ torch.transpose(projection, -2, -1)
+        new_range = (projected_Y.max(dim=0).values - projected_Y.min(dim=0).values).clamp_min(1e-8)
+
+        with torch.no_grad():
+            lengthscale = rotate_lengthscales(
+                old_kernel.base_kernel.lengthscale.squeeze(0) * old_range,
+                prev_projection.to(old_range),
+                projection.to(old_range),
+                default_lengthscale=covar_module.base_kernel.lengthscale.squeeze(0).to(old_range) * new_range,
+            ) / new_range
+            covar_module.base_kernel.lengthscale = lengthscale.clamp_min(1e-3)
+            covar_module.outputscale = old_kernel.outputscale
+
             
     def fit_outcome_model(
             self, method: str, pe_strategy: str, 
@@ -461,7 +657,9 @@ class RetrainingBopeExperiment:
         logger.info(f"        -- Outcome model fitting time: {model_fitting_time:.2f} seconds")
 
         if save_diagnostics:
-            rel_mse = check_outcome_model_fit(outcome_model, self.problem, n_test=1000)
+            rel_mse = check_outcome_model_fit(
+                outcome_model, self.problem, n_test=1000, seed=self.trial_idx,
+                test_set_registry=self.test_set_registry)
             self.subspace_diagnostics[(method, pe_strategy)]["rel_mse"].append(rel_mse)
 
         self.outcome_models_dict[(method, pe_strategy)] = outcome_model
@@ -702,11 +900,16 @@ class RetrainingBopeExperiment:
                 method, pe_strategy, save_model=True, save_model_fit_time=False
             )
         sampler = SobolQMCNormalSampler(num_pref_samples)
+        # the util model is fixed while maximizing its posterior mean
+        acqf_util_model = (
+            FastPairwiseGP(util_model, truncation_rank=self.util_posterior_truncation_rank)
+            if self.fast_util_posterior else util_model
+        )
         if method=="pbo":
-            model = self.util_models_dict[(method, pe_strategy)]
+            model = acqf_util_model
         else:
             model = self.outcome_models_dict[(method, pe_strategy)]
-        pref_obj = None if method=="pbo" else LearnedObjective(pref_model=util_model, sampler=sampler)
+        pref_obj = None if method=="pbo" else LearnedObjective(pref_model=acqf_util_model, sampler=sampler)
 
         # find experimental candidate(s) that maximize the posterior mean utility
         post_mean_cand_X, _ = gen_exp_cand(
@@ -717,6 +920,7 @@ class RetrainingBopeExperiment:
             acqf_name="posterior_mean",
             seed=self.trial_idx,
             sampler_num_outcome_samples=self.sampler_num_outcome_samples,
+            latent_space=self.latent_space_acqf,
         )
         post_mean_util = self.util_func(
             self.problem.evaluate_true(post_mean_cand_X)).item()
@@ -753,32 +957,18 @@ class RetrainingBopeExperiment:
             "candidate": post_mean_cand_X.tolist()
         }
 
-        # check util model fit here
-        # util_model_acc = check_util_model_fit(
-        #     util_model=util_model, 
-        #     problem=self.problem, util_func=self.util_func, 
-        #     n_test=1024, batch_eval=True)
-        # within_result["util_model_acc"] = util_model_acc
-        # util_model_acc_top_half = check_util_model_fit(
-        #     util_model=util_model, 
-        #     problem=self.problem, util_func=self.util_func, 
-        #     n_test=1024, batch_eval=True, top_quantile=0.5)
-        # within_result["util_model_acc_top_half"] = util_model_acc_top_half
-        # util_model_acc_top_quarter = check_util_model_fit(
-        #     util_model=util_model, 
-        #     problem=self.problem, util_func=self.util_func, 
-        #     n_test=1024, batch_eval=True, top_quantile=0.25)
-        # within_result["util_model_acc_top_quarter"] = util_model_acc_top_quarter
-
-        # overall_model_acc = check_overall_fit(
-        #     outcome_model=self.outcome_models_dict[(method, pe_strategy)],
-        #     util_model=util_model,
-        #     problem=self.problem,
-        #     util_func=self.util_func,
-        #     n_test=1000,
-        #     batch_eval=True
-        # )
-        # within_result["overall_model_acc"] = overall_model_acc
+        # check outcome and util model fit here, from one posterior pass
+        # over the shared test set
+        if self.log_model_fit and method != "pbo":
+            within_result.update(evaluate_model_fit(
+                problem=self.problem,
+                util_func=self.util_func,
+                n_test=1024,
+                outcome_model=self.outcome_models_dict[(method, pe_strategy)],
+                util_model=util_model,
+                seed=self.trial_idx,
+                test_set_registry=self.test_set_registry,
+            ))
 
         return within_result
 
@@ -853,7 +1043,8 @@ class RetrainingBopeExperiment:
                     q=self.BO_batch_size, 
                     acqf_name="qNEI",
                     X=baseline_X, 
-                    seed=self.trial_idx
+                    seed=self.trial_idx,
+                    latent_space=self.latent_space_acqf,
                 )
             # new_cand_X_posterior = self.outcome_models_dict[(method, pe_strategy)].posterior(new_cand_X)
             # new_cand_X_posterior_mean_util = util_model.posterior(new_cand_X_posterior.mean).mean.detach()
@@ -921,20 +1112,27 @@ class RetrainingBopeExperiment:
         max_outcome_error = mc_max_outcome_error(
             problem=self.problem,
             projection=projection,
-            n_test=n_test
+            n_test=n_test,
+            seed=self.trial_idx,
+            test_set_registry=self.test_set_registry
         )
         
         max_util_error = mc_max_util_error(
             problem=self.problem,
             projection=projection,
             util_func=self.util_func,
-            n_test=n_test
+            n_test=n_test,
+            seed=self.trial_idx,
+            test_set_registry=self.test_set_registry
         )
 
         max_subspace_util, avg_subspace_util = best_and_avg_util_in_subspace(
             problem=self.problem, 
             projection=projection, 
-            util_func=self.util_func
+            util_func=self.util_func,
+            n_test=n_test,
+            seed=self.trial_idx,
+            test_set_registry=self.test_set_registry
         )
 
         self.subspace_diagnostics[(method, pe_strategy)]["max_util_error"].append(max_util_error)
@@ -994,14 +1192,10 @@ class RetrainingBopeExperiment:
                 # to fit the subspace needs this step
                 if method.endswith("rt"):
                     logger.info(f"    ~~ Retraining subspace using [{method}] with [{pe_strategy}] during PE")
-                    prev_projection = self.projections_dict[(method, pe_strategy)][-1]
-                    self.compute_projections(method, pe_strategy)
-                    _, _, g = compute_grassmannian(
-                        prev_projection, 
-                        self.projections_dict[(method, pe_strategy)][-1]
-                    )
-                    self.subspace_diagnostics[(method, pe_strategy)]["grassmannian"].append(g)
-                    if method != "pca_norefit_rt":
+                    subspace_changed = self.compute_projections(method, pe_strategy)
+                    self.subspace_diagnostics[(method, pe_strategy)]["grassmannian"].append(
+                        self.subspace_tracker.grassmannian.get((method, pe_strategy)))
+                    if subspace_changed and method != "pca_norefit_rt":
                         self.fit_outcome_model(method, pe_strategy)
                     # run diagnostics on the updated subspaces
                     self.compute_subspace_diagnostics(method, pe_strategy, n_test=1024)
@@ -1051,14 +1245,10 @@ class RetrainingBopeExperiment:
                 # update subspace and refit util model for retraining methods
                 if method.endswith("rt"):
                     logger.info(f"    ~~ Retraining subspace using [{method}] with [{pe_strategy}] during BO")
-                    prev_projection = self.projections_dict[(method, pe_strategy)][-1]
-                    self.compute_projections(method, pe_strategy)
-                    _, _, g = compute_grassmannian(
-                        prev_projection,
-                        self.projections_dict[(method, pe_strategy)][-1]
-                    )
-                    self.subspace_diagnostics[(method, pe_strategy)]["grassmannian"].append(g)
-                    if method != "pca_norefit_rt": # TODO: check
+                    subspace_changed = self.compute_projections(method, pe_strategy)
+                    self.subspace_diagnostics[(method, pe_strategy)]["grassmannian"].append(
+                        self.subspace_tracker.grassmannian.get((method, pe_strategy)))
+                    if subspace_changed and method != "pca_norefit_rt": # TODO: check
                         self.fit_util_model(method, pe_strategy, save_model=True)
                     self.compute_subspace_diagnostics(method, pe_strategy, n_test=1024)
                 
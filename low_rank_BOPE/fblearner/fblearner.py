@@ -53,19 +53,24 @@ def main(
     problem, util_func = make_problem_and_util_func(
         problem_name, options = PROBLEM_SETUPS[problem_name])
     
-    for baseline in baselines:
-        for trial_idx in range(trial_idx_start, trial_idx_end+1):
-            options = copy.deepcopy(EXPERIMENT_SETUPS[problem_name])
-            if baseline in METHOD_SETUPS:
-                method_options = METHOD_SETUPS[baseline]
-                options.update(method_options)
-            run_one_trial(
-                problem=problem, 
-                util_func=util_func, 
-                methods=[baseline], 
-                trial_idx=trial_idx,
-                experiment_options=options
-            )
+    try:
+        for baseline in baselines:
+            for trial_idx in range(trial_idx_start, trial_idx_end+1):
+                options = copy.deepcopy(EXPERIMENT_SETUPS[problem_name])
+                if baseline in METHOD_SETUPS:
+                    method_options = METHOD_SETUPS[baseline]
+                    options.update(method_options)
+                run_one_trial(
+                    problem=problem, 
+                    util_func=util_func, 
+                    methods=[baseline], 
+                    trial_idx=trial_idx,
+                    experiment_options=options
+                )
+    finally:
+        # shut down the worker pool of problems that have one, e.g. the robot
+        if hasattr(problem, "close"):
+            problem.close()
     
 
 @flow.flow_async()
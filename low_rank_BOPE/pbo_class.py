@@ -24,10 +24,12 @@ from sklearn.linear_model import LinearRegression
 from torch import Tensor
 
 from low_rank_BOPE.src.diagnostics import check_util_model_fit, get_function_statistics
-from low_rank_BOPE.src.models import MultitaskGPModel, make_modified_kernel
+from low_rank_BOPE.src.models import (FastPairwiseGP, MultitaskGPModel,
+                                      make_modified_kernel)
 from low_rank_BOPE.src.pref_learning_helpers import gen_comps
 from low_rank_BOPE.src.transforms import (compute_weights, fit_pca,
-                                          get_latent_ineq_constraints)
+                                          get_latent_ineq_constraint_matrix,
+                                          ineq_constraint_matrix_to_tuples)
 
 
 class PboExperiment:
@@ -49,6 +51,8 @@ class PboExperiment:
         "latent_dim": None,
         "min_stdv": 100000,
         "true_axes": None, # specify these for synthetic problems
+        "fast_util_posterior": True, # serve util posteriors in acqf optimization from cached solves, see FastPairwiseGP
+        "util_posterior_truncation_rank": None, # if not None, truncate the util posterior variance cache to this rank (crude, inflates variances), see FastPairwiseGP
     }
 
     def __init__(
@@ -191,11 +195,14 @@ class PboExperiment:
                 torch.tensor([[-10000]*projection.shape[0], [10000]*projection.shape[0]], dtype=torch.double)
             
             if self.outcome_bounds is not None:
-                latent_ineq_constraints = get_latent_ineq_constraints(
+                # dense `A @ latent >= b` form, converted once to the tuples
+                # taken by optimize_acqf
+                latent_ineq_constraint_matrix = get_latent_ineq_constraint_matrix(
                     projection=projection,
                     original_bounds=self.outcome_bounds
                 )
-                self.acqf_bounds_dict[method]["ineq_constraints"] = latent_ineq_constraints
+                self.acqf_bounds_dict[method]["ineq_constraints"] = \
+                    ineq_constraint_matrix_to_tuples(*latent_ineq_constraint_matrix)
             else:
                 self.acqf_bounds_dict[method]["ineq_constraints"] = None
         
@@ -333,9 +340,13 @@ class PboExperiment:
             latent = False
             projection = None
 
+        util_model = self.util_models_dict[method]
+        if self.fast_util_posterior:
+            util_model = FastPairwiseGP(util_model, truncation_rank=self.util_posterior_truncation_rank)
+
         sampler = SobolQMCNormalSampler(64)
         postmean_acqf = qSimpleRegret(
-            model = self.util_models_dict[method], 
+            model = util_model, 
             sampler = sampler,
         ).to(torch.double)
 
@@ -1,4 +1,5 @@
 __all__ = [
+    "caching.py",
     "diagnostics.py",
     "models.py",
     "pref_learning_helpers.py",
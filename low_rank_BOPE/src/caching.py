@@ -0,0 +1,484 @@
+# This file contains helpers for caching expensive, deterministic
+# computations (e.g., the true optimal utility of a test problem, or the
+# outcomes of simulators) on disk, keyed by a fingerprint of the objects
+# the computation depends on.
+
+import contextlib
+import functools
+import hashlib
+import inspect
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from typing import Any, List, Optional
+
+import numpy as np
+import torch
+from botorch.test_functions.base import BaseTestProblem
+
+DEFAULT_CACHE_DIR = os.environ.get(
+    "LOW_RANK_BOPE_CACHE_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "low_rank_BOPE"),
+)
+
+# part of every fingerprint; bump to invalidate all cached results, e.g. when
+# a computation changes in a way the fingerprinted source does not capture
+CACHE_VERSION = 1
+
+
+def compute_fingerprint(*objs: Any, max_depth: int = 4) -> str:
+    r"""Compute a stable hash of (nested) python / numpy / torch objects.
+
+    torch modules are fingerprinted through their class, state dict, and
+    public non-module attributes, so two instances of the same problem or
+    utility function with the same parameters get the same fingerprint.
+    Classes and functions also contribute the source code of the modules
+    that define them (and their base classes), so editing a problem or a
+    utility function invalidates the results cached for it. CACHE_VERSION
+    is hashed in as well.
+    Args:
+        objs: objects to fingerprint
+        max_depth: how deep to recurse into attributes of custom objects;
+            beyond this depth only the type of the object is used
+    Returns:
+        hex digest of the sha256 hash of the objects
+    """
+    hasher = hashlib.sha256()
+    hasher.update(f"version:{CACHE_VERSION};".encode())
+    for obj in objs:
+        _update_fingerprint(hasher, obj, max_depth)
+    return hasher.hexdigest()
+
+
+def _update_fingerprint(hasher, obj: Any, depth: int) -> None:
+    if obj is None or isinstance(obj, (bool, int, float, complex, str, bytes)):
+        hasher.update(f"{type(obj).__name__}:{obj!r};".encode())
+    elif isinstance(obj, torch.Tensor):
+        arr = obj.detach().cpu().contiguous()
+        hasher.update(f"tensor:{arr.dtype}:{tuple(arr.shape)};".encode())
+        if arr.numel() > 0:
+            hasher.update(arr.reshape(-1).view(torch.uint8).numpy().tobytes())
+    elif isinstance(obj, np.ndarray):
+        arr = np.ascontiguousarray(obj)
+        hasher.update(f"ndarray:{arr.dtype}:{arr.shape};".encode())
+        hasher.update(arr.tobytes())
+    elif isinstance(obj, (torch.dtype, torch.device)):
+        hasher.update(f"{obj};".encode())
+    elif isinstance(obj, (list, tuple)):
+        hasher.update(f"{type(obj).__name__}[{len(obj)}];".encode())
+        for item in obj:
+            _update_fingerprint(hasher, item, depth)
+    elif isinstance(obj, dict):
+        hasher.update(f"dict[{len(obj)}];".encode())
+        for key in sorted(obj.keys(), key=repr):
+            _update_fingerprint(hasher, key, depth)
+            _update_fingerprint(hasher, obj[key], depth)
+    elif callable(obj) and hasattr(obj, "__qualname__"):
+        # functions and classes, which do not have a stable repr
+        hasher.update(f"callable:{obj.__module__}.{obj.__qualname__};".encode())
+        _update_source_fingerprint(hasher, obj)
+    else:
+        cls = type(obj)
+        hasher.update(f"object:{cls.__module__}.{cls.__qualname__};".encode())
+        _update_source_fingerprint(hasher, cls)
+        if depth <= 0:
+            return
+        if isinstance(obj, torch.nn.Module):
+            _update_fingerprint(hasher, dict(obj.state_dict()), depth - 1)
+            attrs = {
+                k: v for k, v in vars(obj).items()
+                if not k.startswith("_") and k != "training"
+            }
+        elif hasattr(obj, "__dict__"):
+            attrs = {k: v for k, v in vars(obj).items() if not k.startswith("_")}
+        else:
+            hasher.update(repr(obj).encode())
+            return
+        _update_fingerprint(hasher, attrs, depth - 1)
+
+
+def _update_source_fingerprint(hasher, obj: Any) -> None:
+    classes = obj.__mro__ if isinstance(obj, type) else (obj,)
+    for module_name in dict.fromkeys(getattr(c, "__module__", None) for c in classes):
+        if module_name not in (None, "builtins"):
+            hasher.update(_module_source_hash(module_name).encode())
+
+
+@functools.lru_cache(maxsize=None)
+def _module_source_hash(module_name: str) -> str:
+    try:
+        source = inspect.getsource(sys.modules[module_name])
+    except (KeyError, TypeError, OSError):
+        # e.g. modules implemented in C
+        return f"module:{module_name}"
+    return hashlib.sha256(source.encode()).hexdigest()
+
+
+def get_cache_path(key: str, cache_dir: Optional[str] = None) -> str:
+    return os.path.join(cache_dir or DEFAULT_CACHE_DIR, key + ".th")
+
+
+def load_from_cache(key: str, cache_dir: Optional[str] = None) -> Any:
+    r"""Load the value stored under `key`, or return None if there is none."""
+    path = get_cache_path(key, cache_dir)
+    if not os.path.exists(path):
+        return None
+    try:
+        return torch.load(path)
+    except Exception:
+        # e.g. a file truncated by a crashed writer; treat as a cache miss
+        return None
+
+
+def save_to_cache(key: str, value: Any, cache_dir: Optional[str] = None) -> None:
+    r"""Store `value` under `key`. The file is written to a temporary path
+    first and then moved into place, so concurrent readers never see a
+    partially written file.
+    """
+    path = get_cache_path(key, cache_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            torch.save(value, f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def is_deterministic(problem: Any) -> bool:
+    r"""
+    Whether `problem.evaluate_true` is a deterministic function of the design
+    and the problem's configuration, which is required for caching its
+    outcomes (or anything computed from them) on disk.
+
+    Stochastic problems declare this with a `deterministic` attribute, e.g.,
+    Inventory is deterministic only if its `seed` is set. Otherwise, botorch
+    test problems are taken to be deterministic (their `evaluate_true` is the
+    noiseless objective), and any other problem (e.g., LunarLander) is not.
+    """
+    deterministic = getattr(problem, "deterministic", None)
+    if deterministic is not None:
+        return bool(deterministic)
+    return isinstance(problem, BaseTestProblem)
+
+
+################################################################################
+# Persistent cache of simulator outcomes
+
+
+class OutcomeCache:
+    r"""
+    Content-addressed on-disk cache of outcome vectors.
+
+    Outcomes are appended to memory-mapped shard files
+    `cache_dir/outcomes/shard_<i>.bin`; a small sqlite index maps each key to
+    its (shard, offset, dtype, shape) and keeps the LRU ledger, i.e., when
+    each outcome was last read. Shards are append-only and a new one is
+    started once the current one holds `shard_bytes`. Writers append under
+    the index's write lock, and an outcome is only indexed after its bytes
+    are written, so concurrent readers and writers (e.g., workers of a
+    multiprocessing pool) never see partially written outcomes.
+
+    The total size of the shards is tracked in the index. Only when it
+    exceeds `max_bytes` are shards evicted, least recently used first (a
+    shard is as recent as its most recently read outcome), so the cache
+    can exceed `max_bytes` by at most one shard.
+    """
+
+    def __init__(
+        self,
+        cache_dir: Optional[str] = None,
+        max_bytes: int = 2 * 1024 ** 3,
+        shard_bytes: int = 64 * 1024 ** 2,
+    ):
+        r"""
+        Args:
+            cache_dir: root directory of the cache, defaults to DEFAULT_CACHE_DIR
+            max_bytes: maximum total size of the stored outcomes
+            shard_bytes: size at which a new shard file is started
+        """
+        self.cache_dir = os.path.join(cache_dir or DEFAULT_CACHE_DIR, "outcomes")
+        self.max_bytes = max_bytes
+        self.shard_bytes = shard_bytes
+        self._conn = None
+        self._conn_pid = None
+        self._shards = {}
+
+    def __getstate__(self):
+        # connections and memory maps cannot be sent to other processes
+        state = self.__dict__.copy()
+        state["_conn"], state["_conn_pid"], state["_shards"] = None, None, {}
+        return state
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None or self._conn_pid != os.getpid():
+            os.makedirs(self.cache_dir, exist_ok=True)
+            conn = sqlite3.connect(
+                os.path.join(self.cache_dir, "index.sqlite"),
+                timeout=600,
+                isolation_level=None,  # transactions are managed explicitly
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS outcomes (key TEXT PRIMARY KEY, "
+                "shard INTEGER, offset INTEGER, dtype TEXT, shape TEXT, "
+                "last_used REAL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS shards (shard INTEGER PRIMARY KEY, "
+                "nbytes INTEGER)"
+            )
+            self._conn, self._conn_pid, self._shards = conn, os.getpid(), {}
+        return self._conn
+
+    def _shard_path(self, shard: int) -> str:
+        return os.path.join(self.cache_dir, f"shard_{shard}.bin")
+
+    def _read(self, shard: int, offset: int, dtype: str, shape: str) -> np.ndarray:
+        dtype = np.dtype(dtype)
+        shape = tuple(int(d) for d in shape.split(",") if d)
+        nbytes = dtype.itemsize * int(np.prod(shape))
+        mm = self._shards.get(shard)
+        if mm is None or len(mm) < offset + nbytes:
+            # shards grow by appending, so remap if the outcome is past the end
+            mm = np.memmap(self._shard_path(shard), dtype=np.uint8, mode="r")
+            self._shards[shard] = mm
+        return mm[offset:offset + nbytes].view(dtype).reshape(shape)
+
+    def get_many(self, keys: List[str]) -> List[Optional[np.ndarray]]:
+        r"""
+        Return the outcomes stored under `keys` (None for those that are not
+        cached), and mark them as recently used.
+        """
+        conn = self._connect()
+        rows = {}
+        for i in range(0, len(keys), _SQLITE_MAX_VARS):
+            chunk = keys[i:i + _SQLITE_MAX_VARS]
+            rows.update(
+                (row[0], row[1:])
+                for row in conn.execute(
+                    "SELECT key, shard, offset, dtype, shape FROM outcomes WHERE key IN "
+                    f"({','.join('?' * len(chunk))})",
+                    chunk,
+                )
+            )
+
+        values = []
+        for key in keys:
+            value = None
+            if key in rows:
+                try:
+                    value = self._read(*rows[key])
+                except (OSError, ValueError):
+                    # shard evicted concurrently
+                    rows.pop(key)
+            values.append(value)
+
+        if len(rows) > 0:
+            now = time.time()
+            with _transaction(conn):
+                conn.executemany(
+                    "UPDATE outcomes SET last_used = ? WHERE key = ?",
+                    [(now, key) for key in rows],
+                )
+        return values
+
+    def put_many(self, keys: List[str], values: List[np.ndarray]) -> None:
+        r"""Store `values` under `keys`, then evict shards if over max_bytes."""
+        conn = self._connect()
+        with _transaction(conn):
+            row = conn.execute(
+                "SELECT shard, nbytes FROM shards ORDER BY shard DESC LIMIT 1"
+            ).fetchone()
+            shard, shard_nbytes = row if row is not None else (0, 0)
+            if row is None or shard_nbytes >= self.shard_bytes:
+                shard, shard_nbytes = shard + 1, 0
+                conn.execute("INSERT INTO shards VALUES (?, 0)", (shard,))
+
+            entries = []
+            with open(self._shard_path(shard), "ab") as f:
+                # bytes left behind by a writer that crashed before committing
+                # are dead space, the tracked size is the end of the file
+                offset = f.seek(0, os.SEEK_END)
+                for key, value in zip(keys, values):
+                    value = np.ascontiguousarray(value)
+                    data = value.tobytes()
+                    f.write(data + b"\0" * (-len(data) % _ALIGNMENT))
+                    entries.append((
+                        key, shard, offset, value.dtype.str,
+                        ",".join(str(d) for d in value.shape), time.time(),
+                    ))
+                    offset += len(data) + (-len(data) % _ALIGNMENT)
+            conn.executemany(
+                "INSERT OR IGNORE INTO outcomes VALUES (?, ?, ?, ?, ?, ?)", entries
+            )
+            conn.execute("UPDATE shards SET nbytes = ? WHERE shard = ?", (offset, shard))
+
+            total_bytes = conn.execute("SELECT SUM(nbytes) FROM shards").fetchone()[0]
+            if total_bytes > self.max_bytes:
+                self._evict(conn, total_bytes, active_shard=shard)
+
+    def _evict(
+        self, conn: sqlite3.Connection, total_bytes: int, active_shard: int
+    ) -> None:
+        r"""Evict least recently used shards until the cache fits in max_bytes."""
+        shards = conn.execute(
+            "SELECT shards.shard, shards.nbytes FROM shards LEFT JOIN outcomes "
+            "ON shards.shard = outcomes.shard WHERE shards.shard != ? "
+            "GROUP BY shards.shard ORDER BY MAX(outcomes.last_used)",
+            (active_shard,),
+        ).fetchall()
+        for shard, nbytes in shards:
+            if total_bytes <= self.max_bytes:
+                break
+            conn.execute("DELETE FROM outcomes WHERE shard = ?", (shard,))
+            conn.execute("DELETE FROM shards WHERE shard = ?", (shard,))
+            self._shards.pop(shard, None)
+            try:
+                # readers that mapped the shard keep a valid map until they drop it
+                os.remove(self._shard_path(shard))
+            except OSError:
+                pass
+            total_bytes -= nbytes
+
+
+# outcomes are stored at offsets aligned to this many bytes
+_ALIGNMENT = 16
+# number of keys looked up per sqlite query
+_SQLITE_MAX_VARS = 500
+
+
+@contextlib.contextmanager
+def _transaction(conn: sqlite3.Connection):
+    # BEGIN IMMEDIATE takes the write lock up front, serializing writers
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+
+class CachedProblem(torch.nn.Module):
+    r"""
+    Wrap a test problem so that its noiseless outcomes are memoized on disk.
+
+    The outcome of each design is stored under a hash of (problem
+    configuration, exact bits of the design, env seed), so designs evaluated
+    in earlier trials, sweeps or crashed runs are not simulated again. Only
+    the designs that are not cached are passed to `problem.evaluate_true`,
+    in one batch. Other attributes (bounds, outcome_dim, ...) are forwarded
+    to the wrapped problem.
+
+    This requires the outcome of a design to be a deterministic function of
+    the key, i.e., that simulator randomness is controlled by the problem
+    configuration (see `is_deterministic`); otherwise the first noisy outcome
+    of each design would be replayed forever, so stochastic problems are
+    refused. Cached outcomes are not differentiable.
+    """
+
+    def __init__(
+        self,
+        problem,
+        env_seed: Optional[int] = None,
+        cache_dir: Optional[str] = None,
+        max_bytes: int = 2 * 1024 ** 3,
+        problem_config: Any = None,
+    ):
+        r"""
+        Args:
+            problem: test problem with an `evaluate_true` method mapping a
+                `n x d` tensor of designs to outcomes
+            env_seed: seed of the simulator environment, part of the key
+            cache_dir: root directory of the cache, defaults to DEFAULT_CACHE_DIR
+            max_bytes: maximum total size of the stored outcomes
+            problem_config: optional object identifying the problem
+                configuration; by default, the fingerprint of `problem`
+        """
+        if not is_deterministic(problem):
+            raise ValueError(
+                f"{type(problem).__name__} is not deterministic, so its outcomes "
+                "cannot be cached; seed it (e.g., Inventory(seed=...)) or set "
+                "its `deterministic` attribute."
+            )
+        super().__init__()
+        self.problem = problem
+        self.env_seed = env_seed
+        self.problem_config = problem_config
+        self.outcome_cache = OutcomeCache(cache_dir=cache_dir, max_bytes=max_bytes)
+        self._problem_key = None
+
+    def __getattr__(self, name: str):
+        try:
+            return super().__getattr__(name)
+        except AttributeError:
+            if name == "problem":
+                raise
+            return getattr(self.problem, name)
+
+    def _apply(self, fn, *args, **kwargs):
+        # e.g. .double() changes the problem's state and hence its fingerprint
+        self._problem_key = None
+        return super()._apply(fn, *args, **kwargs)
+
+    def get_problem_key(self) -> str:
+        if self._problem_key is None:
+            if self.problem_config is not None:
+                self._problem_key = compute_fingerprint(self.problem_config)
+            else:
+                self._problem_key = compute_fingerprint(self.problem)
+        return self._problem_key
+
+    def get_design_key(self, x: np.ndarray) -> str:
+        r"""Key of a single design, given as a 1-d array."""
+        hasher = hashlib.sha256()
+        hasher.update(self.get_problem_key().encode())
+        hasher.update(f"env_seed:{self.env_seed!r};".encode())
+        hasher.update(f"{x.dtype}:{x.shape};".encode())
+        hasher.update(np.ascontiguousarray(x).tobytes())
+        return hasher.hexdigest()
+
+    def evaluate_true(self, X: torch.Tensor) -> torch.Tensor:
+        r"""
+        Args:
+            X: `batch_shape x d` tensor of designs
+        Returns:
+            `batch_shape x outcome_dim` tensor of outcomes
+        """
+        X_flat = X.detach().cpu().reshape(-1, X.shape[-1])
+        X_np = X_flat.numpy()
+        keys = [self.get_design_key(x) for x in X_np]
+
+        outcomes = self.outcome_cache.get_many(keys)
+        miss_idcs = [i for i, outcome in enumerate(outcomes) if outcome is None]
+
+        if len(miss_idcs) > 0:
+            Y_miss = self.problem.evaluate_true(X_flat[miss_idcs].to(X))
+            Y_miss = Y_miss.detach().cpu().reshape(len(miss_idcs), -1).numpy()
+            self.outcome_cache.put_many([keys[i] for i in miss_idcs], list(Y_miss))
+            for i, y in zip(miss_idcs, Y_miss):
+                outcomes[i] = y
+
+        Y = torch.as_tensor(np.stack(outcomes))
+        return Y.to(device=X.device).reshape(*X.shape[:-1], Y.shape[-1])
+
+    def forward(self, X: torch.Tensor, noise: bool = True) -> torch.Tensor:
+        r"""
+        Evaluate the problem on `X` like `BaseTestProblem.forward`, i.e.,
+        adding observation noise if `noise` and negating if the problem does.
+        """
+        batch = X.ndimension() > 1
+        X = X if batch else X.unsqueeze(0)
+        f = self.evaluate_true(X)
+        noise_std = getattr(self.problem, "noise_std", None)
+        if noise and noise_std is not None:
+            f = f + noise_std * torch.randn_like(f)
+        if getattr(self.problem, "negate", False):
+            f = -f
+        return f if batch else f.squeeze(0)
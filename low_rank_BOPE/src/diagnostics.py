@@ -1,21 +1,230 @@
 import copy
 import sys
-from typing import List, Optional, Tuple
+import weakref
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
 
 import gpytorch
-import scipy.stats as stats
 import torch
 from botorch.acquisition.preference import AnalyticExpectedUtilityOfBestOption
 from botorch.models.model import Model
 from botorch.utils.sampling import draw_sobol_samples
 from torch import Tensor
+from torch.quasirandom import SobolEngine
 import numpy as np
 
-from low_rank_BOPE.src.pref_learning_helpers import (gen_initial_real_data,
+from low_rank_BOPE.src.pref_learning_helpers import (gen_comps,
+                                                     gen_initial_real_data,
                                                      generate_random_inputs)
+from low_rank_BOPE.src.transforms import inequality_constraints_to_matrix
 
 sys.path.append('..')
 
+# number of test points pushed through the outcome function, utility function
+# or model posterior at a time; bounds the memory used by the diagnostics
+DEFAULT_CHUNK_SIZE = 256
+
+# names of the util model accuracies computed on the top quantiles of the test set
+_TOP_QUANTILE_NAMES = {1.0: "", 0.5: "_top_half", 0.25: "_top_quarter"}
+
+################################################################################
+# Shared, chunked Monte Carlo test sets
+
+def evaluate_in_chunks(
+    func: Callable, X: Tensor, chunk_size: int = DEFAULT_CHUNK_SIZE
+) -> Tensor:
+    r"""
+    Evaluate `func` on the rows of `X`, at most `chunk_size` rows at a time.
+
+    Args:
+        func: function mapping a `n x d` tensor to a `n x m` (or `n`) tensor,
+            e.g., `problem.evaluate_true` or a utility function
+        X: `n_test x d` tensor of inputs
+        chunk_size: maximum number of rows passed to `func` at once
+    Returns:
+        `n_test x m` (or `n_test`) tensor of detached function values
+    """
+    return torch.cat(
+        [func(X_chunk).detach() for X_chunk in torch.split(X, chunk_size)], dim=0
+    )
+
+
+class TestSetRegistry:
+    r"""
+    Registry of noiseless Monte Carlo test sets (X, f(X), g(f(X))), where
+    f is `problem.evaluate_true` and g is a utility function.
+
+    Test sets are memoized by (problem, n_test, seed), so that the ground
+    truth is evaluated once and the same tensors are handed to every
+    diagnostic and every method. Utility values are memoized per utility
+    function on top of the outcomes. At most `max_size` test sets are kept;
+    the least recently used one is evicted first. Problems and utility
+    functions are only referenced weakly, so their test sets are dropped
+    together with them.
+    """
+
+    # not a test case, despite the name
+    __test__ = False
+
+    def __init__(self, max_size: int = 4, chunk_size: int = DEFAULT_CHUNK_SIZE):
+        r"""
+        Args:
+            max_size: maximum number of (problem, n_test, seed) test sets kept
+            chunk_size: maximum number of points passed to the outcome and
+                utility functions at once
+        """
+        self.max_size = max_size
+        self.chunk_size = chunk_size
+        # problem -> {(n_test, seed): test set}
+        self._test_sets = weakref.WeakKeyDictionary()
+        self._clock = 0
+
+    def __len__(self):
+        return sum(len(test_sets) for test_sets in self._test_sets.values())
+
+    def __getstate__(self):
+        # weak references cannot be pickled, so send the test sets with strong
+        # references; they are kept in the copy as long as the problems are,
+        # e.g. when pickling an experiment together with its problem
+        state = self.__dict__.copy()
+        state["_test_sets"] = [
+            (problem, {
+                key: {**test_set, "util_vals": list(test_set["util_vals"].items())}
+                for key, test_set in test_sets.items()
+            })
+            for problem, test_sets in self._test_sets.items()
+        ]
+        return state
+
+    def __setstate__(self, state):
+        test_sets = state.pop("_test_sets")
+        self.__dict__.update(state)
+        self._test_sets = weakref.WeakKeyDictionary()
+        for problem, problem_test_sets in test_sets:
+            self._test_sets[problem] = {
+                key: {**test_set, "util_vals": weakref.WeakKeyDictionary(test_set["util_vals"])}
+                for key, test_set in problem_test_sets.items()
+            }
+
+    def clear(self):
+        self._test_sets.clear()
+
+    def _evict(self):
+        while len(self) > self.max_size:
+            problem, key = min(
+                (
+                    (problem, key)
+                    for problem, test_sets in self._test_sets.items()
+                    for key in test_sets
+                ),
+                key=lambda item: self._test_sets[item[0]][item[1]]["last_used"],
+            )
+            del self._test_sets[problem][key]
+
+    def get(
+        self,
+        problem: torch.nn.Module,
+        n_test: int,
+        seed: Optional[int] = None,
+        util_func: Optional[torch.nn.Module] = None,
+    ) -> Tuple[Tensor, Tensor, Optional[Tensor]]:
+        r"""
+        Get the test set for `problem`, evaluating it if it is not registered.
+        If `seed` is None, a fresh test set is drawn using the global random
+        number generator and is not registered.
+
+        Args:
+            problem: a TestProblem, maps inputs to outcomes
+            n_test: number of test points
+            seed: seed for drawing the Sobol test inputs
+            util_func: optional ground truth utility function
+        Returns:
+            test_X: `n_test x input_dim` tensor of test inputs
+            test_Y: `n_test x outcome_dim` tensor of true outcomes
+            test_util_vals: utility values of test_Y, None if util_func is None
+        """
+        key = (n_test, seed)
+        test_sets = self._test_sets.get(problem, {})
+        if seed is not None and key in test_sets:
+            test_set = test_sets[key]
+        else:
+            test_X = generate_random_inputs(problem, n_test, seed=seed).detach()
+            test_set = {
+                "X": test_X,
+                "Y": evaluate_in_chunks(
+                    problem.evaluate_true, test_X, self.chunk_size),
+                "util_vals": weakref.WeakKeyDictionary(),
+            }
+            if seed is not None:
+                self._test_sets.setdefault(problem, {})[key] = test_set
+        self._clock += 1
+        test_set["last_used"] = self._clock
+        self._evict()
+
+        test_util_vals = None
+        if util_func is not None:
+            if util_func in test_set["util_vals"]:
+                test_util_vals = test_set["util_vals"][util_func]
+            else:
+                test_util_vals = evaluate_in_chunks(
+                    util_func, test_set["Y"], self.chunk_size)
+                try:
+                    test_set["util_vals"][util_func] = test_util_vals
+                except TypeError:
+                    # not weakly referenceable (e.g. a builtin), not memoized
+                    pass
+
+        return test_set["X"], test_set["Y"], test_util_vals
+
+
+# used by the diagnostics when no registry is passed in; it does not keep the
+# problems (or their test sets) alive
+_default_test_set_registry = TestSetRegistry()
+
+
+def get_test_set(
+    problem: torch.nn.Module,
+    n_test: int,
+    seed: Optional[int] = None,
+    util_func: Optional[torch.nn.Module] = None,
+    test_set_registry: Optional[TestSetRegistry] = None,
+) -> Tuple[Tensor, Tensor, Optional[Tensor]]:
+    r"""
+    Get a noiseless Monte Carlo test set (X, f(X), g(f(X))) for `problem`.
+
+    If `seed` is given, the test set is evaluated once and shared across all
+    calls with the same problem, `n_test` and `seed`, so that the different
+    diagnostics (and methods) are computed on the same points. If `seed` is
+    None, a fresh test set is drawn using the global random number generator.
+
+    Args:
+        problem: a TestProblem, maps inputs to outcomes
+        n_test: number of test points
+        seed: seed for drawing the Sobol test inputs
+        util_func: optional ground truth utility function
+        test_set_registry: registry to look up / store the test set in;
+            defaults to a module-level registry
+    Returns:
+        test_X: `n_test x input_dim` tensor of test inputs
+        test_Y: `n_test x outcome_dim` tensor of true outcomes
+        test_util_vals: utility values of test_Y, None if util_func is None
+    """
+    if test_set_registry is None:
+        test_set_registry = _default_test_set_registry
+    return test_set_registry.get(problem, n_test, seed=seed, util_func=util_func)
+
+
+def _projected_chunks(
+    test_Y: Tensor, projection: Tensor, chunk_size: int
+) -> Iterator[Tuple[Tensor, Tensor]]:
+    r"""
+    Iterate over chunks of `test_Y` together with their projection
+    $VV^T y$ onto the subspace spanned by the rows of `projection`, computed
+    as `(Y V^T) V` without materializing the `outcome_dim x outcome_dim`
+    projection matrix.
+    """
+    for Y_chunk in torch.split(test_Y, chunk_size):
+        yield Y_chunk, (Y_chunk @ projection.transpose(-2, -1)) @ projection
+
 
 ################################################################################
 # Diagnostics for subspace quality, subspace similarity, etc.
@@ -101,7 +310,14 @@ def empirical_max_outcome_error(Y: Tensor, projection: Tensor) -> float:
     return torch.max(Y_orth_proj_norm).item()
 
 
-def mc_max_outcome_error(problem, projection, n_test) -> float:
+def mc_max_outcome_error(
+    problem,
+    projection,
+    n_test,
+    seed: Optional[int] = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    test_set_registry: Optional[TestSetRegistry] = None,
+) -> float:
     r"""
     Compute the diagnostic $max_x \|(I-VV^T)f(x)\|_2$,
     through Monte Carlo sampling. V = projection transposed,
@@ -116,26 +332,24 @@ def mc_max_outcome_error(problem, projection, n_test) -> float:
         projection: num_axes x outcome_dim tensor,
             each row a learned principal axis
         n_test: number of Monte Carlo samples to take
+        seed: if not None, use the shared test set drawn with this seed
+        chunk_size: number of test points processed at a time
+        test_set_registry: registry holding the shared test sets
     Returns:
         maximum norm, among the sampled data points, of the
             outcome component projected onto the orthogonal space of V
     """
 
-    test_X = generate_random_inputs(problem, n_test).detach()
-    test_Y = problem.evaluate_true(test_X).detach()
-
-    outcome_dim = test_Y.shape[-1]
+    _, test_Y, _ = get_test_set(
+        problem, n_test, seed=seed, test_set_registry=test_set_registry)
 
-    # I-VV^T, projection onto orthogonal space of V, shape is outcome_dim x outcome_dim
-    orth_proj = (
-        torch.eye(outcome_dim) -
-        torch.transpose(projection, -2, -1) @ projection
+    # residual (I-VV^T)y = y - VV^T y, computed chunk by chunk
+    max_error = max(
+        torch.linalg.norm(Y_chunk - Y_proj, dim=1).max().item()
+        for Y_chunk, Y_proj in _projected_chunks(test_Y, projection, chunk_size)
     )
 
-    # test_Y @ orth_proj is num_samples x outcome_dim
-    test_Y_orth_proj_norm = torch.linalg.norm(test_Y @ orth_proj, dim=1)
-
-    return torch.max(test_Y_orth_proj_norm).item()
+    return max_error
 
 
 def empirical_max_util_error(Y, projection, util_func) -> float:
@@ -170,7 +384,15 @@ def empirical_max_util_error(Y, projection, util_func) -> float:
     return torch.max(util_difference).item()
 
 
-def mc_max_util_error(problem, projection, util_func, n_test) -> float:
+def mc_max_util_error(
+    problem,
+    projection,
+    util_func,
+    n_test,
+    seed: Optional[int] = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    test_set_registry: Optional[TestSetRegistry] = None,
+) -> float:
     r"""
     Compute the diagnostic $max_x \|g(f(x)) - g(VV^T f(x))\|_2$,
     through Monte Carlo sampling. V = projection transposed, where
@@ -188,26 +410,41 @@ def mc_max_util_error(problem, projection, util_func, n_test) -> float:
             each row a learned principal axis
         util_func: ground truth utility function (outcome -> utility)
         n_test: number of test points to estimate the expectation
+        seed: if not None, use the shared test set drawn with this seed
+        chunk_size: number of test points processed at a time
+        test_set_registry: registry holding the shared test sets
     Returns:
         maximum difference, among the sampled data points, of the
             true utility value and the utility value of the projection
             of sampled outcome data onto the subpace V.
     """
 
-    test_X = generate_random_inputs(problem, n_test).detach()
-    test_Y = problem.evaluate_true(test_X).detach()
-
-    # VV^T, projection onto subspace spanned by V, `outcome_dim x outcome_dim`
-    proj = torch.transpose(projection, -2, -1) @ projection
+    _, test_Y, test_util_vals = get_test_set(
+        problem, n_test, seed=seed, util_func=util_func,
+        test_set_registry=test_set_registry
+    )
 
-    # compute util(Y) - util(VV^T Y)
-    test_util_difference = torch.abs(
-        util_func(test_Y) - util_func(test_Y @ proj))
+    # compute util(Y) - util(VV^T Y), chunk by chunk
+    max_error = max(
+        torch.abs(util_chunk - util_func(Y_proj)).max().item()
+        for util_chunk, (_, Y_proj) in zip(
+            torch.split(test_util_vals, chunk_size),
+            _projected_chunks(test_Y, projection, chunk_size)
+        )
+    )
 
-    return torch.max(test_util_difference).item()
+    return max_error
 
 
-def best_and_avg_util_in_subspace(problem, projection, util_func, n_test = 1024):
+def best_and_avg_util_in_subspace(
+    problem,
+    projection,
+    util_func,
+    n_test = 1024,
+    seed: Optional[int] = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    test_set_registry: Optional[TestSetRegistry] = None,
+):
     r"""
     Compute the diagnostic $max_x g(VV^T f(x))$ and $E_x g(VV^T f(x))$
     through Monte Carlo sampling. V = projection transposed, where
@@ -224,20 +461,24 @@ def best_and_avg_util_in_subspace(problem, projection, util_func, n_test = 1024)
             each row a learned principal axis
         util_func: ground truth utility function (outcome -> utility)
         n_test: number of test points to estimate the expectation
+        seed: if not None, use the shared test set drawn with this seed
+        chunk_size: number of test points processed at a time
+        test_set_registry: registry holding the shared test sets
     Returns:
         maximum and average utility value of sampled outcome vectors projected 
             onto the subspace V
     """
 
-    test_X = generate_random_inputs(problem, n_test).detach()
-    test_Y = problem.evaluate_true(test_X).detach()
-
-    # VV^T, projection onto subspace spanned by V, `outcome_dim x outcome_dim`
-    proj = torch.transpose(projection, -2, -1) @ projection
+    _, test_Y, _ = get_test_set(
+        problem, n_test, seed=seed, test_set_registry=test_set_registry)
 
-    util_vals = util_func(test_Y @ proj)
+    max_util, sum_util = -float("inf"), 0.0
+    for _, Y_proj in _projected_chunks(test_Y, projection, chunk_size):
+        util_vals = util_func(Y_proj).detach()
+        max_util = max(max_util, torch.max(util_vals).item())
+        sum_util += torch.sum(util_vals).item()
 
-    return torch.max(util_vals).item(), torch.mean(util_vals).item()
+    return max_util, sum_util / n_test
 
 
 def compute_variance_explained_per_axis(data, axes, **tkwargs) -> torch.Tensor:
@@ -312,7 +553,10 @@ def check_outcome_model_fit(
     outcome_model: Model, 
     problem: torch.nn.Module, 
     n_test: int, 
-    batch_eval: bool = True
+    batch_eval: bool = True,
+    seed: Optional[int] = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    test_set_registry: Optional[TestSetRegistry] = None,
 ) -> float:
     r"""
     Evaluate the goodness of fit of the outcome model.
@@ -320,28 +564,42 @@ def check_outcome_model_fit(
         outcome_model: GP model mapping input to outcome
         problem: TestProblem
         n_test: size of test set
+        batch_eval: if True, evaluate the noiseless outcome function on the
+            whole test set (in chunks); otherwise, call the (noisy) problem
+            point by point
+        seed: seed of the test set; defaults to `n_test`. With `batch_eval`,
+            the test set is shared with the other diagnostics using this seed
+        chunk_size: number of test points the posterior is computed on at once
+        test_set_registry: registry holding the shared test sets
     Returns:
         mse: mean squared error between posterior mean and true value
             of the test set observations
     """
 
     torch.manual_seed(n_test)
+    if seed is None:
+        seed = n_test
 
     # generate test set
-    test_X = generate_random_inputs(problem, n_test).detach()
     if not batch_eval:
+        test_X = generate_random_inputs(problem, n_test, seed=seed).detach()
         Y_list = []
         for idx in range(len(test_X)):
             y = problem(test_X[idx]).detach()
             Y_list.append(y)
         test_Y = torch.stack(Y_list).squeeze(1)
     else:
-        test_Y = problem.evaluate_true(test_X).detach()
+        test_X, test_Y, _ = get_test_set(
+            problem, n_test, seed=seed, test_set_registry=test_set_registry)
 
     test_Y_mean = test_Y.mean(axis=0)
 
-    # run outcome model posterior prediction on test data
-    test_posterior_mean = outcome_model.posterior(test_X).mean
+    # run outcome model posterior prediction on test data, chunk by chunk
+    # so that the joint posterior covariance stays small
+    with torch.no_grad():
+        test_posterior_mean = evaluate_in_chunks(
+            lambda X: outcome_model.posterior(X).mean, test_X, chunk_size
+        )
 
     # Deprecated: relative SE/MSE taking average of fractions
     # mse = ((test_posterior_mean - test_Y)**2 / test_Y**2).mean(axis=0).detach().sum().item()
@@ -363,7 +621,9 @@ def check_util_model_fit(
     return_util_vals: bool = False,
     projection: Optional[Tensor] = None,
     kendalltau: bool = True,
-    top_quantile: float = 1.0
+    top_quantile: float = 1.0,
+    seed: Optional[int] = None,
+    test_set_registry: Optional[TestSetRegistry] = None,
 ) -> float:
     r"""
     Evaluate the goodness of fit of the utility model.
@@ -377,19 +637,29 @@ def check_util_model_fit(
             latent space; if not None, the pref model is fit on the latent space
         top_quantile: fraction of the test data with high utility values to test
             for accuracy of preference prediction
+        seed: if not None (and batch_eval is True), use the shared noiseless
+            test set drawn with this seed instead of a fresh one
+        test_set_registry: registry holding the shared test sets
     Returns:
         pref_prediction_accuracy: fraction of the `n_test/2` pairwise
             preference that the model correctly predicts
     """
 
     # generate test set
-    test_X, test_Y, test_util_vals, test_comps = gen_initial_real_data(
-        n=n_test, 
-        problem=problem, 
-        util_func=util_func, 
-        comp_noise=0, 
-        batch_eval=batch_eval
-    )
+    if seed is not None and batch_eval:
+        test_X, test_Y, test_util_vals = get_test_set(
+            problem, n_test, seed=seed, util_func=util_func,
+            test_set_registry=test_set_registry
+        )
+        test_comps = gen_comps(test_util_vals)
+    else:
+        test_X, test_Y, test_util_vals, test_comps = gen_initial_real_data(
+            n=n_test, 
+            problem=problem, 
+            util_func=util_func, 
+            comp_noise=0, 
+            batch_eval=batch_eval
+        )
     if len(test_util_vals.shape) == 1:
         test_util_vals = test_util_vals.unsqueeze(1)
 
@@ -415,11 +685,8 @@ def check_util_model_fit(
     
     if kendalltau:
         # compute kendall's tau rank correlation
-        pref_prediction_accuracy, p = stats.kendalltau(
-            posterior_util_mean.detach().numpy(), 
-            test_util_vals.detach().numpy()
-        )
-        # print(f"Kendall's tau rank correlation: {pref_prediction_accuracy}, p-value: {p}")
+        pref_prediction_accuracy = torch.tensor(
+            kendall_tau(posterior_util_mean, test_util_vals))
     else:
         # compute pref prediction accuracy for adjacent pairs
         # the prediction for pair (i, i+1) is correct if
@@ -497,11 +764,8 @@ def check_overall_fit(
 
     if kendalltau:
         # compute kendall's tau rank correlation
-        pref_prediction_accuracy, p = stats.kendalltau(
-            posterior_util_mean.detach().numpy(), 
-            test_util_vals.detach().numpy()
-        )
-        # print(f"Overall model accuracy Kendall's tau: {pref_prediction_accuracy}, p-value: {p}")
+        pref_prediction_accuracy = torch.tensor(
+            kendall_tau(posterior_util_mean, test_util_vals))
     else:
         # compute pref prediction accuracy for adjacent pairs
         # the prediction for pair (i, i+1) is correct if
@@ -522,9 +786,292 @@ def check_overall_fit(
         return pref_prediction_accuracy.item()
 
 
+def kendall_tau(
+    x: Tensor, y: Tensor, chunk_size: int = DEFAULT_CHUNK_SIZE
+) -> float:
+    r"""
+    Kendall's tau-b rank correlation between `x` and `y` (same as the default
+    of scipy.stats.kendalltau), from the signs of all pairwise differences,
+    computed on torch tensors `chunk_size` rows at a time.
+
+    Args:
+        x, y: `n` (or `n x 1`) tensors
+        chunk_size: number of rows of the `n x n` sign matrices formed at once
+    Returns:
+        tau, nan if either input is constant
+    """
+    x, y = x.detach().reshape(-1), y.detach().reshape(-1).to(x)
+    n = x.shape[0]
+    concordance, x_ties, y_ties = 0.0, 0, 0
+    for start in range(0, n, chunk_size):
+        x_sign = torch.sign(x[start : start + chunk_size].unsqueeze(-1) - x)
+        y_sign = torch.sign(y[start : start + chunk_size].unsqueeze(-1) - y)
+        concordance += (x_sign * y_sign).sum().item()
+        x_ties += (x_sign == 0).sum().item()
+        y_ties += (y_sign == 0).sum().item()
+    # each pair appears twice in the sign matrices, and each point is tied with itself
+    n_pairs = n * (n - 1) / 2
+    denominator = np.sqrt(
+        (n_pairs - (x_ties - n) / 2) * (n_pairs - (y_ties - n) / 2)
+    )
+    if denominator == 0:
+        return float("nan")
+    return concordance / 2 / denominator
+
+
+def evaluate_model_fit(
+    problem: torch.nn.Module,
+    util_func: torch.nn.Module,
+    n_test: int,
+    outcome_model: Optional[Model] = None,
+    util_model: Optional[Model] = None,
+    projection: Optional[Tensor] = None,
+    top_quantiles: Tuple[float] = (1.0, 0.5, 0.25),
+    seed: Optional[int] = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    test_set_registry: Optional[TestSetRegistry] = None,
+) -> Dict[str, float]:
+    r"""
+    Evaluate the fit of the outcome and utility models with one posterior pass
+    over one shared noiseless test set, computing the metrics of
+    check_outcome_model_fit, check_util_model_fit (for several top quantiles,
+    Kendall's tau and adjacent-pair accuracy) and check_overall_fit together.
+
+    Args:
+        problem: TestProblem
+        util_func: ground truth utility function (outcome -> utility)
+        n_test: size of the test set
+        outcome_model: optional GP model mapping input to outcome
+        util_model: optional GP model mapping outcome to utility
+        projection: optional `latent_dim x outcome_dim` tensor of projection to
+            latent space; if not None, the util model is fit on the latent space
+        top_quantiles: fractions of the test data with the highest utility values
+            on which the Kendall's tau of the utility model is computed
+        seed: seed of the shared test set; defaults to `n_test`
+        chunk_size: number of test points the posteriors are computed on at once
+        test_set_registry: registry holding the shared test sets
+    Returns:
+        dictionary of the metrics that apply to the given models:
+            "rel_mse": relative MSE of the outcome model, see check_outcome_model_fit()
+            "util_model_acc", "util_model_acc_top_half", "util_model_acc_top_quarter",
+                ("util_model_acc_top_{q}" for other quantiles): Kendall's tau between
+                the util model's posterior mean and the true utility on the top quantiles
+            "util_model_pair_acc": accuracy of the util model on adjacent test pairs
+            "overall_model_acc": Kendall's tau between the true utility and
+                util_model(outcome_model(x))
+    """
+    if seed is None:
+        seed = n_test
+    test_X, test_Y, test_util_vals = get_test_set(
+        problem, n_test, seed=seed, util_func=util_func,
+        test_set_registry=test_set_registry)
+    test_util_vals = test_util_vals.reshape(-1)
+    metrics = {}
+
+    with torch.no_grad():
+        if outcome_model is not None:
+            posterior_Y_mean = evaluate_in_chunks(
+                lambda X: outcome_model.posterior(X).mean, test_X, chunk_size)
+            metrics["rel_mse"] = (
+                torch.sum((posterior_Y_mean - test_Y) ** 2)
+                / torch.sum((test_Y - test_Y.mean(axis=0)) ** 2)
+            ).item()
+
+        if util_model is None:
+            return metrics
+
+        def util_posterior_mean(Y):
+            if projection is not None:
+                Y = torch.matmul(Y, torch.transpose(projection, -2, -1))
+            return util_model.posterior(Y).mean.reshape(-1)
+
+        posterior_util_mean = evaluate_in_chunks(util_posterior_mean, test_Y, chunk_size)
+
+        # rank the test points by true utility once for all quantiles
+        util_order = torch.argsort(test_util_vals, descending=True)
+        for top_quantile in top_quantiles:
+            if top_quantile < 1.0:
+                n_select = int(n_test * top_quantile)
+                n_select += n_select % 2
+                top_indices = util_order[:n_select]
+            else:
+                top_indices = util_order
+            name = _TOP_QUANTILE_NAMES.get(top_quantile, f"_top_{top_quantile}")
+            metrics["util_model_acc" + name] = kendall_tau(
+                posterior_util_mean[top_indices], test_util_vals[top_indices],
+                chunk_size=chunk_size)
+
+        # adjacent pairs, as in check_util_model_fit(kendalltau=False)
+        n_pairs = n_test // 2
+        pred_diff = (posterior_util_mean[: 2 * n_pairs].view(n_pairs, 2)).diff(dim=-1)
+        true_diff = (test_util_vals[: 2 * n_pairs].view(n_pairs, 2)).diff(dim=-1)
+        # a pair is predicted correctly if the predicted utility is strictly
+        # larger for the preferred item (ties go to the second item)
+        metrics["util_model_pair_acc"] = torch.where(
+            true_diff < 0, pred_diff < 0, pred_diff > 0
+        ).double().mean().item()
+
+        if outcome_model is not None:
+            overall_util_mean = evaluate_in_chunks(
+                util_posterior_mean, posterior_Y_mean, chunk_size)
+            metrics["overall_model_acc"] = kendall_tau(
+                overall_util_mean, test_util_vals, chunk_size=chunk_size)
+
+    return metrics
+
+
 ################################################################################
 # General diagnostic for understanding the landscape of a function / GP posterior
 
+def _chebyshev_center(A: Tensor, b: Tensor, bounds: Tensor) -> Tensor:
+    r"""Center of the largest ball inside {x in bounds: A x >= b}, by linear
+    programming; raises a ValueError if the region is empty."""
+    from scipy.optimize import linprog
+
+    # maximize r s.t. a_i x - r ||a_i|| >= b_i
+    A_np, b_np = A.detach().cpu().numpy(), b.detach().cpu().numpy()
+    row_norms = np.linalg.norm(A_np, axis=-1, keepdims=True)
+    result = linprog(
+        c=np.concatenate([np.zeros(A_np.shape[-1]), [-1.0]]),
+        A_ub=np.concatenate([-A_np, row_norms], axis=-1),
+        b_ub=-b_np,
+        bounds=[tuple(bound) for bound in bounds.t().tolist()] + [(0, None)],
+    )
+    if not result.success:
+        raise ValueError(
+            f"Could not find a point satisfying the inequality constraints: {result.message}"
+        )
+    return torch.as_tensor(result.x[:-1]).to(A)
+
+
+def _hit_and_run(
+    A: Tensor,
+    b: Tensor,
+    bounds: Tensor,
+    start_points: Tensor,
+    n_samples: int,
+    n_burnin: int = 200,
+    thinning: int = 10,
+    generator: Optional[torch.Generator] = None,
+) -> Tensor:
+    r"""
+    Approximately uniform samples from the polytope {x in bounds: A x >= b}
+    by hit-and-run, running one chain per start point in parallel.
+
+    Args:
+        A, b: `m x d` and `m` tensors of constraints `A x >= b`
+        bounds: `2 x d` tensor of box bounds
+        start_points: `n_chains x d` tensor of feasible starting points
+        n_samples: number of samples to return
+        n_burnin: number of steps discarded at the start of each chain
+        thinning: number of steps between two samples kept from a chain
+        generator: optional random number generator
+    Returns:
+        `n_samples x d` tensor of feasible samples
+    """
+    # box bounds as constraints: x >= lb, -x >= -ub
+    eye = torch.eye(A.shape[-1]).to(A)
+    A = torch.cat((A, eye, -eye))
+    b = torch.cat((b, bounds[0], -bounds[1]))
+
+    X = start_points.clone()
+    n_chains = X.shape[0]
+    n_steps = n_burnin + thinning * int(np.ceil(n_samples / n_chains))
+    samples = []
+    for step in range(1, n_steps + 1):
+        # random direction, and the feasible segment of the line through X
+        direction = torch.randn(X.shape, generator=generator).to(X)
+        direction = direction / direction.norm(dim=-1, keepdim=True)
+        slack = (X @ A.t() - b).clamp_min(0)
+        rate = direction @ A.t()
+        step_to_boundary = -slack / rate
+        t_min = torch.where(rate > 0, step_to_boundary, -np.inf).max(dim=-1).values
+        t_max = torch.where(rate < 0, step_to_boundary, np.inf).min(dim=-1).values
+        t = t_min + (t_max - t_min) * torch.rand(n_chains, generator=generator).to(X)
+        X = X + t.unsqueeze(-1) * direction
+        if step > n_burnin and (step - n_burnin) % thinning == 0:
+            samples.append(X)
+
+    return torch.cat(samples)[:n_samples]
+
+
+def sample_feasible_points(
+    bounds: Tensor,
+    n_samples: int,
+    inequality_constraints=None,
+    block_size: int = 4096,
+    max_rejection_draws: int = 2 ** 18,
+    n_chains: int = 64,
+    seed: Optional[int] = None,
+) -> Tensor:
+    r"""
+    Draw quasi-random samples from the box `bounds` subject to linear
+    inequality constraints `A x >= b`.
+
+    Sobol points are drawn in blocks of `block_size`, all constraints are checked
+    at once with one matrix product, and the feasible rows are kept until there
+    are `n_samples` of them. If fewer are found within `max_rejection_draws`
+    draws (the feasible region is a tiny fraction of the box), the rest are
+    drawn by hit-and-run, started from the feasible points found so far or
+    from the Chebyshev center of the region.
+
+    Args:
+        bounds: `2 x d` tensor of bounds
+        n_samples: number of samples
+        inequality_constraints: None, a list of tuples (indices, coefficients, rhs)
+            as passed into optimize_acqf(), or a tuple of tensors `(A, b)` as
+            returned by get_latent_ineq_constraint_matrix()
+        block_size: number of Sobol points drawn at once
+        max_rejection_draws: maximum number of Sobol points drawn before
+            switching to hit-and-run
+        n_chains: maximum number of hit-and-run chains run in parallel
+        seed: optional seed for the Sobol engine and hit-and-run
+    Returns:
+        `n_samples x d` tensor of feasible samples
+    """
+    bounds = bounds.to(torch.double)
+    if inequality_constraints is None:
+        return draw_sobol_samples(bounds=bounds, n=n_samples, q=1, seed=seed).squeeze(1).to(torch.double)
+
+    if isinstance(inequality_constraints, tuple):
+        A, b = inequality_constraints
+        A, b = A.to(bounds), b.to(bounds)
+    else:
+        A, b = inequality_constraints_to_matrix(
+            inequality_constraints, dim=bounds.shape[-1], dtype=bounds.dtype)
+
+    sobol_engine = SobolEngine(bounds.shape[-1], scramble=True, seed=seed)
+    feasible_samples = [bounds.new_zeros(0, bounds.shape[-1])]
+    n_feasible, n_drawn = 0, 0
+    while n_feasible < n_samples and n_drawn < max_rejection_draws:
+        block = sobol_engine.draw(block_size, dtype=torch.double).to(bounds)
+        block = bounds[0] + (bounds[1] - bounds[0]) * block
+        block = block[(block @ A.t() >= b).all(dim=-1)]
+        feasible_samples.append(block)
+        n_feasible += block.shape[0]
+        n_drawn += block_size
+    samples = torch.cat(feasible_samples)[:n_samples]
+
+    if samples.shape[0] < n_samples:
+        generator = None if seed is None else torch.Generator().manual_seed(seed)
+        if samples.shape[0] > 0:
+            start_points = samples[:n_chains]
+        else:
+            start_points = _chebyshev_center(A, b, bounds).unsqueeze(0)
+        # chains from the same start point separate during burn-in
+        start_points = start_points.repeat(
+            int(np.ceil(n_chains / start_points.shape[0])), 1)[:n_chains]
+        samples = torch.cat((
+            samples,
+            _hit_and_run(
+                A, b, bounds, start_points,
+                n_samples=n_samples - samples.shape[0], generator=generator,
+            ),
+        ))
+
+    return samples
+
+
 def get_function_statistics(
     function: torch.nn.Module or Model, 
     bounds: Tensor, 
@@ -553,42 +1100,18 @@ def get_function_statistics(
                 A list of tuples (indices, coefficients, rhs),
                 with each tuple encoding an inequality constraint of the form
                 `\sum_i (latent_var[indices[i]] * coefficients[i]) >= rhs`
+            or the same constraints as one system `(A, b)`, see sample_feasible_points()
         n_samples: number of samples to take
         interpolation: interpolation method in torch.quantile()
     Returns:
         A few statistics of the function output values
     """
 
-    # TODO: think: would rejection sampling be inefficient if 
-    # the feasible region is small relative to the bounds? (not urgent)
-
-    if inequality_constraints is None:
-        samples = draw_sobol_samples(bounds=bounds, n=n_samples, q=1).squeeze(1).to(torch.double)
-    else:
-        samples = []
-        for _ in range(n_samples):
-            valid = False
-            while not valid:
-                # take sample
-                sample = draw_sobol_samples(bounds=bounds, n=1, q=1).squeeze(0).to(torch.double)
-                # check that it complies with inequality constraints
-                ineq_cons_met = True
-                for indices, coefficients, rhs in inequality_constraints:
-                    if torch.matmul(
-                        sample[:,indices], 
-                        torch.tensor(coefficients, dtype=torch.double)
-                    ) >= rhs:
-                        # keep going if the current constraint is met
-                        continue
-                    else:
-                        # break if one constraint is violated
-                        ineq_cons_met = False
-                        break 
-                if ineq_cons_met == True: # if all constraints are met
-                    valid = True
-            samples.append(sample)
-        
-        samples = torch.stack(samples).squeeze(1)
+    samples = sample_feasible_points(
+        bounds=bounds,
+        n_samples=n_samples,
+        inequality_constraints=inequality_constraints,
+    )
     # NOTE: samples shape is `n_samples x bounds.shape[-1]`
 
     if inner_function is not None:
@@ -1,13 +1,25 @@
-from typing import Optional
+import copy
+from contextlib import ExitStack
+from typing import List, Optional, Union
 
 import gpytorch
 import torch
-from botorch.fit import fit_gpytorch_mll, fit_gpytorch_model
+from botorch.acquisition.objective import PosteriorTransform
+from botorch.exceptions.errors import ModelFittingError, UnsupportedError
+from botorch.fit import (FitGPyTorchMLL, _fit_fallback, fit_gpytorch_mll,
+                         fit_gpytorch_model)
 from botorch.models.gpytorch import GPyTorchModel
 from botorch.models.model import Model
+from botorch.models.multitask import KroneckerMultiTaskGP
+from botorch.models.pairwise_gp import PairwiseGP
 from botorch.models.transforms.input import InputTransform
 from botorch.models.transforms.outcome import OutcomeTransform
+from botorch.posteriors.gpytorch import GPyTorchPosterior
+from botorch.posteriors.multitask import MultitaskGPPosterior
+from botorch.posteriors.transformed import TransformedPosterior
 from gpytorch import ExactMarginalLogLikelihood
+from gpytorch.distributions import (MultitaskMultivariateNormal,
+                                    MultivariateNormal)
 from gpytorch.constraints import GreaterThan, Interval
 from gpytorch.kernels import (Kernel, LCMKernel, MaternKernel, RBFKernel,
                               ScaleKernel)
@@ -16,6 +28,16 @@ from gpytorch.models import ExactGP
 from gpytorch.priors import SmoothedBoxPrior
 from gpytorch.priors.lkj_prior import LKJCovariancePrior
 from gpytorch.priors.torch_priors import GammaPrior, Prior
+from gpytorch.utils.memoize import cached
+from linear_operator import to_linear_operator
+from linear_operator.operators import (AddedDiagLinearOperator,
+                                       ConstantDiagLinearOperator,
+                                       DiagLinearOperator,
+                                       KroneckerProductDiagLinearOperator,
+                                       KroneckerProductLinearOperator,
+                                       RootLinearOperator)
+from linear_operator.utils.cholesky import psd_safe_cholesky
+from linear_operator.utils.errors import NotPSDError
 from torch import Tensor
 
 
@@ -154,6 +176,440 @@ def fit_LCM_model(
     return lcm_model
 
 
+class FastPairwiseGP(Model):
+    r"""
+    Posterior predictions of a fitted PairwiseGP from cached Laplace solves.
+
+    PairwiseGP solves two `n x n` systems against the training datapoints in
+    every posterior call. With the hyperparameters and the MAP utility f fixed
+    (e.g., while optimizing an acquisition function over the utility), these are
+    computed once here: the predictive weights alpha = K^-1 (f - m) and a root
+    R R^T = (K + H^-1)^-1 of the Laplace correction, where H is the Hessian of the
+    negative log likelihood at f. Then for new points
+        mean = k(x, X) alpha + m(x),
+        covar = k(x, x) - (k(x, X) R) (k(x, X) R)^T,
+    i.e. one kernel evaluation against X and two matmuls. With
+    `truncation_rank`, R only keeps the leading `truncation_rank` eigenvectors
+    of (K + H^-1)^-1. This is a crude eigen-truncation, not LOVE (which builds
+    its cache with Lanczos and is accurate near the data): the dropped
+    eigenvalues are not small in general, so the variance can be overestimated
+    by more than an order of magnitude at small ranks.
+
+    The cache is computed at construction and is not updated if the wrapped
+    model is refitted, so a new FastPairwiseGP should be created after fitting.
+    """
+
+    def __init__(self, model: PairwiseGP, truncation_rank: Optional[int] = None):
+        r"""
+        Args:
+            model: fitted (non-batched) PairwiseGP
+            truncation_rank: optional rank to truncate the variance cache to;
+                if None, exact
+        """
+        super().__init__()
+        if len(model.batch_shape) > 0:
+            raise UnsupportedError("FastPairwiseGP does not support batched models.")
+        self.model = model
+        self.truncation_rank = truncation_rank
+
+        model.eval()
+        with torch.no_grad():
+            train_X = model.transform_inputs(model.datapoints)
+            if model.utility is None:
+                model._update(train_X)
+            if model.pred_cov_fac_need_update:
+                model._update_utility_derived_values()
+
+            alpha = torch.cholesky_solve(
+                (model.utility - model._prior_mean(train_X)).unsqueeze(-1),
+                model.covar_chol,
+            ).squeeze(-1)
+            # (K + H^-1)^-1 = (H K + I)^-1 H, symmetric PSD up to round-off
+            pred_cov_fac_inv = torch.linalg.solve(model.hlcov_eye, model.likelihood_hess)
+            evals, evecs = torch.linalg.eigh(
+                (pred_cov_fac_inv + pred_cov_fac_inv.transpose(-2, -1)) / 2
+            )
+            if truncation_rank is not None:
+                evals, evecs = evals[..., -truncation_rank:], evecs[..., -truncation_rank:]
+            pred_cov_root = evecs * evals.clamp_min(0).sqrt().unsqueeze(-2)
+
+        self.train_X = train_X
+        self.alpha = alpha
+        self.pred_cov_root = pred_cov_root
+
+    @property
+    def num_outputs(self) -> int:
+        return 1
+
+    @property
+    def batch_shape(self) -> torch.Size:
+        return torch.Size()
+
+    def posterior(
+        self,
+        X: Tensor,
+        output_indices: Optional[List[int]] = None,
+        observation_noise: bool = False,
+        posterior_transform: Optional[PosteriorTransform] = None,
+        **kwargs,
+    ) -> GPyTorchPosterior:
+        r"""
+        Args:
+            X: `batch_shape x q x d` tensor of (untransformed) outcomes
+            output_indices, observation_noise: not used, as in PairwiseGP
+            posterior_transform: an optional PosteriorTransform
+        Returns:
+            posterior on the utility of the `q` points, same as the
+            PairwiseGP posterior up to numerical error
+        """
+        model = self.model
+        X = model.transform_inputs(X)
+        covar_x_train = model._calc_covar(X, self.train_X.to(X))
+        mean = covar_x_train @ self.alpha.to(X) + model._prior_mean(X)
+        root = covar_x_train @ self.pred_cov_root.to(X)
+        covar = model._calc_covar(X, X) - root @ root.transpose(-2, -1)
+
+        scale = model.covar_module.outputscale.unsqueeze(-1).unsqueeze(-1).detach()
+        # as in PairwiseGP, factorize the covariance scaled by 1 / outputscale
+        covar_root = psd_safe_cholesky(covar / scale, jitter=model._jitter) * scale.sqrt()
+        posterior = GPyTorchPosterior(
+            MultivariateNormal(
+                mean=mean, covariance_matrix=RootLinearOperator(covar_root)
+            )
+        )
+        if posterior_transform is not None:
+            return posterior_transform(posterior)
+        return posterior
+
+
+def _kronecker_solves() -> ExitStack:
+    r"""
+    Context in which solves and log determinants with a Kronecker-structured
+    train covariance use its structure. With botorch's default settings (no
+    fast log_prob, max_cholesky_size = 4096), they are computed from a dense
+    Cholesky factor of the `n m x n m` matrix instead.
+    """
+    stack = ExitStack()
+    stack.enter_context(gpytorch.settings.fast_computations(log_prob=True, solves=True))
+    stack.enter_context(gpytorch.settings.max_cholesky_size(0))
+    return stack
+
+
+class _KroneckerMultitaskGPPosterior(MultitaskGPPosterior):
+    r"""MultitaskGPPosterior whose Matheron samples use the Kronecker solve."""
+
+    def rsample_from_base_samples(
+        self,
+        sample_shape: torch.Size,
+        base_samples: Optional[Tensor],
+        train_diff: Optional[Tensor] = None,
+    ) -> Tensor:
+        with _kronecker_solves():
+            return super().rsample_from_base_samples(
+                sample_shape=sample_shape, base_samples=base_samples, train_diff=train_diff
+            )
+
+
+class LowRankKroneckerGP(KroneckerMultiTaskGP):
+    r"""
+    Multi-output GP with a shared input kernel and a rank-`latent_dim` task
+    covariance, cov(y_i(x), y_j(x')) = k(x, x') B_ij with B = W W^T + diag(v),
+    W of shape `outcome_dim x latent_dim`.
+
+    This is the model fitted by MultitaskGPModel (the LCM kernel there repeats
+    the same base kernel `latent_dim` times, so that sum_q k B_q = k sum_q B_q),
+    but in Kronecker form: on the shared training inputs, the train covariance
+    is K_X \kron B + I \kron D, with D the diagonal task noise. The model must
+    be fitted with LowRankKroneckerMarginalLogLikelihood (fit_gpytorch_mll
+    then retries failed fits as in _fit_low_rank_kronecker_gp()), which uses one of
+        - inference="kronecker": exact solves and log determinant through the
+          eigendecompositions of K_X and D^-1/2 B D^-1/2, in O(n^3 + m^3) time
+          instead of O((n m)^3) (Rakitsch et al., 2013);
+        - inference="cg": preconditioned (pivoted Cholesky) CG solves and a
+          stochastic Lanczos quadrature estimate of the log determinant, which
+          only use Kronecker MVMs, O(n m (n + m)) each; for large `n`.
+    Predictions use the exact Kronecker solve in both cases. Posterior samples
+    are drawn with Matheron's rule (see MultitaskGPPosterior): a joint prior
+    sample at the train and test points is updated with one solve against the
+    train covariance, instead of factorizing the `q m x q m` posterior
+    covariance.
+    """
+
+    def __init__(
+        self,
+        train_X: Tensor,
+        train_Y: Tensor,
+        latent_dim: int,
+        inference: str = "kronecker",
+        cg_tolerance: float = 0.01,
+        max_preconditioner_size: int = 20,
+        num_trace_samples: int = 16,
+        task_covar_prior: Optional[Prior] = None,
+        likelihood: Optional[MultitaskGaussianLikelihood] = None,
+        outcome_transform: Optional[OutcomeTransform] = None,
+        input_transform: Optional[InputTransform] = None,
+    ):
+        r"""
+        Args:
+            train_X: `num_samples x input_dim` tensor
+            train_Y: `num_samples x outcome_dim` tensor
+            latent_dim: rank of the low-rank part of the task covariance
+            inference: "kronecker" or "cg", see class docstring
+            cg_tolerance: CG residual tolerance, for inference="cg"
+            max_preconditioner_size: rank of the pivoted Cholesky preconditioner,
+                for inference="cg"
+            num_trace_samples: number of probe vectors in the stochastic log
+                determinant estimate, for inference="cg"
+            task_covar_prior: prior on B, defaults to KroneckerMultiTaskGP's
+            likelihood: MultitaskGaussianLikelihood
+            outcome_transform: OutcomeTransform
+            input_transform: InputTransform
+        """
+        if inference not in ("kronecker", "cg"):
+            raise ValueError(f"Unknown inference {inference}, must be 'kronecker' or 'cg'.")
+        super().__init__(
+            train_X=train_X,
+            train_Y=train_Y,
+            likelihood=likelihood,
+            data_covar_module=MaternKernel(
+                nu=2.5,
+                ard_num_dims=train_X.shape[-1],
+                lengthscale_prior=GammaPrior(3.0, 6.0),
+            ),
+            task_covar_prior=task_covar_prior,
+            rank=latent_dim,
+            input_transform=input_transform,
+            outcome_transform=outcome_transform,
+        )
+        self.inference = inference
+        self.cg_tolerance = cg_tolerance
+        self.max_preconditioner_size = max_preconditioner_size
+        self.num_trace_samples = num_trace_samples
+
+    def inference_settings(self) -> ExitStack:
+        r"""Context for computing the marginal likelihood with `self.inference`."""
+        stack = _kronecker_solves()
+        if self.inference == "cg":
+            stack.enter_context(gpytorch.settings.cg_tolerance(self.cg_tolerance))
+            stack.enter_context(
+                gpytorch.settings.max_preconditioner_size(self.max_preconditioner_size))
+            stack.enter_context(gpytorch.settings.num_trace_samples(self.num_trace_samples))
+        return stack
+
+    @property
+    @cached(name="predictive_mean_cache")
+    def predictive_mean_cache(self) -> Tensor:
+        with _kronecker_solves():
+            return super().predictive_mean_cache
+
+    def posterior(
+        self,
+        X: Tensor,
+        output_indices: Optional[List[int]] = None,
+        observation_noise: bool = False,
+        posterior_transform: Optional[PosteriorTransform] = None,
+        **kwargs,
+    ) -> Union[MultitaskGPPosterior, TransformedPosterior]:
+        r"""
+        Posterior at `X`, as in KroneckerMultiTaskGP, but computed from dense
+        `n x n`, `q x n` and `m x m` factors. With B the task covariance, D the
+        diagonal task noise and the eigendecompositions K_X = U diag(l) U^T and
+        D^-1/2 B D^-1/2 = V diag(s) V^T, the train covariance is inverted as
+            (K_X \kron B + I \kron D)^-1 = (U \kron D^-1/2 V)
+                diag(l \kron s + 1)^-1 (U \kron D^-1/2 V)^T.
+        (KroneckerMultiTaskGP's lazy Kronecker matmuls also fail in the backward
+        pass for a batched X.) Samples are drawn with Matheron's rule, from a
+        jittered root of the joint covariance, see _joint_data_root().
+        Args:
+            X: `batch_shape x q x input_dim` tensor
+            output_indices: not supported, as in KroneckerMultiTaskGP
+            observation_noise: if True, add the task noise to the posterior
+            posterior_transform: not supported, as in KroneckerMultiTaskGP
+        Returns:
+            posterior over the `batch_shape x q x outcome_dim` outcomes
+        """
+        self.eval()
+        if posterior_transform is not None:
+            raise NotImplementedError(
+                f"Posterior transforms are not supported for {self.__class__.__name__}"
+            )
+
+        X = self.transform_inputs(X)
+        train_x = self.transform_inputs(self.train_inputs[0])
+        batch_shape, q, n = X.shape[:-2], X.shape[-2], train_x.shape[-2]
+        data_covar_module = self.covar_module.data_covar_module
+
+        task_covar = self._task_covar_matrix.to_dense()
+        num_tasks = task_covar.shape[-1]
+        task_noise = torch.zeros(num_tasks).to(task_covar)
+        if self.likelihood.has_task_noise:
+            task_noise = task_noise + self.likelihood.task_noises.reshape(num_tasks)
+        if self.likelihood.has_global_noise:
+            task_noise = task_noise + self.likelihood.noise
+        task_noise_inv_root = task_noise.rsqrt()
+
+        test_data_covar = data_covar_module(X, train_x).to_dense()
+        test_mean = self.mean_module(X)
+        mean_cache = self.predictive_mean_cache.reshape(n, num_tasks)
+        mean = test_mean + test_data_covar @ mean_cache @ task_covar
+
+        data_evals, data_evecs = torch.linalg.eigh(data_covar_module(train_x).to_dense())
+        task_evals, task_evecs = torch.linalg.eigh(
+            task_noise_inv_root.unsqueeze(-1) * task_covar * task_noise_inv_root)
+        test_factor = (test_data_covar @ data_evecs) ** 2
+        task_factor = ((task_covar * task_noise_inv_root) @ task_evecs) ** 2
+        inv_evals = 1 / (data_evals.unsqueeze(-1) * task_evals + 1)
+        variance = (
+            data_covar_module(X, diag=True).unsqueeze(-1) * task_covar.diagonal()
+            - test_factor @ inv_evals @ task_factor.transpose(-2, -1)
+        ).clamp_min(0)
+
+        test_noise = None
+        if observation_noise:
+            variance = variance + task_noise
+            test_noise = KroneckerProductDiagLinearOperator(
+                ConstantDiagLinearOperator(torch.ones(*batch_shape, 1).to(X), diag_shape=q),
+                DiagLinearOperator(task_noise.expand(*batch_shape, num_tasks)),
+            )
+        distribution = MultitaskMultivariateNormal(
+            mean, DiagLinearOperator(variance.reshape(*batch_shape, q * num_tasks))
+        )
+
+        task_root = self._task_covar_matrix.root_decomposition(
+            method="diagonalization").root.to_dense()
+        task_root = task_root.expand(*batch_shape, *task_root.shape[-2:])
+        posterior = _KroneckerMultitaskGPPosterior(
+            distribution=distribution,
+            joint_covariance_matrix=RootLinearOperator(
+                KroneckerProductLinearOperator(self._joint_data_root(X), task_root)),
+            test_train_covar=KroneckerProductLinearOperator(
+                to_linear_operator(test_data_covar),
+                to_linear_operator(task_covar.expand(*batch_shape, num_tasks, num_tasks)),
+            ),
+            train_diff=self.train_targets - self.mean_module(train_x),
+            test_mean=test_mean,
+            train_train_covar=self.train_full_covar,
+            train_noise=KroneckerProductDiagLinearOperator(
+                ConstantDiagLinearOperator(torch.ones(1).to(X), diag_shape=n),
+                DiagLinearOperator(task_noise),
+            ),
+            test_noise=test_noise,
+        )
+        if hasattr(self, "outcome_transform"):
+            posterior = self.outcome_transform.untransform_posterior(posterior)
+        return posterior
+
+    def _joint_data_root(self, X: Tensor) -> Tensor:
+        r"""
+        Root of the input covariance of the training points and the (transformed)
+        inputs `X`, extending the root of the training covariance with a Cholesky
+        factor of the Schur complement of `X`. KroneckerMultiTaskGP takes an
+        unjittered root of the Schur complement, which is NaN when it is
+        numerically zero, e.g., for a test point at a training point.
+        """
+        train_x = self.transform_inputs(self.train_inputs[0])
+        data_data_covar = self.train_full_covar.linear_ops[0]
+        train_root = data_data_covar.root_decomposition(method="diagonalization").root.to_dense()
+        train_inv_root = data_data_covar.root_inv_decomposition().root.to_dense()
+
+        cross = self.covar_module.data_covar_module(X, train_x).to_dense() @ train_inv_root
+        schur = self.covar_module.data_covar_module(X).to_dense() - cross @ cross.transpose(-2, -1)
+        schur_root = psd_safe_cholesky(schur)
+
+        batch_shape = cross.shape[:-2]
+        upper = torch.cat((
+            train_root.expand(*batch_shape, *train_root.shape[-2:]),
+            torch.zeros(*batch_shape, train_root.shape[-2], X.shape[-2]).to(cross),
+        ), dim=-1)
+        lower = torch.cat((cross, schur_root), dim=-1)
+        return torch.cat((upper, lower), dim=-2)
+
+
+class LowRankKroneckerMarginalLogLikelihood(ExactMarginalLogLikelihood):
+    r"""
+    Exact marginal log likelihood of a LowRankKroneckerGP, computed with the
+    model's Kronecker or CG inference. With inference="cg", the probe vectors
+    of the log determinant estimate are drawn with a fixed seed, so that the
+    objective is deterministic across the optimizer's iterations.
+    """
+
+    def __init__(
+        self, likelihood: MultitaskGaussianLikelihood, model: LowRankKroneckerGP, seed: int = 0
+    ):
+        super().__init__(likelihood, model)
+        self.seed = seed
+
+    def forward(self, function_dist, target, *params):
+        output = self.likelihood(function_dist, *params)
+        with self.model.inference_settings(), torch.random.fork_rng(devices=[]):
+            if self.model.inference == "cg":
+                # drop the Kronecker structure of the noise, so that the solves
+                # use (preconditioned) CG rather than the eigendecompositions
+                covar = output.lazy_covariance_matrix
+                output = output.__class__(
+                    output.mean,
+                    AddedDiagLinearOperator(
+                        covar.linear_op, DiagLinearOperator(covar.diag_tensor.diagonal())
+                    ),
+                    interleaved=output._interleaved,
+                )
+                torch.manual_seed(self.seed)
+            try:
+                res = output.log_prob(target)
+            except torch.linalg.LinAlgError as e:
+                # an eigendecomposition failed to converge, e.g., at a point far
+                # out in the line search; fail like a non-PD train covariance, so
+                # that fit_gpytorch_mll retries the fit
+                raise NotPSDError(str(e)) from e
+        res = self._add_other_terms(res, params)
+
+        num_data = function_dist.event_shape.numel()
+        return res.div_(num_data)
+
+
+@FitGPyTorchMLL.register(LowRankKroneckerMarginalLogLikelihood, object, LowRankKroneckerGP)
+def _fit_low_rank_kronecker_gp(
+    mll: LowRankKroneckerMarginalLogLikelihood,
+    _: type,
+    __: type,
+    *,
+    max_attempts: int = 5,
+    **kwargs,
+) -> LowRankKroneckerMarginalLogLikelihood:
+    r"""
+    fit_gpytorch_mll for a LowRankKroneckerGP. After a failed attempt,
+    fit_gpytorch_mll retries from hyperparameters sampled from all their
+    priors, which raises for KroneckerMultiTaskGP: its LKJ prior on the task
+    covariance and the task noise priors cannot be sampled into the model.
+    Here, a failed attempt is retried from the initial hyperparameters instead,
+    with new lengthscales sampled from their prior and a new random factor W
+    of the task covariance.
+    Args:
+        mll: LowRankKroneckerMarginalLogLikelihood
+        max_attempts: maximum number of attempts
+        kwargs: passed to fit_gpytorch_mll, e.g., optimizer_kwargs
+    Returns:
+        the fitted `mll`, in eval mode
+    """
+    model = mll.model
+    init_state = copy.deepcopy(model.state_dict())
+    for attempt in range(max_attempts):
+        if attempt > 0:
+            model.load_state_dict(init_state)
+            with torch.no_grad():
+                for _, module, prior, closure, setting_closure in model.named_priors():
+                    if setting_closure is not None:
+                        setting_closure(module, prior.sample(closure(module).shape))
+                covar_factor = model.covar_module.task_covar_module.covar_factor
+                covar_factor.copy_(torch.randn_like(covar_factor))
+        try:
+            return _fit_fallback(mll, _, __, max_attempts=1, **kwargs)
+        except ModelFittingError:
+            continue
+    raise ModelFittingError(
+        f"All {max_attempts} attempts to fit the {model.__class__.__name__} have failed.")
+
+
 # modified kernel with change in hyperpriors
 def make_modified_kernel(ard_num_dims, a=0.01, b=100):
     # ls_prior = GammaPrior(1.2, 0.5)
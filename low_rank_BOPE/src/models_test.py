@@ -0,0 +1,201 @@
+import sys
+
+sys.path.append('../..')
+
+import pytest
+import torch
+from botorch.fit import fit_gpytorch_mll
+from botorch.models.pairwise_gp import (PairwiseGP,
+                                        PairwiseLaplaceMarginalLogLikelihood)
+from botorch.models.transforms.input import Normalize
+from botorch.models.transforms.outcome import Standardize
+from botorch.sampling.normal import SobolQMCNormalSampler
+from gpytorch.distributions import MultivariateNormal
+from linear_operator.utils.errors import NotPSDError
+from low_rank_BOPE.src.models import (FastPairwiseGP, LowRankKroneckerGP,
+                                      LowRankKroneckerMarginalLogLikelihood)
+
+
+def make_pairwise_gp(num_datapoints=30, outcome_dim=4, num_comps=40, seed=0):
+    r"""PairwiseGP fitted on noiseless comparisons of a linear utility."""
+    torch.manual_seed(seed)
+    Y = torch.rand(num_datapoints, outcome_dim, dtype=torch.double)
+    util_vals = Y.sum(-1)
+    comps = torch.randint(num_datapoints, (num_comps, 2))
+    comps = comps[comps[:, 0] != comps[:, 1]]
+    comps = torch.where(
+        (util_vals[comps[:, 0]] > util_vals[comps[:, 1]]).unsqueeze(-1),
+        comps, comps.flip(-1))
+    model = PairwiseGP(Y, comps, input_transform=Normalize(outcome_dim))
+    fit_gpytorch_mll(PairwiseLaplaceMarginalLogLikelihood(model.likelihood, model))
+    return model
+
+
+def test_fast_pairwise_gp_posterior():
+    r"""FastPairwiseGP's posterior matches PairwiseGP.posterior, and a
+    truncated cache only inflates the variance."""
+    model = make_pairwise_gp()
+    fast_model = FastPairwiseGP(model)
+    X = torch.rand(5, 3, 4, dtype=torch.double)
+
+    with torch.no_grad():
+        posterior = model.posterior(X)
+        fast_posterior = fast_model.posterior(X)
+        truncated_posterior = FastPairwiseGP(model, truncation_rank=5).posterior(X)
+    assert fast_posterior.mean.shape == posterior.mean.shape
+    assert torch.allclose(fast_posterior.mean, posterior.mean, rtol=0, atol=1e-12)
+    assert torch.allclose(
+        fast_posterior.mvn.covariance_matrix, posterior.mvn.covariance_matrix,
+        rtol=0, atol=1e-10)
+    assert torch.allclose(truncated_posterior.mean, posterior.mean, rtol=0, atol=1e-12)
+    assert (truncated_posterior.variance >= posterior.variance - 1e-10).all()
+
+
+
+def make_kronecker_data(num_samples=12, input_dim=3, outcome_dim=5, seed=0):
+    r"""Outcomes that are noisy linear combinations of a few smooth functions."""
+    torch.manual_seed(seed)
+    X = torch.rand(num_samples, input_dim, dtype=torch.double)
+    latent = torch.stack((X.sum(-1), torch.sin(3 * X[:, 0]), X[:, 1] * X[:, 2]), -1)
+    Y = latent @ torch.randn(3, outcome_dim, dtype=torch.double)
+    Y = Y + 0.05 * torch.randn(num_samples, outcome_dim, dtype=torch.double)
+    return X, Y
+
+
+def dense_train_covar(model, X):
+    r"""The train covariance K_X \kron B + I \kron D as a dense matrix."""
+    data_covar = model.covar_module.data_covar_module(X).to_dense()
+    task_covar = model.covar_module.task_covar_module.covar_matrix.to_dense()
+    task_noise = model.likelihood.task_noises.reshape(-1) + model.likelihood.noise
+    return (
+        torch.kron(data_covar, task_covar)
+        + torch.kron(torch.eye(X.shape[-2]).to(X), torch.diag(task_noise))
+    )
+
+
+def test_low_rank_kronecker_posterior():
+    r"""The posterior of a LowRankKroneckerGP matches the dense computation."""
+    X, Y = make_kronecker_data()
+    model = LowRankKroneckerGP(X, Y, latent_dim=2)
+    with torch.no_grad():
+        model.covar_module.data_covar_module.lengthscale = 0.5
+        model.likelihood.task_noises = torch.linspace(0.01, 0.1, Y.shape[-1])
+    model.eval()
+    test_X = torch.cat((torch.rand(4, 2, 3, dtype=torch.double), X[:2].expand(4, 2, 3)), -2)
+
+    data_covar_module = model.covar_module.data_covar_module
+    task_covar = model.covar_module.task_covar_module.covar_matrix.to_dense()
+    task_noise = model.likelihood.task_noises.reshape(-1) + model.likelihood.noise
+    with torch.no_grad():
+        train_covar = dense_train_covar(model, X)
+        train_diff = (Y - model.mean_module(X)).reshape(-1)
+        for observation_noise in [False, True]:
+            posterior = model.posterior(test_X, observation_noise=observation_noise)
+            for b in range(test_X.shape[0]):
+                test_train_covar = torch.kron(
+                    data_covar_module(test_X[b], X).to_dense(), task_covar)
+                mean = model.mean_module(test_X[b]).reshape(-1) + test_train_covar @ (
+                    torch.linalg.solve(train_covar, train_diff))
+                covar = torch.kron(data_covar_module(test_X[b]).to_dense(), task_covar) - (
+                    test_train_covar @ torch.linalg.solve(train_covar, test_train_covar.T))
+                variance = covar.diagonal()
+                if observation_noise:
+                    variance = variance + task_noise.repeat(test_X.shape[-2])
+                assert torch.allclose(
+                    posterior.mean[b].reshape(-1), mean, rtol=0, atol=1e-10)
+                assert torch.allclose(
+                    posterior.variance[b].reshape(-1), variance, rtol=0, atol=1e-10)
+
+
+def test_low_rank_kronecker_posterior_samples():
+    r"""Matheron's rule samples have the posterior's shape and moments."""
+    X, Y = make_kronecker_data()
+    model = LowRankKroneckerGP(X, Y, latent_dim=2, outcome_transform=Standardize(Y.shape[-1]))
+    model.eval()
+    test_X = torch.rand(4, 3, 3, dtype=torch.double)
+    posterior = model.posterior(test_X)
+
+    sampler = SobolQMCNormalSampler(torch.Size([8]), seed=0)
+    assert sampler(posterior).shape == torch.Size([8, 4, 3, Y.shape[-1]])
+    torch.manual_seed(0)
+    samples = posterior.rsample(torch.Size([4096]))
+    assert samples.shape == torch.Size([4096, 4, 3, Y.shape[-1]])
+    assert torch.allclose(samples.mean(0), posterior.mean, rtol=0, atol=0.1)
+    assert torch.allclose(samples.var(0), posterior.variance, rtol=0.15, atol=1e-3)
+
+
+@pytest.mark.parametrize("inference", ["kronecker", "cg"])
+def test_low_rank_kronecker_mll(inference):
+    r"""The marginal log likelihood and its gradient match the dense
+    computation, exactly with Kronecker inference and approximately with CG."""
+    X, Y = make_kronecker_data()
+    torch.manual_seed(1)
+    model = LowRankKroneckerGP(X, Y, latent_dim=2, inference=inference)
+    mll = LowRankKroneckerMarginalLogLikelihood(model.likelihood, model)
+    mll.train()
+    loss = mll(model(X), model.train_targets)
+    loss.backward()
+    grads = {name: param.grad.clone() for name, param in model.named_parameters()}
+    model.zero_grad()
+
+    # the same objective from a dense `n m x n m` covariance
+    mean = model.mean_module(X).reshape(-1)
+    dense_loss = MultivariateNormal(mean, dense_train_covar(model, X)).log_prob(
+        model.train_targets.reshape(-1))
+    # the log priors, as in ExactMarginalLogLikelihood
+    for _, module, prior, closure, _ in mll.named_priors():
+        dense_loss = dense_loss + prior.log_prob(closure(module)).sum()
+    dense_loss = dense_loss / Y.numel()
+    dense_loss.backward()
+
+    tol = 1e-8 if inference == "kronecker" else 2e-2
+    assert loss.item() == pytest.approx(dense_loss.item(), abs=tol)
+    for name, param in model.named_parameters():
+        assert torch.allclose(grads[name], param.grad, rtol=tol, atol=tol), name
+    if inference == "cg":
+        # the log determinant estimate is deterministic across evaluations
+        assert mll(model(X), model.train_targets).item() == loss.item()
+
+
+def test_low_rank_kronecker_mll_fails_as_not_psd():
+    r"""A failed eigendecomposition is raised as a NotPSDError, on which
+    fit_gpytorch_mll retries from a new initialization."""
+    X, Y = make_kronecker_data()
+    torch.manual_seed(0)
+    model = LowRankKroneckerGP(X, Y, latent_dim=2)
+    with torch.no_grad():
+        # the kernel matrix is NaN at a vanishing lengthscale
+        model.covar_module.data_covar_module.raw_lengthscale.fill_(-700)
+    mll = LowRankKroneckerMarginalLogLikelihood(model.likelihood, model)
+    mll.train()
+    with pytest.raises(NotPSDError):
+        mll(model(X), model.train_targets)
+
+    fit_gpytorch_mll(mll)
+    assert not model.training
+    assert (model.covar_module.data_covar_module.raw_lengthscale > -700).all()
+
+
+@pytest.mark.parametrize("latent_dim", [1, 2])
+def test_fit_low_rank_kronecker_gp(latent_dim):
+    r"""The mtgp (latent_dim=1) and lmc outcome models of BopeExperiment can
+    be fitted from different initializations."""
+    X, Y = make_kronecker_data()
+    for seed in range(3):
+        torch.manual_seed(seed)
+        model = LowRankKroneckerGP(
+            X, Y, latent_dim=latent_dim, outcome_transform=Standardize(Y.shape[-1]))
+        fit_gpytorch_mll(LowRankKroneckerMarginalLogLikelihood(model.likelihood, model))
+        assert not model.training
+        assert torch.isfinite(model.posterior(X).variance).all()
+
+
+if __name__ == "__main__":
+    test_fast_pairwise_gp_posterior()
+    test_low_rank_kronecker_posterior()
+    test_low_rank_kronecker_posterior_samples()
+    for inference in ["kronecker", "cg"]:
+        test_low_rank_kronecker_mll(inference)
+    test_low_rank_kronecker_mll_fails_as_not_psd()
+    for latent_dim in [1, 2]:
+        test_fit_low_rank_kronecker_gp(latent_dim)
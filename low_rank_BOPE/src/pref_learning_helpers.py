@@ -4,11 +4,14 @@
 # Code is mostly inspired by Jerry Lin's implementation here:
 # https://github.com/facebookresearch/preference-exploration/blob/main/sim_helpers.py
 
+import copy
 import sys
+import warnings
 
 sys.path.append('/home/yz685/low_rank_BOPE')
 
-from typing import Dict, Optional, Tuple
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
 
 import numpy as np
 import scipy
@@ -20,35 +23,51 @@ from botorch.acquisition.monte_carlo import (qNoisyExpectedImprovement,
 from botorch.acquisition.objective import MCAcquisitionObjective
 from botorch.acquisition.preference import AnalyticExpectedUtilityOfBestOption
 from botorch.exceptions.errors import UnsupportedError
+from botorch.exceptions.warnings import OptimizationWarning
 from botorch.models import SingleTaskGP
 from botorch.models.deterministic import DeterministicModel
 from botorch.models.model import Model
 from botorch.models.pairwise_gp import (PairwiseGP,
                                         PairwiseLaplaceMarginalLogLikelihood)
 from botorch.models.transforms.input import (ChainedInputTransform,
-                                             InputTransform)
+                                             FilterFeatures, InputTransform)
+from botorch.models.transforms.outcome import (ChainedOutcomeTransform,
+                                               OutcomeTransform)
 from botorch.optim.optimize import optimize_acqf
 from botorch.sampling.normal import SobolQMCNormalSampler
 from botorch.utils.sampling import draw_sobol_samples
 from gpytorch.mlls import ExactMarginalLogLikelihood
 from torch import Tensor
 
-from low_rank_BOPE.src.models import make_modified_kernel
-from low_rank_BOPE.src.transforms import InputCenter, PCAInputTransform
+from low_rank_BOPE.src.caching import (compute_fingerprint, is_deterministic,
+                                       load_from_cache, save_to_cache)
+from low_rank_BOPE.src.models import FastPairwiseGP, make_modified_kernel
+from low_rank_BOPE.src.transforms import (InputCenter,
+                                          LatentAffineOutcomeTransform,
+                                          LinearProjectionInputTransform,
+                                          LinearProjectionOutcomeTransform,
+                                          PCAInputTransform,
+                                          PCAOutcomeTransform,
+                                          SubsetOutcomeTransform)
 
 # ======= Initial data generation =======
 
 
-def generate_random_inputs(problem: torch.nn.Module, n: int) -> Tensor:
+def generate_random_inputs(
+    problem: torch.nn.Module, n: int, seed: Optional[int] = None
+) -> Tensor:
     r"""Generate n quasi-random Sobol points in the design space.
     Args:
         problem: a TestProblem in Botorch
         n: number of random inputs to generate
+        seed: optional seed for the Sobol engine; if None, the seed is drawn
+            from the global torch random number generator
     Returns:
         `n x problem input dim` tensor of randomly generated points in problem's input domain
     """
     return (
-        draw_sobol_samples(bounds=problem.bounds, n=1, q=n).squeeze(0).to(torch.double)
+        draw_sobol_samples(bounds=problem.bounds, n=1, q=n, seed=seed)
+        .squeeze(0).to(torch.double)
     )
 
 
@@ -64,29 +83,28 @@ def gen_comps(
         comp_pairs: `(num_outcomes // 2) x 2` tensor showing the preference,
             with the more preferable outcome followed by the other one in each row
     """
-    cpu_util = util_vals.cpu()
-
-    comp_pairs = []
-    for i in range(cpu_util.shape[0] // 2):
-        i1 = i * 2
-        i2 = i * 2 + 1
-        if cpu_util[i1] > cpu_util[i2]:
-            new_comp = [i1, i2]
-            util_diff = cpu_util[i1] - cpu_util[i2]
-        else:
-            new_comp = [i2, i1]
-            util_diff = cpu_util[i2] - cpu_util[i1]
-
-        new_comp = torch.tensor(new_comp, device=util_vals.device, dtype=torch.long)
-        if comp_noise_type is not None:
-            new_comp = inject_comp_error(
-                new_comp, util_diff, comp_noise_type, comp_noise
-            )
-        comp_pairs.append(new_comp)
+    # view the first 2 * (num_outcomes // 2) utilities as consecutive pairs
+    num_pairs = util_vals.shape[0] // 2
+    util_pairs = util_vals.reshape(util_vals.shape[0], -1)[: 2 * num_pairs, 0].reshape(
+        num_pairs, 2
+    )
+    pair_indices = torch.arange(
+        2 * num_pairs, device=util_vals.device, dtype=torch.long
+    ).view(num_pairs, 2)
+
+    # the first of each pair wins only if its utility is strictly larger
+    first_wins = util_pairs[:, 0] > util_pairs[:, 1]
+    comp_pairs = torch.where(
+        first_wins.unsqueeze(-1), pair_indices, pair_indices.flip(-1)
+    )
 
-    comp_pairs = torch.stack(comp_pairs)
+    if comp_noise_type is not None:
+        util_diff = (util_pairs[:, 0] - util_pairs[:, 1]).abs()
+        comp_pairs = inject_comp_error(
+            comp_pairs, util_diff, comp_noise_type, comp_noise
+        )
 
-    return comp_pairs
+    return comp_pairs.contiguous()
 
 
 def gen_initial_real_data(
@@ -147,6 +165,217 @@ def fit_outcome_model(X: torch.Tensor, Y: torch.Tensor, **model_kwargs) -> Model
     return outcome_model
 
 
+def fit_batched_outcome_models(
+    X_list: List[Tensor], 
+    Y_list: List[Tensor], 
+    outcome_transforms: List[Optional[OutcomeTransform]],
+) -> List[Model]:
+    r"""Fit one SingleTaskGP per dataset (e.g., one per trial / seed), with all
+    the models fitted jointly as a single batched GP in one optimizer call.
+    Args:
+        X_list: list of `num_samples x input_dim` input data
+        Y_list: list of `num_samples x outcome_dim` outcome data
+        outcome_transforms: list of outcome transforms, one for each dataset.
+            Data-dependent transforms (e.g. PCA) are fitted on each dataset
+            separately, before the batched GP is fitted on the transformed data.
+    Returns:
+        list of fitted outcome models, one for each dataset; these are regular
+        (non-batched) SingleTaskGPs, same as the ones from fit_outcome_model()
+    """
+
+    outcome_models = [
+        SingleTaskGP(train_X=X, train_Y=Y, outcome_transform=outcome_tf)
+        for X, Y, outcome_tf in zip(X_list, Y_list, outcome_transforms)
+    ]
+
+    # datasets can only be batched together if the data have the same shape,
+    # e.g., PCA may learn a different number of axes for each dataset
+    groups = defaultdict(list)
+    for idx, model in enumerate(outcome_models):
+        train_X = model.train_inputs[0]
+        if model.num_outputs > 1:
+            train_X = train_X[0]
+        groups[(tuple(train_X.shape), model.num_outputs)].append(idx)
+
+    for idcs in groups.values():
+        batch_X, batch_Y = [], []
+        for idx in idcs:
+            model = outcome_models[idx]
+            # training data after the outcome transform
+            batch_X.append(X_list[idx])
+            if model.num_outputs > 1:
+                batch_Y.append(model.train_targets.transpose(-1, -2))
+            else:
+                batch_Y.append(model.train_targets.unsqueeze(-1))
+        batched_model = SingleTaskGP(
+            train_X=torch.stack(batch_X), train_Y=torch.stack(batch_Y)
+        )
+        _fit_batched_gp(batched_model)
+
+        batched_params = dict(batched_model.named_parameters())
+        with torch.no_grad():
+            for batch_idx, idx in enumerate(idcs):
+                for name, param in outcome_models[idx].named_parameters():
+                    param.copy_(batched_params[name][batch_idx])
+                outcome_models[idx].eval()
+
+    return outcome_models
+
+
+def _fit_batched_gp(
+    model: SingleTaskGP,
+    max_iter: int = 2000,
+    history_size: int = 10,
+    ftol: float = 2.220446049250313e-09,
+    gtol: float = 1e-05,
+    max_step: float = 1.0,
+) -> None:
+    r"""Fit the independent GPs stacked along the batch dimensions of `model`.
+
+    Running one L-BFGS on the summed marginal log likelihood (as
+    fit_gpytorch_mll does) mixes the curvature of unrelated GPs, and takes
+    many times more iterations than fitting the GPs one by one. Here, every
+    GP runs its own L-BFGS (curvature pairs, backtracking line search and
+    convergence check), in lockstep, so that each iteration is a single
+    batched forward / backward pass, and the batch only takes as many
+    iterations as its slowest GP. The objective of each GP is the one
+    fit_gpytorch_mll minimizes when fitting it alone; ftol and gtol are the
+    scipy L-BFGS-B defaults. GPs whose line search fails, or that have not
+    converged after max_iter iterations, stop where they are, with an
+    OptimizationWarning.
+    Args:
+        model: batched SingleTaskGP
+        max_iter: maximum number of L-BFGS iterations
+        history_size: number of curvature pairs kept per GP
+        ftol: tolerance on the relative reduction of the loss of a GP
+        gtol: tolerance on the largest gradient entry of a GP
+        max_step: largest change of any raw hyperparameter in one iteration;
+            a single GP stepping too far (e.g., to a near-zero noise) makes
+            the Cholesky decomposition of the batch fail, after which the
+            line search evaluates the GPs one by one
+    """
+    mll = ExactMarginalLogLikelihood(model.likelihood, model)
+    mll.train()
+    batch_shape = model._aug_batch_shape
+    num_gps = batch_shape.numel()
+    params = [param for param in model.parameters() if param.requires_grad]
+    sizes = [param.numel() // num_gps for param in params]
+
+    def loss_and_grad(x):
+        with torch.no_grad():
+            for param, x_param in zip(params, torch.split(x, sizes, dim=-1)):
+                param.copy_(x_param.reshape(param.shape))
+        model.zero_grad()
+        with torch.enable_grad():
+            # the marginal log likelihood (with the log priors) of each GP
+            loss = -mll(
+                model(*model.train_inputs), model.train_targets, *model.train_inputs)
+            loss.sum().backward()
+        grad = torch.cat([param.grad.reshape(num_gps, -1) for param in params], dim=-1)
+        return loss.detach().reshape(num_gps), grad
+
+    def initial_step(g):
+        return (1 / g.abs().sum(-1)).clamp(max=1)
+
+    x = torch.cat([param.detach().reshape(num_gps, -1) for param in params], dim=-1)
+    f, g = loss_and_grad(x)
+    if not torch.isfinite(f).all():
+        raise RuntimeError("Non-finite marginal log likelihood at initialization.")
+    # curvature pairs, oldest first; rho = 0 marks an empty slot
+    S = x.new_zeros(history_size, *x.shape)
+    Y = x.new_zeros(history_size, *x.shape)
+    rho = x.new_zeros(history_size, num_gps)
+    active = g.abs().amax(-1) > gtol
+    line_search_failed = torch.zeros_like(active)
+
+    for _ in range(max_iter):
+        if not active.any():
+            break
+        # two-loop recursion, for all GPs at once
+        q = g.clone()
+        a = x.new_zeros(history_size, num_gps)
+        for i in reversed(range(history_size)):
+            a[i] = rho[i] * (S[i] * q).sum(-1)
+            q -= a[i].unsqueeze(-1) * Y[i]
+        yy = (Y[-1] * Y[-1]).sum(-1)
+        gamma = torch.where(
+            rho[-1] > 0, 1 / (rho[-1] * yy).clamp(min=1e-300), initial_step(g))
+        r = gamma.unsqueeze(-1) * q
+        for i in range(history_size):
+            b = rho[i] * (Y[i] * r).sum(-1)
+            r += (a[i] - b).unsqueeze(-1) * S[i]
+        d = -r
+        # restart from steepest descent if d is not a descent direction
+        not_descent = (g * d).sum(-1) >= 0
+        d[not_descent] = -initial_step(g[not_descent]).unsqueeze(-1) * g[not_descent]
+        rho[:, not_descent] = 0
+        d[~active] = 0
+        gd = (g * d).sum(-1)
+
+        # backtracking line search with the Armijo condition
+        step = (max_step / d.abs().amax(-1).clamp(min=1e-300)).clamp(max=1)
+        searching = active.clone()
+        x_new, f_new, g_new = x.clone(), f.clone(), g.clone()
+        for _ in range(30):
+            x_trial = torch.where(
+                searching.unsqueeze(-1), x + step.unsqueeze(-1) * d, x_new)
+            try:
+                f_trial, g_trial = loss_and_grad(x_trial)
+            except RuntimeError:
+                # e.g. a failed Cholesky decomposition of one of the GPs; try
+                # the GPs one at a time, with the others at feasible values
+                f_trial, g_trial = torch.full_like(f, float("inf")), g.clone()
+                for i in searching.nonzero().squeeze(-1).tolist():
+                    x_i = torch.where(searching.unsqueeze(-1), x, x_new)
+                    x_i[i] = x_trial[i]
+                    try:
+                        f_i, g_i = loss_and_grad(x_i)
+                    except RuntimeError:
+                        continue
+                    f_trial[i], g_trial[i] = f_i[i], g_i[i]
+            accept = searching & (f_trial <= f + 1e-4 * step * gd)
+            if accept.any():
+                x_new[accept], f_new[accept] = x_trial[accept], f_trial[accept]
+                g_new[accept] = g_trial[accept]
+            searching &= ~accept
+            if not searching.any():
+                break
+            step[searching] /= 2
+        # GPs whose line search failed stop at their current iterate
+        line_search_failed |= searching
+        active &= ~searching
+
+        s, y = x_new - x, g_new - g
+        sy = (s * y).sum(-1)
+        update = active & (sy > 1e-10)
+        S = torch.where(update[:, None], torch.cat((S[1:], s[None])), S)
+        Y = torch.where(update[:, None], torch.cat((Y[1:], y[None])), Y)
+        rho = torch.where(
+            update, torch.cat((rho[1:], (1 / sy.clamp(min=1e-10))[None])), rho)
+
+        converged = (f - f_new) <= ftol * torch.stack(
+            (f.abs(), f_new.abs(), torch.ones_like(f))).amax(0)
+        converged |= g_new.abs().amax(-1) <= gtol
+        active &= ~converged
+        x, f, g = x_new, f_new, g_new
+
+    if line_search_failed.any():
+        warnings.warn(
+            f"The line search failed for {int(line_search_failed.sum())} of "
+            f"{num_gps} batched GPs, which stopped before converging.",
+            OptimizationWarning,
+        )
+    if active.any():
+        warnings.warn(
+            f"{int(active.sum())} of {num_gps} batched GPs did not converge "
+            f"within max_iter={max_iter} iterations.",
+            OptimizationWarning,
+        )
+    loss_and_grad(x)
+    model.zero_grad()
+    model.eval()
+
+
 def fit_pref_model(Y: Tensor, comps: Tensor, **model_kwargs) -> Model:
     r"""
     Fit a preference / utility GP model for the mapping from outcome to scalar utility value
@@ -170,6 +399,121 @@ def fit_pref_model(Y: Tensor, comps: Tensor, **model_kwargs) -> Model:
     return util_model
 
 
+class WarmStartPairwiseGP(PairwiseGP):
+    r"""
+    PairwiseGP whose Laplace approximation can be warm-started from given
+    utilities. PairwiseGP starts the search for the MAP utilities from those
+    of its last update, or from a heuristic based on the number of wins of
+    each datapoint when the number of datapoints changed. Setting
+    `utility_init` to a `num_datapoints` tensor, with one utility for each
+    datapoint in `datapoints` (i.e., after duplicates are consolidated),
+    makes the next update start from these utilities instead; a tensor of the
+    wrong size is ignored. This hook is not part of PairwiseGP's interface: it
+    overrides the private `_update` and sets the private `_x0`, so it is tied
+    to the botorch version pinned in requirements.txt, see
+    pref_learning_helpers_test.py.
+    """
+
+    utility_init: Optional[Tensor] = None
+
+    def _update(self, datapoints: Tensor, **kwargs) -> None:
+        if self.utility_init is not None:
+            # PairwiseGP keeps the utilities to warm-start from in _x0
+            self._x0 = self.utility_init.detach().cpu().numpy()
+            self.utility_init = None
+        super()._update(datapoints, **kwargs)
+
+
+class IncrementalPairwiseGP:
+    r"""
+    Keep a fitted PairwiseGP utility model across preference learning rounds.
+
+    Calling `fit()` with the same data as the last call returns the last fitted
+    model, so that one fit can be shared between e.g. the acquisition step and
+    the posterior mean check of the same round. If the new data only appends
+    datapoints and comparisons to the last data, the same model is updated in
+    place through set_train_data(): fitting starts from the current kernel 
+    hyperparameters, with the Laplace MAP utilities warm-started at the 
+    previous posterior mean (which, at the previous datapoints, is their MAP 
+    utility), see WarmStartPairwiseGP. Otherwise, a new model is fitted 
+    from scratch.
+    """
+
+    def __init__(
+        self,
+        warm_start: bool = True,
+        **model_kwargs
+    ) -> None:
+        r"""
+        Args:
+            warm_start: if False, always fit a new model from scratch
+                (same as calling fit_pref_model() every time)
+            model_kwargs: arguments for PairwiseGP, such as input_transform
+                and covar_module
+        """
+        self.warm_start = warm_start
+        self.model_kwargs = model_kwargs
+        self.model = None
+        self.Y = None
+        self.comps = None
+
+    def fit(self, Y: Tensor, comps: Tensor) -> PairwiseGP:
+        r"""Fit (or reuse) the utility model on the given data.
+        Args:
+            Y: `num_outcome_samples x outcome_dim` tensor of outcomes
+            comps: `num_comparisons x 2` tensor of comparisons
+        Returns:
+            util_model: fitted PairwiseGP
+        """
+        comps = comps.long()
+        if self.model is not None and self._is_extension(Y, comps):
+            if Y.shape[-2] == self.Y.shape[-2] and comps.shape[-2] == self.comps.shape[-2]:
+                return self.model
+            if self.warm_start:
+                try:
+                    self._warm_start_fit(Y, comps)
+                    return self.model
+                except (ValueError, RuntimeError):
+                    pass
+
+        self.model = None
+        self.model = WarmStartPairwiseGP(
+            datapoints=Y, comparisons=comps, **copy.deepcopy(self.model_kwargs))
+        mll_util = PairwiseLaplaceMarginalLogLikelihood(
+            self.model.likelihood, self.model)
+        fit_gpytorch_mll(mll_util)
+        self.Y, self.comps = Y, comps
+        return self.model
+
+    def _is_extension(self, Y: Tensor, comps: Tensor) -> bool:
+        n, m = self.Y.shape[-2], self.comps.shape[-2]
+        return (
+            Y.shape[-2] >= n 
+            and comps.shape[-2] >= m
+            and torch.equal(Y[..., :n, :], self.Y)
+            and torch.equal(comps[..., :m, :], self.comps)
+        )
+
+    def _warm_start_fit(self, Y: Tensor, comps: Tensor) -> None:
+        model = self.model
+        if len(model.batch_shape) > 0:
+            raise RuntimeError("Incremental updates are not supported in batch mode")
+
+        with torch.no_grad():
+            model.eval()
+            util_init = model.posterior(Y).mean.reshape(-1)
+
+        model.set_train_data(Y, comps, update_model=False)
+        # utilities of the consolidated datapoints, each of which is one of Y
+        is_same = torch.isclose(
+            model.datapoints.unsqueeze(-2), Y.unsqueeze(-3)).all(dim=-1)
+        model.utility_init = util_init[is_same.to(torch.int).argmax(dim=-1)]
+
+        mll_util = PairwiseLaplaceMarginalLogLikelihood(model.likelihood, model)
+        fit_gpytorch_mll(mll_util)
+        self.Y, self.comps = Y, comps
+
+
 def fit_util_models(train_Y, comps, util_vals, input_transform, covar_module):
     """ 
     Fit utility model given (1) comparisons (2) ground truth utility values.
@@ -295,6 +639,132 @@ def generate_random_pref_data(
 
 # ======= Candidate and outcome generation =======
 
+# transforms mapping between the full outcome space and a latent space
+_OUTCOME_PROJECTIONS = (
+    PCAOutcomeTransform,
+    LinearProjectionOutcomeTransform,
+    SubsetOutcomeTransform,
+)
+_INPUT_PROJECTIONS = (
+    PCAInputTransform,
+    LinearProjectionInputTransform,
+    FilterFeatures,
+)
+
+
+def _split_at_projection(transform, projection_types):
+    r"""Split a (chained) transform into the steps before the projection,
+    the projection, and the steps after it. Returns None if there is not
+    exactly one projection step."""
+    if isinstance(transform, (ChainedOutcomeTransform, ChainedInputTransform)):
+        steps = list(transform.items())
+    else:
+        steps = [("projection", transform)]
+    proj_idx = [i for i, (_, tf) in enumerate(steps) if isinstance(tf, projection_types)]
+    if len(proj_idx) != 1:
+        return None
+    return steps[: proj_idx[0]], steps[proj_idx[0]][1], steps[proj_idx[0] + 1 :]
+
+
+def get_latent_space_models(
+    outcome_model: Model, util_model: PairwiseGP, atol: float = 1e-6
+) -> Optional[Tuple[Model, PairwiseGP]]:
+    r"""
+    Express an outcome model with a projecting outcome transform (PCA, linear
+    projection or subset) and a utility model with a projecting input transform
+    in the same latent space, so that acquisition functions never form samples
+    in the full outcome space.
+
+    The outcome model's latent posterior is mapped to the full outcome space and
+    then projected again by the utility model's input transform. When all steps
+    in between (e.g., Standardize of the outcomes and InputCenter of the utility
+    inputs) are affine, this is an affine map Z -> Z W + b between latent spaces,
+    with W = I when the projection and back-projection cancel. The returned
+    models share the parameters and data of the given ones:
+        - the outcome model untransforms its posterior only up to the latent
+          space, followed by Z -> Z W + b (skipped when W = I and b = 0),
+        - the utility model stores its datapoints in the latent space and
+          only applies the input transforms after the projection.
+
+    Args:
+        outcome_model: fitted outcome model, with a projecting outcome transform
+        util_model: fitted PairwiseGP, with a projecting input transform
+        atol: absolute tolerance for W = I, b = 0 and for checking that
+            the map between the latent spaces is affine
+    Returns:
+        (latent_outcome_model, latent_util_model), or None if the models do not
+        have this structure, in which case the full-space models should be used
+    """
+    outcome_split = _split_at_projection(
+        getattr(outcome_model, "outcome_transform", None), _OUTCOME_PROJECTIONS)
+    util_split = _split_at_projection(
+        getattr(util_model, "input_transform", None), _INPUT_PROJECTIONS)
+    if outcome_split is None or util_split is None:
+        return None
+    outcome_prefix, outcome_proj, outcome_suffix = outcome_split
+    util_prefix, util_proj, util_suffix = util_split
+    outcome_model.eval()
+    util_model.eval()
+
+    # push 0, the canonical basis and a random point through the composed map;
+    # the random point comes from a local generator, so that the check neither
+    # depends on nor advances the global RNG (e.g. in the middle of PE)
+    train_Y = util_model.datapoints
+    latent_dim = outcome_model.num_outputs
+    generator = torch.Generator().manual_seed(0)
+    Z = torch.cat((
+        torch.zeros(1, latent_dim),
+        torch.eye(latent_dim),
+        torch.randn(1, latent_dim, generator=generator),
+    )).to(train_Y)
+    with torch.no_grad():
+        U = outcome_proj.untransform(Z)[0]
+        for _, tf in reversed(outcome_prefix):
+            U = tf.untransform(U)[0]
+        for _, tf in util_prefix:
+            U = tf.transform(U)
+        U = util_proj.transform(U)
+    offset = U[0]
+    weight = U[1:-1] - offset
+    if not torch.allclose(Z[-1:] @ weight + offset, U[-1:], atol=atol):
+        # some step in between is not affine
+        return None
+
+    latent_outcome_tfs = dict(outcome_suffix)
+    if weight.shape[0] == weight.shape[1] and torch.allclose(
+        weight, torch.eye(latent_dim).to(weight), atol=atol
+    ):
+        weight = None
+    if torch.allclose(offset, torch.zeros_like(offset), atol=atol):
+        offset = None
+    if weight is not None or offset is not None:
+        latent_outcome_tfs["latent_affine"] = LatentAffineOutcomeTransform(
+            weight=weight, offset=offset)
+
+    # shallow copies sharing parameters, data and cached solves with the
+    # original models, with their own transforms
+    latent_outcome_model = copy.copy(outcome_model)
+    latent_outcome_model._modules = dict(outcome_model._modules)
+    del latent_outcome_model._modules["outcome_transform"]
+    if len(latent_outcome_tfs) > 0:
+        latent_outcome_model.outcome_transform = ChainedOutcomeTransform(
+            **latent_outcome_tfs)
+
+    latent_util_model = copy.copy(util_model)
+    latent_util_model._modules = dict(util_model._modules)
+    latent_util_model._buffers = dict(util_model._buffers)
+    del latent_util_model._modules["input_transform"]
+    with torch.no_grad():
+        latent_datapoints = train_Y
+        for _, tf in util_prefix:
+            latent_datapoints = tf.transform(latent_datapoints)
+        latent_util_model.consolidated_datapoints = util_proj.transform(
+            latent_datapoints)
+    if len(util_suffix) > 0:
+        latent_util_model.input_transform = ChainedInputTransform(**dict(util_suffix))
+
+    return latent_outcome_model, latent_util_model
+
 
 def gen_exp_cand(
     model: Model,
@@ -308,6 +778,7 @@ def gen_exp_cand(
     num_restarts: int = 8,
     raw_samples: int = 64,
     batch_limit: int = 4,
+    latent_space: bool = False,
 ) -> Tensor:
     """Given an outcome model and an objective, generate q experimental candidates
     using a specified acquisition function.
@@ -323,9 +794,26 @@ def gen_exp_cand(
         num_restarts: number of starting points for multi-start acqf optimization
         raw_samples: number of samples for initializing acqf optimization
         batch_limit: the limit on batch size in gen_candidates_scipy() within optimize_acqf()
+        latent_space: if True and `objective` is a LearnedObjective, draw the outcome
+            samples in the latent space shared by the outcome and utility models
+            when possible, see `get_latent_space_models`
     Returns:
         candidates: `q x problem input dim` generated candidates
     """
+    if latent_space and isinstance(objective, LearnedObjective):
+        pref_model = objective.pref_model
+        fast_pref_model = isinstance(pref_model, FastPairwiseGP)
+        if fast_pref_model:
+            pref_model = pref_model.model
+        latent_models = get_latent_space_models(model, pref_model)
+        if latent_models is not None:
+            model, latent_util_model = latent_models
+            if fast_pref_model:
+                latent_util_model = FastPairwiseGP(
+                    latent_util_model, truncation_rank=objective.pref_model.truncation_rank)
+            objective = LearnedObjective(
+                pref_model=latent_util_model, sampler=objective.sampler)
+
     sampler = SobolQMCNormalSampler(sampler_num_outcome_samples)
     if acqf_name == "qNEI":
         # generate experimental candidates with qNEI/qNEIUU
@@ -567,22 +1055,20 @@ def inject_comp_error(comp, util_diff, comp_noise_type, comp_noise):
     else:
         raise UnsupportedError(f"Unsupported comp_noise_type: {comp_noise_type}")
 
-    # with comp_error_p probability to make a comparison mistake
-    flip_rand = torch.rand(util_diff.shape).to(util_diff)
+    # with comp_error_p probability to make a comparison mistake,
+    # one draw for all pairs
+    flip_rand = torch.rand(
+        util_diff.shape, dtype=util_diff.dtype, device=util_diff.device
+    )
     to_flip = flip_rand < comp_error_p
-    flipped_comp = comp.clone()
-    if len(flipped_comp.shape) > 1:
+    if len(comp.shape) > 1:
         assert (util_diff >= 0).all()
         # flip tensor
-        flipped_comp[to_flip, 0], flipped_comp[to_flip, 1] = (
-            comp[to_flip, 1],
-            comp[to_flip, 0],
-        )
+        flipped_comp = torch.where(to_flip.unsqueeze(-1), comp.flip(-1), comp)
     else:
         assert util_diff > 0
         # flip a single pair
-        if to_flip:
-            flipped_comp[[0, 1]] = flipped_comp[[1, 0]]
+        flipped_comp = comp.flip(-1) if to_flip else comp.clone()
     return flipped_comp
 
 
@@ -590,39 +1076,114 @@ def find_true_optimal_utility(
     problem: torch.nn.Module, 
     util_func: torch.nn.Module, 
     n: int,
-    maximize: bool = True
+    maximize: bool = True,
+    refine_top_k: int = 10,
+    use_cache: bool = True,
+    cache_dir: Optional[str] = None,
+    seed: int = 0,
 ):
     r"""
     Find the optimal utility value, i.e., max_x (util_func(problem(x))) across
-    the domain through taking a large number of samples.
+    the domain through taking a large number of samples, then refining the
+    best ones with L-BFGS-B if the problem and utility are differentiable.
+    The result is cached on disk, keyed by a fingerprint of the problem, the
+    utility function and the settings, so that it is only computed once 
+    across trials. Results for stochastic problems (see
+    caching.is_deterministic) are not cached.
     Args:
         problem: a TestProblem that maps designs to outcomes
         util_func: maps outcomes to scalar utility
         n: number of evalutions
         maximize: boolean for whether to maximize (if False, minimize)
+        refine_top_k: number of best samples to use as starting points for 
+            gradient-based refinement; set to 0 to skip refinement
+        use_cache: whether to read from / write to the on-disk cache
+        cache_dir: directory of the cache; defaults to 
+            $LOW_RANK_BOPE_CACHE_DIR or ~/.cache/low_rank_BOPE
+        seed: seed for the Sobol samples
+    Returns:
+        the optimal utility value found
     """
 
+    use_cache = use_cache and is_deterministic(problem)
+    if use_cache:
+        cache_key = "true_opt_" + compute_fingerprint(
+            problem, util_func, n, maximize, refine_top_k, seed
+        )
+        cached = load_from_cache(cache_key, cache_dir)
+        if cached is not None:
+            return cached["opt_val"]
+
+    sign = 1 if maximize else -1
+
+    def signed_util(X):
+        return sign * util_func(problem.evaluate_true(X)).reshape(X.shape[0], -1)[:, 0]
+
     meta_batch_size = 20000 // problem.dim
     num_meta_batches = n // meta_batch_size + 1
-    best_util_vals = []
-
-    for _ in range(num_meta_batches):
-        _, _, util_vals, _ = gen_initial_real_data(
-            n=meta_batch_size,
-            problem=problem,
-            util_func=util_func,
-            comp_noise=0,
-            batch_eval=True
-        )
-        if maximize:
-            best_util_vals.append(torch.max(util_vals).item())
-        else:
-            best_util_vals.append(torch.min(util_vals).item())
-    
-    if maximize:
-        return np.max(best_util_vals)
-    else:
-        return np.min(best_util_vals)
+    top_X, top_vals = None, None
+
+    with torch.no_grad():
+        for batch_idx in range(num_meta_batches):
+            X = draw_sobol_samples(
+                bounds=problem.bounds, n=meta_batch_size, q=1, seed=seed + batch_idx
+            ).squeeze(-2)
+            vals = signed_util(X).to(X)
+            if top_X is not None:
+                X = torch.cat((top_X, X))
+                vals = torch.cat((top_vals, vals))
+            top_vals, top_idx = torch.topk(vals, k=min(max(refine_top_k, 1), len(vals)))
+            top_X = X[top_idx]
+
+    best_val = top_vals[0].item()
+    if refine_top_k > 0:
+        refined_val = _refine_optimal_utility(signed_util, top_X, problem.bounds)
+        if refined_val is not None:
+            best_val = max(best_val, refined_val)
+    opt_val = sign * best_val
+
+    if use_cache:
+        save_to_cache(cache_key, {"opt_val": opt_val}, cache_dir)
+
+    return opt_val
+
+
+def _refine_optimal_utility(
+    signed_util, X_init: Tensor, bounds: Tensor, maxiter: int = 200
+) -> Optional[float]:
+    r"""Jointly run L-BFGS-B from each row of X_init to maximize signed_util.
+    Returns the best value found, or None if signed_util is not differentiable.
+    """
+    shape = X_init.shape
+    lower = bounds[0].expand(shape).reshape(-1).cpu().numpy()
+    upper = bounds[1].expand(shape).reshape(-1).cpu().numpy()
+
+    def f_and_grad(x):
+        X = torch.from_numpy(x).to(X_init).view(shape).requires_grad_(True)
+        loss = -signed_util(X).sum()
+        (grad,) = torch.autograd.grad(loss, X)
+        return loss.item(), grad.reshape(-1).cpu().double().numpy()
+
+    try:
+        # check that gradients can be computed at all, e.g. the problem
+        # could be a simulator that detaches or goes through numpy
+        _, grad = f_and_grad(X_init.reshape(-1).cpu().double().numpy())
+        if not np.all(np.isfinite(grad)):
+            return None
+    except RuntimeError:
+        return None
+
+    res = scipy.optimize.minimize(
+        f_and_grad,
+        X_init.reshape(-1).cpu().double().numpy(),
+        jac=True,
+        method="L-BFGS-B",
+        bounds=list(zip(lower, upper)),
+        options={"maxiter": maxiter},
+    )
+    with torch.no_grad():
+        X_refined = torch.from_numpy(res.x).to(X_init).view(shape)
+        return signed_util(X_refined).max().item()
 
 
 # TODO: fix this later, using scipy but not optimizing at all
@@ -0,0 +1,94 @@
+import copy
+import sys
+
+sys.path.append('../..')
+
+import pytest
+import torch
+from botorch.exceptions.warnings import OptimizationWarning
+from botorch.models import SingleTaskGP
+from botorch.models.transforms.outcome import Standardize
+from gpytorch.mlls import ExactMarginalLogLikelihood
+from low_rank_BOPE.src.models import make_modified_kernel
+from low_rank_BOPE.src.pref_learning_helpers import (IncrementalPairwiseGP,
+                                                     _fit_batched_gp,
+                                                     fit_batched_outcome_models,
+                                                     fit_outcome_model,
+                                                     fit_pref_model, gen_comps)
+
+
+def make_outcome_data(num_datasets=4, num_samples=20, input_dim=3, outcome_dim=4):
+    r"""Noisy random sinusoids, one dataset per trial."""
+    torch.manual_seed(0)
+    X_list, Y_list = [], []
+    for _ in range(num_datasets):
+        X = torch.rand(num_samples, input_dim, dtype=torch.double)
+        W = torch.randn(input_dim, outcome_dim, dtype=torch.double)
+        noise = torch.randn(num_samples, outcome_dim, dtype=torch.double)
+        X_list.append(X)
+        Y_list.append(torch.sin(3 * X @ W) + 0.05 * noise)
+    return X_list, Y_list
+
+
+def train_mll(model):
+    r"""Marginal log likelihood (with the log priors) of a fitted model."""
+    model.train()
+    mll = ExactMarginalLogLikelihood(model.likelihood, model)
+    with torch.no_grad():
+        res = mll(model(*model.train_inputs), model.train_targets, *model.train_inputs)
+    model.eval()
+    return res.sum().item()
+
+
+def test_fit_batched_outcome_models():
+    r"""Fitting the trials' outcome models as one batched GP reaches the
+    marginal log likelihoods of fitting them one by one. (These data also
+    make the batched Cholesky decomposition fail in the line search.)"""
+    X_list, Y_list = make_outcome_data()
+    batched_models = fit_batched_outcome_models(
+        X_list, Y_list, [Standardize(Y.shape[-1]) for Y in Y_list])
+    for X, Y, batched_model in zip(X_list, Y_list, batched_models):
+        model = fit_outcome_model(X, Y, outcome_transform=Standardize(Y.shape[-1]))
+        assert train_mll(batched_model) == pytest.approx(train_mll(model), abs=1e-3)
+
+
+def test_fit_batched_gp_warns():
+    r"""GPs that are still being fitted after max_iter iterations warn."""
+    X_list, Y_list = make_outcome_data(num_datasets=2)
+    model = SingleTaskGP(torch.stack(X_list), torch.stack(Y_list))
+    with pytest.warns(OptimizationWarning, match="did not converge"):
+        _fit_batched_gp(model, max_iter=1)
+
+
+def test_warm_start_pref_model():
+    r"""A warm-started refit on extended data reaches the same hyperparameters
+    and MAP utilities as a cold fit_pref_model() from the same initial
+    hyperparameters, i.e., the warm start only changes where the search for
+    the MAP utilities starts."""
+    for seed in range(3):
+        torch.manual_seed(seed)
+        Y = torch.rand(40, 3, dtype=torch.double)
+        # repeat a few datapoints, which PairwiseGP consolidates
+        Y = torch.cat((Y, Y[:3]))
+        comps = gen_comps(Y.sum(-1))
+
+        incremental_model = IncrementalPairwiseGP(
+            covar_module=make_modified_kernel(ard_num_dims=3))
+        model = incremental_model.fit(Y[:30], comps[:15])
+        init_covar_module = copy.deepcopy(model.covar_module)
+        # updated in place, rather than refitted from scratch
+        assert incremental_model.fit(Y, comps) is model
+        ref_model = fit_pref_model(Y, comps, covar_module=init_covar_module)
+
+        assert torch.equal(model.datapoints, ref_model.datapoints)
+        for name, param in ref_model.covar_module.named_hyperparameters():
+            assert torch.allclose(
+                model.covar_module.get_parameter(name), param, rtol=1e-5, atol=1e-8
+            ), name
+        assert torch.allclose(model.utility, ref_model.utility, rtol=0, atol=1e-5)
+
+
+if __name__ == "__main__":
+    test_fit_batched_outcome_models()
+    test_fit_batched_gp_warns()
+    test_warm_start_pref_model()
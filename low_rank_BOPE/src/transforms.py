@@ -1,3 +1,4 @@
+import math
 import random
 from typing import List, Optional, Tuple
 
@@ -8,16 +9,30 @@ from botorch.exceptions.errors import BotorchTensorDimensionError
 from botorch.models.transforms.input import (InputTransform,
                                              ReversibleInputTransform)
 from botorch.models.transforms.outcome import OutcomeTransform
-from botorch.posteriors import Posterior, TransformedPosterior
+from botorch.posteriors import (GPyTorchPosterior, Posterior,
+                                 TransformedPosterior)
+from gpytorch.distributions import MultitaskMultivariateNormal
+from linear_operator.operators import LinearOperator, to_linear_operator
+from linear_operator.utils.getitem import _is_noop_index
 from torch import Tensor
 
 
 # code credit to Sait
 class ModifiedTransformedPosterior(TransformedPosterior):
+    def __init__(self, *args, output_dim: Optional[int] = None, **kwargs):
+        r"""
+        Args:
+            args, kwargs: arguments of TransformedPosterior
+            output_dim: number of outputs after `sample_transform`; if given,
+                shapes are computed without drawing samples
+        """
+        super().__init__(*args, **kwargs)
+        self.output_dim = output_dim
+
     @property
     def event_shape(self) -> torch.Size:
         r"""The event shape (i.e. the shape of a single sample)."""
-        return self.rsample().shape[-2:]
+        return self._extended_shape()
 
     def _extended_shape(
         self, sample_shape: torch.Size = torch.Size()  # noqa: B008
@@ -28,16 +43,200 @@ class ModifiedTransformedPosterior(TransformedPosterior):
         NOTE: This assumes that the `sample_transform` does not change the
         shape of the samples.
         """
-
+        if self.output_dim is not None:
+            return self._posterior._extended_shape()[-2:-1] + torch.Size([self.output_dim])
         return self.rsample().shape[-2:]
 
 
+class ProjectedCovarianceLinearOperator(LinearOperator):
+    r"""
+    Lazy covariance of Y = Z A, where Z is a `batch_shape x n x p` Gaussian
+    with covariance Sigma and A is a `p x d` matrix. In the interleaved
+    order (Y[i, j] at index i * d + j),
+        Cov(Y[i, j], Y[i', j']) = sum_{k, k'} A[k, j] A[k', j'] Cov(Z[i, k], Z[i', k']),
+    i.e. (I_n kron A^T) Sigma (I_n kron A), which has rank at most n * p.
+    Matrix-vector products go through the latent covariance, so the
+    `nd x nd` matrix is never formed.
+    """
+
+    def __init__(
+        self,
+        latent_covar: LinearOperator,
+        projection: Tensor,
+        latent_interleaved: bool = True,
+    ):
+        r"""
+        Args:
+            latent_covar: `batch_shape x np x np` covariance of Z
+            projection: `p x d` tensor A
+            latent_interleaved: whether Z[i, k] is at index i * p + k of
+                `latent_covar` (else at k * n + i)
+        """
+        latent_covar = to_linear_operator(latent_covar)
+        super().__init__(latent_covar, projection, latent_interleaved=latent_interleaved)
+        self.latent_covar = latent_covar
+        self.projection = projection
+        self.latent_interleaved = latent_interleaved
+        self.num_latent, self.num_outputs = projection.shape[-2:]
+        self.num_points = latent_covar.shape[-1] // self.num_latent
+
+    def _size(self) -> torch.Size:
+        dim = self.num_points * self.num_outputs
+        return self.latent_covar.shape[:-2] + torch.Size([dim, dim])
+
+    def _transpose_nonbatch(self) -> LinearOperator:
+        return self
+
+    def _latent_index(self, point_index: Tensor, latent_index: Tensor) -> Tensor:
+        if self.latent_interleaved:
+            return point_index * self.num_latent + latent_index
+        return latent_index * self.num_points + point_index
+
+    def _to_latent(self, rhs: Tensor) -> Tensor:
+        r"""(I_n kron A) rhs: `... x nd x t` -> `... x np x t` in the latent order"""
+        rhs = rhs.reshape(*rhs.shape[:-2], self.num_points, self.num_outputs, rhs.shape[-1])
+        res = torch.einsum("kj,...ijt->...ikt", self.projection, rhs)
+        if not self.latent_interleaved:
+            res = res.transpose(-3, -2)
+        return res.reshape(*res.shape[:-3], -1, res.shape[-1])
+
+    def _from_latent(self, rhs: Tensor) -> Tensor:
+        r"""(I_n kron A^T) rhs: `... x np x t` in the latent order -> `... x nd x t`"""
+        if self.latent_interleaved:
+            rhs = rhs.reshape(*rhs.shape[:-2], self.num_points, self.num_latent, rhs.shape[-1])
+        else:
+            rhs = rhs.reshape(
+                *rhs.shape[:-2], self.num_latent, self.num_points, rhs.shape[-1]
+            ).transpose(-3, -2)
+        res = torch.einsum("kj,...ikt->...ijt", self.projection, rhs)
+        return res.reshape(*res.shape[:-3], -1, res.shape[-1])
+
+    def _matmul(self, rhs: Tensor) -> Tensor:
+        is_vector = rhs.ndimension() == 1
+        if is_vector:
+            rhs = rhs.unsqueeze(-1)
+        res = self._from_latent(self.latent_covar.matmul(self._to_latent(rhs)))
+        return res.squeeze(-1) if is_vector else res
+
+    def _diagonal(self) -> Tensor:
+        # `n x p x p` blocks of the latent covariance, one per point
+        point_index = torch.arange(self.num_points, device=self.device).view(-1, 1, 1)
+        latent_index = torch.arange(self.num_latent, device=self.device)
+        blocks = self.latent_covar[
+            ...,
+            self._latent_index(point_index, latent_index.view(-1, 1)),
+            self._latent_index(point_index, latent_index.view(1, -1)),
+        ]
+        diag = torch.einsum("kj,...ikl,lj->...ij", self.projection, blocks, self.projection)
+        return diag.reshape(*diag.shape[:-2], -1)
+
+    def _getitem(self, row_index, col_index, *batch_indices) -> LinearOperator:
+        if _is_noop_index(row_index) and _is_noop_index(col_index):
+            # only index the batch dimensions of the latent covariance
+            return self.__class__(
+                self.latent_covar._getitem(row_index, col_index, *batch_indices),
+                self.projection,
+                latent_interleaved=self.latent_interleaved,
+            )
+        return super()._getitem(row_index, col_index, *batch_indices)
+
+    def _expand_batch(self, batch_shape: torch.Size) -> LinearOperator:
+        return self.__class__(
+            self.latent_covar._expand_batch(batch_shape),
+            self.projection,
+            latent_interleaved=self.latent_interleaved,
+        )
+
+
+class ProjectedGPyTorchPosterior(GPyTorchPosterior):
+    r"""
+    Exact posterior of Y = Z A for a Gaussian posterior on `n x p` latent
+    outcomes Z and a `p x d` matrix A: a multitask normal with mean mu A and
+    the lazy covariance `ProjectedCovarianceLinearOperator`.
+
+    Shapes are known without sampling. Samples are drawn from the latent
+    posterior and mapped through A, so the base samples have the latent
+    posterior's (smaller) shape and the samples are the same as those of the
+    corresponding `TransformedPosterior`.
+    """
+
+    def __init__(self, posterior: GPyTorchPosterior, projection: Tensor):
+        r"""
+        Args:
+            posterior: posterior on the latent outcomes Z, `batch_shape x n x p`
+            projection: `p x d` tensor A
+        """
+        self.latent_posterior = posterior
+        self.projection = projection
+        latent_distribution = posterior.distribution
+        latent_interleaved = latent_distribution._interleaved if posterior._is_mt else True
+        super().__init__(
+            distribution=MultitaskMultivariateNormal(
+                mean=posterior.mean.matmul(projection),
+                covariance_matrix=ProjectedCovarianceLinearOperator(
+                    latent_distribution.lazy_covariance_matrix,
+                    projection,
+                    latent_interleaved=latent_interleaved,
+                ),
+                interleaved=True,
+            )
+        )
+
+    @property
+    def base_sample_shape(self) -> torch.Size:
+        return self.latent_posterior.base_sample_shape
+
+    @property
+    def batch_range(self) -> Tuple[int, int]:
+        return self.latent_posterior.batch_range
+
+    def rsample_from_base_samples(
+        self, sample_shape: torch.Size, base_samples: Tensor
+    ) -> Tensor:
+        return self.latent_posterior.rsample_from_base_samples(
+            sample_shape=sample_shape, base_samples=base_samples
+        ).matmul(self.projection)
+
+    def rsample(
+        self,
+        sample_shape: Optional[torch.Size] = None,
+        base_samples: Optional[Tensor] = None,
+    ) -> Tensor:
+        return self.latent_posterior.rsample(
+            sample_shape=sample_shape, base_samples=base_samples
+        ).matmul(self.projection)
+
+
+def project_posterior(posterior: Posterior, projection: Tensor) -> Posterior:
+    r"""
+    Posterior on Y = Z A given a posterior on Z: exact (ProjectedGPyTorchPosterior)
+    if the posterior on Z is Gaussian, else a TransformedPosterior whose mean
+    and variance ignore the correlation between the outputs of Z.
+
+    Args:
+        posterior: posterior on `batch_shape x n x p` latent outcomes Z
+        projection: `p x d` tensor A
+    Returns:
+        posterior on the `batch_shape x n x d` outcomes Y
+    """
+    if isinstance(posterior, GPyTorchPosterior):
+        return ProjectedGPyTorchPosterior(posterior, projection)
+    return ModifiedTransformedPosterior(
+        posterior=posterior,
+        sample_transform=lambda x: x.matmul(projection),
+        mean_transform=lambda x, v: x.matmul(projection),
+        variance_transform=lambda x, v: v.matmul(torch.square(projection)),
+        output_dim=projection.shape[-1],
+    )
+
+
 # referred to Wesley's private PCA-GP code
 class PCAOutcomeTransform(OutcomeTransform):
     def __init__(
         self,
         variance_explained_threshold: float = 0.9,
         num_axes: Optional[int] = None,
+        svd_method: str = "full",
         *tkwargs,
     ):
         r"""
@@ -46,11 +245,13 @@ class PCAOutcomeTransform(OutcomeTransform):
             variance_explained_threshold: fraction of variance in the data that we want the selected principal axes to explain;
                 if num_axes is None, use this to decide the number of principal axes to select
             num_axes: number of principal axes to select
+            svd_method: "full" or "randomized", see `compute_principal_axes`
         """
 
         super().__init__()
         self.variance_explained_threshold = variance_explained_threshold
         self.num_axes = num_axes
+        self.svd_method = svd_method
 
     def forward(
         self, Y: torch.Tensor, Yvar: Optional[torch.Tensor] = None, **tkwargs
@@ -68,20 +269,17 @@ class PCAOutcomeTransform(OutcomeTransform):
 
         if self.training:
 
-            U, S, V = torch.svd(Y)
-            S_squared = torch.square(S)
-            explained_variance = S_squared / S_squared.sum()
-
-            if self.num_axes is None:
-                # decide the number of principal axes to keep (that makes explained variance exceed the specified threshold)
-                exceed_thres = (
-                    np.cumsum(explained_variance) > self.variance_explained_threshold
-                )
-                self.num_axes = len(exceed_thres) - sum(exceed_thres) + 1
-
-            axes_learned = torch.transpose(V[:, : self.num_axes], -2, -1)
-            self.PCA_explained_variance = sum(explained_variance[: self.num_axes])
-            self.axes_learned = torch.tensor(axes_learned, **tkwargs)
+            # decide the number of principal axes to keep (that makes explained
+            # variance exceed the specified threshold), unless num_axes is given
+            axes_learned, explained_variance = compute_principal_axes(
+                Y.detach(),
+                var_threshold=self.variance_explained_threshold,
+                num_PCs=self.num_axes,
+                svd_method=self.svd_method,
+            )
+            self.num_axes = axes_learned.shape[0]
+            self.PCA_explained_variance = explained_variance[: self.num_axes].sum()
+            self.axes_learned = axes_learned.to(**tkwargs)
 
         Y_transformed = torch.matmul(Y, torch.transpose(self.axes_learned, -2, -1)).to(
             **tkwargs
@@ -127,12 +325,7 @@ class PCAOutcomeTransform(OutcomeTransform):
             untransformed_posterior: posterior in the space of metrics
         """
 
-        untransformed_posterior = ModifiedTransformedPosterior(
-            posterior=posterior,
-            sample_transform=lambda x: x.matmul(self.axes_learned),
-            mean_transform=lambda x, v: x.matmul(self.axes_learned),
-            variance_transform=lambda x, v: v.matmul(torch.square(self.axes_learned)),
-        )
+        untransformed_posterior = project_posterior(posterior, self.axes_learned)
 
         return untransformed_posterior
 
@@ -268,13 +461,8 @@ class LinearProjectionOutcomeTransform(OutcomeTransform):
             untransformed_posterior: posterior in the space of outcomes
         """
 
-        untransformed_posterior = ModifiedTransformedPosterior(
-            posterior=posterior,
-            sample_transform=lambda x: x.matmul(self.projection_matrix_pseudo_inv),
-            mean_transform=lambda x, v: x.matmul(self.projection_matrix_pseudo_inv),
-            variance_transform=lambda x, v: v.matmul(
-                torch.square(self.projection_matrix_pseudo_inv)
-            ),  # TODO: think about this later
+        untransformed_posterior = project_posterior(
+            posterior, self.projection_matrix_pseudo_inv
         )
 
         return untransformed_posterior
@@ -332,6 +520,109 @@ class LinearProjectionInputTransform(InputTransform, torch.nn.Module):
         return untransformed_X
 
 
+class LatentAffineOutcomeTransform(OutcomeTransform):
+    def __init__(
+        self,
+        weight: Optional[torch.Tensor] = None,
+        offset: Optional[torch.Tensor] = None,
+    ):
+        r"""
+        Initialize LatentAffineOutcomeTransform() instance, which maps
+        values Y to latent outcomes Z = (Y - b) W^+, and untransforms latent
+        outcomes Z to Z W + b, where W^+ is the pseudo-inverse of W. It is used
+        to express outcome model posteriors in the latent coordinates of a
+        utility model's input transform (see `get_latent_space_models`).
+        Args:
+            weight: `p x p'` tensor W, identity if None
+            offset: `p'` tensor b, zero if None
+        """
+
+        super().__init__()
+        self.weight = weight
+        self.offset = offset
+
+    def forward(
+        self, Y: torch.Tensor, Yvar: Optional[torch.Tensor] = None, **tkwargs
+    ) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        r"""
+        Map values back to the latent space, i.e., invert `untransform`
+        (exactly if W has full row rank).
+        Args:
+            Y: `batch_shape x num_samples x p'` tensor of mapped values
+            Yvar: (optional) `batch_shape x num_samples x p'` tensor of mapped variances
+        Returns:
+            Y_transformed: `batch_shape x num_samples x p` tensor of latent values
+            Yvar_transformed: `batch_shape x num_samples x p` tensor of latent variances
+        """
+
+        if self.offset is not None:
+            Y = Y - self.offset
+        if self.weight is not None:
+            weight_pseudo_inv = torch.linalg.pinv(self.weight)
+            Y = torch.matmul(Y, weight_pseudo_inv)
+            # as in LinearProjectionOutcomeTransform, ignores the covariance
+            if Yvar is not None:
+                Yvar = torch.matmul(Yvar, torch.square(weight_pseudo_inv))
+
+        return Y, Yvar
+
+    def untransform(
+        self, Y: torch.Tensor, Yvar: Optional[torch.Tensor] = None, **tkwargs
+    ) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        r"""
+        Args:
+            Y: `num_samples x p` tensor of latent values
+            Yvar: `num_samples x p` tensor of latent variances
+        Returns:
+            Y_untransformed: `num_samples x p'` tensor of mapped values
+            Yvar_untransformed: `num_samples x p'` tensor of mapped variances
+        """
+
+        if self.weight is not None:
+            Y = torch.matmul(Y, self.weight)
+            if Yvar is not None:
+                Yvar = torch.matmul(Yvar, torch.square(self.weight))
+        if self.offset is not None:
+            Y = Y + self.offset
+
+        return Y, Yvar
+
+    def untransform_posterior(self, posterior: Posterior):
+        r"""
+        Create posterior distribution of Z W + b.
+        Args:
+            posterior: posterior in the space of Z
+        Returns:
+            untransformed_posterior: posterior in the space of Z W + b
+        """
+
+        if self.weight is not None:
+            posterior = project_posterior(posterior, self.weight)
+        if self.offset is None:
+            return posterior
+
+        if isinstance(posterior, GPyTorchPosterior):
+            # a shift leaves the covariance unchanged
+            mvn = posterior.distribution
+            if posterior._is_mt:
+                mean = mvn.mean + self.offset
+                kwargs = {"interleaved": mvn._interleaved}
+            else:
+                mean = mvn.mean + self.offset.squeeze(-1)
+                kwargs = {}
+            return GPyTorchPosterior(
+                mvn.__class__(
+                    mean=mean, covariance_matrix=mvn.lazy_covariance_matrix, **kwargs
+                )
+            )
+        return ModifiedTransformedPosterior(
+            posterior=posterior,
+            sample_transform=lambda x: x + self.offset,
+            mean_transform=lambda x, v: x + self.offset,
+            variance_transform=lambda x, v: v,
+        )
+
+
 def generate_random_projection(dim, num_axes, **tkwargs):
     r"""
     Generate a random linear projection matrix.
@@ -389,6 +680,10 @@ class SubsetOutcomeTransform(OutcomeTransform):
         super().__init__()
         self.outcome_dim = outcome_dim
         self.subset = subset
+        # scatter indices, built once here rather than in every call
+        self.register_buffer(
+            "subset_indices", torch.as_tensor(subset, dtype=torch.long)
+        )
 
     def forward(
         self, Y: torch.Tensor, Yvar: Optional[torch.Tensor] = None, **tkwargs
@@ -403,10 +698,11 @@ class SubsetOutcomeTransform(OutcomeTransform):
             Yvar_transformed: `batch_shape x num_samples x p` tensor of subset outcome variances
         """
 
-        Y_transformed = Y[..., self.subset].to(**tkwargs)
+        subset_indices = self.subset_indices.to(Y.device)
+        Y_transformed = Y.index_select(-1, subset_indices).to(**tkwargs)
 
         if Yvar is not None:
-            Yvar_transformed = Yvar[..., self.subset].to(**tkwargs)
+            Yvar_transformed = Yvar.index_select(-1, subset_indices).to(**tkwargs)
 
         return Y_transformed, Yvar_transformed if Yvar is not None else None
 
@@ -425,22 +721,27 @@ class SubsetOutcomeTransform(OutcomeTransform):
             Yvar_untransformed: `num_samples x outcome_dim` tensor of outcome variances
         """
 
-        # initialize a zero tensor with the full shapes
-        # then fill in the nonzero values
-        Y_untransformed = torch.zeros((*Y.shape[:-1], self.outcome_dim)).to(Y)
-        Y_untransformed[..., self.subset] = Y
-
+        Y_untransformed = self._impute_zeros(Y)
         if Yvar is not None:
-            Yvar_untransformed = torch.zeros((*Yvar.shape[:-1], self.outcome_dim)).to(
-                Yvar
-            )
-            Yvar_untransformed[..., self.subset] = Yvar
+            Yvar_untransformed = self._impute_zeros(Yvar)
 
         return (
             Y_untransformed,
             Yvar_untransformed if Yvar is not None else None,
         )
 
+    def _impute_zeros(self, y: Tensor) -> Tensor:
+        r"""Scatter `... x p` subset values into a `... x outcome_dim` zero tensor."""
+        return y.new_zeros((*y.shape[:-1], self.outcome_dim)).index_copy_(
+            -1, self.subset_indices.to(y.device), y
+        )
+
+    def _impute_zeros_mean(self, mean: Tensor, variance: Tensor) -> Tensor:
+        return self._impute_zeros(mean)
+
+    def _impute_zeros_variance(self, mean: Tensor, variance: Tensor) -> Tensor:
+        return self._impute_zeros(variance)
+
     def untransform_posterior(self, posterior: Posterior):
         r"""
         Transform a posterior distribution on the subset of outcomes
@@ -452,22 +753,12 @@ class SubsetOutcomeTransform(OutcomeTransform):
                 return zero deterministically for the unmodeled outcomes
         """
 
-        def impute_zeros(y):
-            y_untransformed = torch.zeros((*y.shape[:-1], self.outcome_dim)).to(y)
-            y_untransformed[..., self.subset] = y
-            return y_untransformed
-
-        def mean_transform(y, v):
-            return impute_zeros(y)
-
-        def variance_transform(y, v):
-            return impute_zeros(v)
-
         untransformed_posterior = ModifiedTransformedPosterior(
             posterior=posterior,
-            sample_transform=impute_zeros,
-            mean_transform=mean_transform,
-            variance_transform=variance_transform,
+            sample_transform=self._impute_zeros,
+            mean_transform=self._impute_zeros_mean,
+            variance_transform=self._impute_zeros_variance,
+            output_dim=self.outcome_dim,
         )
 
         return untransformed_posterior
@@ -620,37 +911,105 @@ class InputCenter(ReversibleInputTransform, torch.nn.Module):
         return False
 
 
-def get_latent_ineq_constraints(projection: Tensor, original_bounds: Tensor):
-    """
-    Get inequality constraints on latent variables
+def get_latent_ineq_constraint_matrix(
+    projection: Tensor, original_bounds: Tensor
+) -> Tuple[Tensor, Tensor]:
+    r"""
+    Get inequality constraints on latent variables as one dense system
+    `A @ latent_var >= b`.
 
     Args:
         projection: `latent_dim x outcome_dim` tensor of projection matrix
         original_bounds: `2 x outcome_dim` tensor of bounds in the outcome space
     Returns:
-        A list of tuples (indices, coefficients, rhs),
-            with each tuple encoding an inequality constraint of the form
-            `\sum_i (latent_var[indices[i]] * coefficients[i]) >= rhs`
-        (This is to be directly plugged into inequality_constraints in optimize_acqf) 
+        A: `2 * outcome_dim x latent_dim` tensor of coefficients
+        b: `2 * outcome_dim` tensor of right hand sides;
+            rows 2i and 2i+1 encode the lower and upper bound on outcome i
     """
 
     # we want: 
     # projection[0][i]*pc[0] + ... + projection[p][i]*pc[p] >= original_bounds[0][i]
     # - projection[0][i]*pc[0] - ... - projection[p][i]*pc[p] >= - original_bounds[1][i]
 
-    indices = torch.tensor(range(projection.shape[0]))
-    latent_cons = []
+    projection_t = torch.transpose(projection, -2, -1)
+    A = torch.stack((projection_t, -projection_t), dim=-2).reshape(-1, projection.shape[0])
+    b = torch.stack((original_bounds[0], -original_bounds[1]), dim=-1).reshape(-1)
 
-    for i in range(original_bounds.shape[-1]):
-        lb = original_bounds[0][i].item()
-        coefficients_lb = projection[:,i]
-        latent_cons.append((indices, coefficients_lb, lb))
+    return A, b
 
-        ub = -original_bounds[1][i].item()
-        coefficients_ub = -projection[:,i]
-        latent_cons.append((indices, coefficients_ub, ub))
-    
-    return latent_cons
+
+def ineq_constraint_matrix_to_tuples(A: Tensor, b: Tensor) -> List[Tuple]:
+    r"""
+    Convert constraints `A @ x >= b` into the list of tuples taken by
+    `inequality_constraints` in optimize_acqf, keeping only the nonzero
+    coefficients of each row.
+
+    Args:
+        A: `num_constraints x dim` tensor of coefficients
+        b: `num_constraints` tensor of right hand sides
+    Returns:
+        A list of tuples (indices, coefficients, rhs)
+    """
+
+    nonzero = A != 0
+    if bool(nonzero.all()):
+        # dense rows share the index tensor
+        indices = torch.arange(A.shape[-1])
+        return [(indices, coefficients, rhs) for coefficients, rhs in zip(A, b.tolist())]
+    # all-zero rows are kept as they are, with every index
+    nonzero[~nonzero.any(dim=-1)] = True
+    return [
+        (torch.nonzero(row_nonzero).squeeze(-1), coefficients[row_nonzero], rhs)
+        for row_nonzero, coefficients, rhs in zip(nonzero, A, b.tolist())
+    ]
+
+
+def inequality_constraints_to_matrix(
+    inequality_constraints: List[Tuple], dim: int, **tkwargs
+) -> Tuple[Tensor, Tensor]:
+    r"""
+    Stack constraints in the optimize_acqf format into one dense system
+    `A @ x >= b`; the inverse of `ineq_constraint_matrix_to_tuples`.
+
+    Args:
+        inequality_constraints: list of tuples (indices, coefficients, rhs),
+            each encoding `\sum_i (x[indices[i]] * coefficients[i]) >= rhs`
+        dim: dimension of x
+    Returns:
+        A: `num_constraints x dim` tensor of coefficients
+        b: `num_constraints` tensor of right hand sides
+    """
+
+    tkwargs.setdefault("dtype", torch.double)
+    A = torch.zeros(len(inequality_constraints), dim, **tkwargs)
+    b = torch.zeros(len(inequality_constraints), **tkwargs)
+    for row, (indices, coefficients, rhs) in enumerate(inequality_constraints):
+        A[row, torch.as_tensor(indices, dtype=torch.long)] = torch.as_tensor(
+            coefficients, **tkwargs
+        )
+        b[row] = float(rhs)
+
+    return A, b
+
+
+def get_latent_ineq_constraints(projection: Tensor, original_bounds: Tensor):
+    """
+    Get inequality constraints on latent variables
+
+    Args:
+        projection: `latent_dim x outcome_dim` tensor of projection matrix
+        original_bounds: `2 x outcome_dim` tensor of bounds in the outcome space
+    Returns:
+        A list of tuples (indices, coefficients, rhs),
+            with each tuple encoding an inequality constraint of the form
+            `\sum_i (latent_var[indices[i]] * coefficients[i]) >= rhs`
+        (This is to be directly plugged into inequality_constraints in optimize_acqf;
+        see get_latent_ineq_constraint_matrix for the same constraints as one matrix)
+    """
+
+    return ineq_constraint_matrix_to_tuples(
+        *get_latent_ineq_constraint_matrix(projection, original_bounds)
+    )
     
 
 def compute_weights(
@@ -703,12 +1062,97 @@ def compute_weights(
     return torch.tensor(weights).unsqueeze(1)
 
 
+def select_num_axes(explained_variance: Tensor, var_threshold: float = 0.9) -> int:
+    r"""
+    Smallest number of principal axes whose cumulative explained variance
+    exceeds `var_threshold`.
+
+    Args:
+        explained_variance: `k` tensor of fractions of variance explained by
+            each principal axis, in decreasing order
+        var_threshold: threshold of variance explained
+    Returns:
+        number of principal axes to keep
+    """
+    exceed_thres = torch.cumsum(explained_variance.detach(), dim=-1) > var_threshold
+    return len(exceed_thres) - int(exceed_thres.sum()) + 1
+
+
+def compute_principal_axes(
+    Y_centered: Tensor,
+    var_threshold: float = 0.9,
+    num_PCs: Optional[int] = None,
+    svd_method: str = "full",
+    oversample: int = 10,
+    n_iter: int = 4,
+) -> Tuple[Tensor, Tensor]:
+    r"""
+    Compute the principal axes of a centered data matrix through its SVD.
+
+    Args:
+        Y_centered: `num_samples x outcome_dim` tensor of centered data; can
+            also be any matrix with the same right singular vectors and
+            singular values, e.g. a factor R of the scatter matrix R^T R
+        var_threshold: threshold of variance explained
+        num_PCs: the number of principal components to keep;
+            default None; if specified, will override var_threshold
+        svd_method: "full" for a full SVD, or "randomized" for a truncated
+            randomized SVD, which is faster for large, wide matrices;
+            the rank is increased until the top singular vectors explain
+            `var_threshold` of the total variance
+        oversample: number of extra dimensions sampled in the randomized SVD
+        n_iter: number of power iterations in the randomized SVD
+    Returns:
+        pca_axes: `num_axes x outcome_dim` tensor where each row is a pca axis
+        explained_variance: `k` tensor of fractions of variance explained by
+            the top `k >= num_axes` principal axes
+    """
+    max_rank = min(Y_centered.shape[-2:])
+    if svd_method == "randomized":
+        total_variance = torch.square(Y_centered).sum()
+        rank = min(max_rank, (num_PCs or 1) + oversample)
+        while True:
+            if rank >= max_rank:
+                # no cheaper than a full SVD
+                svd_method = "full"
+                break
+            # fix the seed of the random test matrix, without advancing the
+            # global random number generator used by the experiments
+            with torch.random.fork_rng():
+                torch.manual_seed(0)
+                _, S, V = torch.svd_lowrank(Y_centered, q=rank, niter=n_iter)
+            explained_variance = torch.square(S) / total_variance
+            if num_PCs is not None or explained_variance.sum() > var_threshold:
+                break
+            rank = 2 * rank
+    elif svd_method != "full":
+        raise ValueError(
+            f"svd_method must be 'full' or 'randomized', got {svd_method}")
+
+    if svd_method == "full":
+        _, S, Vh = torch.linalg.svd(Y_centered, full_matrices=False)
+        V = torch.transpose(Vh, -2, -1)
+        S_squared = torch.square(S)
+        explained_variance = S_squared / S_squared.sum()
+
+    if num_PCs is not None:
+        # override var_threshold
+        num_axes = num_PCs
+    else:
+        num_axes = select_num_axes(explained_variance, var_threshold)
+
+    pca_axes = torch.transpose(V[:, : num_axes], -2, -1)
+
+    return pca_axes, explained_variance
+
+
 def fit_pca(
     train_Y: Tensor, 
     var_threshold: float=0.9, 
     num_PCs: Optional[int]=None,
     weights: Optional[Tensor] = None,
-    standardize: Optional[bool] = True
+    standardize: Optional[bool] = True,
+    svd_method: str = "full",
 ):
     r"""
     Perform PCA on supplied data with optional weights.
@@ -720,6 +1164,7 @@ def fit_pca(
             default None; if specified, will override var_threshold
         weights: `num_samples x 1` tensor of weights to add on each data point
         standardize: whether to standardize train_Y before computing PCA
+        svd_method: "full" or "randomized", see `compute_principal_axes`
     Returns:
         pca_axes: `latent_dim x outcome_dim` tensor where each row is a pca axis
     """
@@ -741,23 +1186,126 @@ def fit_pca(
 
     if standardize:
         # standardize
-        U, S, V = torch.svd(train_Y_centered/train_Y_centered.std(dim=0))
-    else:
-        # don't standardize, just center
-        U, S, V = torch.svd(train_Y_centered)
-        
-    S_squared = torch.square(S)
-    explained_variance = S_squared / S_squared.sum()
+        train_Y_centered = train_Y_centered/train_Y_centered.std(dim=0)
+    # otherwise, don't standardize, just center
 
-    if num_PCs is not None:
-        # override var_threshold
-        num_axes = num_PCs
-    else:
-        exceed_thres = (
-            np.cumsum(explained_variance.detach().numpy()) > var_threshold
+    pca_axes, _ = compute_principal_axes(
+        train_Y_centered,
+        var_threshold=var_threshold,
+        num_PCs=num_PCs,
+        svd_method=svd_method,
+    )
+
+    return pca_axes.to(torch.double)
+
+
+class IncrementalPCA:
+    r"""
+    PCA (optionally weighted) that is updated as rows are appended to the
+    data, without refactorizing the whole data matrix. Equivalent to
+    `fit_pca` on all the rows seen so far.
+
+    The weighted PCA in `fit_pca` decomposes Z = w * (Y - m), where m is the
+    w-weighted mean. We keep a compact factor R (at most `outcome_dim` rows)
+    with R^T R = sum_i w_i^2 (y_i - mu)(y_i - mu)^T, where mu is the
+    w^2-weighted mean. New rows are merged by an SVD of the stacked matrix
+    [R; R_new; sqrt(a a_new / (a + a_new)) (mu - mu_new)], where a, a_new are
+    the sums of squared weights. At query time, Z^T Z = R^T R + a (m - mu)(m - mu)^T
+    and the column stds of Z (which has zero column means) are recovered from
+    the same factor, so that standardization costs nothing extra.
+
+    Weights of rows that were already added cannot be changed; if they do,
+    (e.g., weights computed from utility estimates), refit from scratch.
+    """
+
+    def __init__(self, standardize: bool = True, max_rank: Optional[int] = None):
+        r"""
+        Args:
+            standardize: whether to standardize the data before computing PCA
+            max_rank: if specified, only keep the top `max_rank` singular
+                directions after each update, which makes the updates cheaper
+                but the decomposition approximate
+        """
+        self.standardize = standardize
+        self.max_rank = max_rank
+        self.n_samples = 0
+        self.factor = None
+
+    def partial_fit(self, Y: Tensor, weights: Optional[Tensor] = None):
+        r"""
+        Add rows to the data.
+
+        Args:
+            Y: `num_new_samples x outcome_dim` tensor of new data
+            weights: `num_new_samples x 1` tensor of nonnegative weights;
+                default None, i.e., unweighted PCA
+        Returns:
+            self
+        """
+        if weights is None:
+            weights = torch.ones(Y.shape[0], 1, dtype=Y.dtype, device=Y.device)
+        assert weights.shape[0] == Y.shape[0], \
+            f"weights shape {weights.shape} does not match Y shape {Y.shape}, "
+        assert (weights >= 0).all(), \
+            "weights must be nonnegative"
+
+        sum_w2_new = torch.square(weights).sum()
+        mean_w2_new = (torch.square(weights) * Y).sum(dim=0) / sum_w2_new
+        factor_new = weights * (Y - mean_w2_new)
+
+        if self.factor is None:
+            self.sum_w = weights.sum()
+            self.sum_wY = (weights * Y).sum(dim=0)
+            self.sum_w2 = sum_w2_new
+            self.mean_w2 = mean_w2_new
+            stacked = factor_new
+        else:
+            self.sum_w = self.sum_w + weights.sum()
+            self.sum_wY = self.sum_wY + (weights * Y).sum(dim=0)
+            sum_w2 = self.sum_w2 + sum_w2_new
+            mean_correction = torch.sqrt(self.sum_w2 * sum_w2_new / sum_w2) \
+                * (self.mean_w2 - mean_w2_new)
+            stacked = torch.cat(
+                [self.factor, factor_new, mean_correction.unsqueeze(0)], dim=0)
+            self.mean_w2 = (self.sum_w2 * self.mean_w2 + sum_w2_new * mean_w2_new) / sum_w2
+            self.sum_w2 = sum_w2
+
+        # compress the factor to at most `outcome_dim` (or `max_rank`) rows
+        _, S, Vh = torch.linalg.svd(stacked, full_matrices=False)
+        if self.max_rank is not None:
+            S, Vh = S[: self.max_rank], Vh[: self.max_rank]
+        self.factor = S.unsqueeze(-1) * Vh
+        self.n_samples += Y.shape[0]
+
+        return self
+
+    def get_axes(
+        self, var_threshold: float = 0.9, num_PCs: Optional[int] = None
+    ) -> Tensor:
+        r"""
+        Principal axes of all the data seen so far.
+
+        Args:
+            var_threshold: threshold of variance explained
+            num_PCs: the number of principal components to keep;
+                default None; if specified, will override var_threshold
+        Returns:
+            pca_axes: `latent_dim x outcome_dim` tensor where each row is a pca axis
+        """
+        weighted_mean = self.sum_wY / self.sum_w
+        factor = torch.cat(
+            [
+                self.factor,
+                (torch.sqrt(self.sum_w2) * (weighted_mean - self.mean_w2)).unsqueeze(0),
+            ],
+            dim=0,
         )
-        num_axes = len(exceed_thres) - sum(exceed_thres) + 1
+        if self.standardize:
+            # std of the columns of w * (Y - weighted_mean), which have zero mean
+            factor = factor / (
+                torch.linalg.norm(factor, dim=0) / math.sqrt(self.n_samples - 1))
 
-    pca_axes = torch.transpose(V[:, : num_axes], -2, -1).to(torch.double)
+        pca_axes, _ = compute_principal_axes(
+            factor, var_threshold=var_threshold, num_PCs=num_PCs)
 
-    return pca_axes
\ No newline at end of file
+        return pca_axes.to(torch.double)
@@ -11,7 +11,7 @@ import sys
 sys.path.append('..')
 
 
-from low_rank_BOPE.src.lunar_lander import LunarLander
+from low_rank_BOPE.test_problems.lunar_lander import LunarLander
 from low_rank_BOPE.src.pref_learning_helpers import (
     check_outcome_model_fit,
     check_pref_model_fit,
@@ -124,9 +124,12 @@ def main(
         )
 
         # make this part multiprocessing
+        # the trials run in daemonic workers, so each trial evaluates its
+        # episodes serially and at most cpu_count() processes are busy
         mpc_args = [(problem, sigmoid_util_func, int(i), config) for i in range(N_BOPE_REPS)]
-        pool = multiprocessing.Pool()
-        all_results[num_envs] = pool.starmap(run_one_trial, mpc_args)
+        n_processes = min(len(mpc_args), multiprocessing.cpu_count())
+        with multiprocessing.Pool(n_processes) as pool:
+            all_results[num_envs] = pool.starmap(run_one_trial, mpc_args)
         torch.save(all_results, save_file_name)
 
         # for i in range(N_BOPE_REPS):
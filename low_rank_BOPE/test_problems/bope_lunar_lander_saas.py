@@ -117,20 +117,20 @@ def main(
         config = copy.deepcopy(BASE_CONFIG)
         config["input_dim"] = INPUT_DIM
         config["outcome_dim"] = num_envs
-        problem = LunarLander(num_envs=num_envs)
+        with LunarLander(num_envs=num_envs) as problem:
 
-        for i in range(N_BOPE_REPS):
-            print(f'==========running BOPE rep {i}==========')
-            all_results[num_envs].append(
-                run_one_trial(
-                problem=problem,
-                util_func=sigmoid_util_func,
-                trial_idx=i,
-                config=config,
-                **tkwargs,
-            ))
+            for i in range(N_BOPE_REPS):
+                print(f'==========running BOPE rep {i}==========')
+                all_results[num_envs].append(
+                    run_one_trial(
+                    problem=problem,
+                    util_func=sigmoid_util_func,
+                    trial_idx=i,
+                    config=config,
+                    **tkwargs,
+                ))
 
-            torch.save(all_results, save_file_name)
+                torch.save(all_results, save_file_name)
 
     return all_results
 
@@ -689,6 +689,11 @@ class AugmentedProblem(MultiObjectiveTestProblem):
             )
             # print("Generated outcome projection matrix: ", self.outcome_projection_matrix)
 
+    @property
+    def deterministic(self) -> bool:
+        # evaluate_true adds the augmentation noise
+        return not self.noise
+
     def evaluate_true(self, X):
 
         base_outcome = self.base_problem.evaluate_true(X)
@@ -1,4 +1,4 @@
-from typing import List
+from typing import List, Optional
 import numpy as np
 import torch
 from torch import Tensor
@@ -63,6 +63,62 @@ def step(state, Q, R, params):
     return state
 
 
+def simulate_inventory_trajectories(
+    Q: np.ndarray,
+    R: np.ndarray,
+    init_inventory,
+    std_normal_draws: np.ndarray,
+    params: dict,
+) -> np.ndarray:
+    r"""
+    Array-backed version of `step()`: run the QR policies of all designs
+    forward in lockstep and record their inventory levels.
+
+    For the same standard normal draws, this produces the same trajectories
+    as calling `step()` day by day for each design, since
+    `np.random.normal(mean, std) == mean + std * np.random.standard_normal()`.
+
+    Args:
+        Q: `n` array of order quantities
+        R: `n` array of reorder levels
+        init_inventory: initial inventory level, scalar or `n` array
+        std_normal_draws: `n x duration` array of standard normal draws
+            driving the daily demand
+        params: a dictionary of parameters; 'demand_mean', 'demand_std' and
+            'lead_time' may be scalars or `n` arrays (e.g., when simulating
+            several inventories with different parameters together)
+    Returns:
+        `n x duration` array of inventory levels at the start of each day
+    """
+    n, duration = std_normal_draws.shape
+    demand_mean = np.reshape(params['demand_mean'], (-1, 1))
+    demand_std = np.reshape(params['demand_std'], (-1, 1))
+    demand = np.maximum(0, demand_mean + demand_std * std_normal_draws)
+
+    inventory = np.empty((n, duration))
+    state_inventory = np.broadcast_to(
+        np.asarray(init_inventory, dtype=float), (n,)).copy()
+    state_days_left = np.full(n, -1)
+
+    for t in range(duration):
+        inventory[:, t] = state_inventory
+        # orders that arrive today are unloaded; other orders in transit get
+        # one day closer
+        arrived = state_days_left == 0
+        state_inventory = np.where(arrived, state_inventory + Q, state_inventory)
+        state_days_left = np.where(
+            arrived, -1, 
+            np.where(state_days_left > 0, state_days_left - 1, state_days_left)
+        )
+        # fill demand from inventory, backordering if needed
+        state_inventory = state_inventory - demand[:, t]
+        # place an order if below reorder level and no order is on its way
+        reorder = (state_inventory < R) & (state_days_left == -1)
+        state_days_left = np.where(reorder, params['lead_time'], state_days_left)
+
+    return inventory
+
+
 class Inventory(SyntheticTestFunction):
     r"""
     Simulate an inventory control problem using the QR policy.
@@ -79,7 +135,8 @@ class Inventory(SyntheticTestFunction):
         init_inventory: int = 50, # keep it fixed for now
         x_baseline: int = 50,
         x_scaling: int = 50, # scale x to be between 50 and 100
-        params: dict = PARAMS
+        params: dict = PARAMS,
+        seed: Optional[int] = None,
     ):
         r"""
         Args:
@@ -88,6 +145,11 @@ class Inventory(SyntheticTestFunction):
             x_baseline: lower bound for actual values of Q,R params
             x_scaling: scale Q,R values to be in [x_baseline, x_baseline + x_scaling]
             params: dictionary of parameters for running the simulation
+            seed: if not None, the demand of each design is drawn from its
+                own random stream, seeded with `seed` and the design itself,
+                so evaluations are reproducible and do not depend on the
+                other designs in the batch; otherwise the global numpy
+                random state is used
         """
         super().__init__()
         self.outcome_dim = duration
@@ -95,22 +157,54 @@ class Inventory(SyntheticTestFunction):
         self.x_baseline = x_baseline
         self.x_scaling = x_scaling
         self.params = params
+        self.seed = seed
+
+    @property
+    def deterministic(self) -> bool:
+        r"""Outcomes are reproducible only with a seeded demand, see __init__."""
+        return self.seed is not None
 
     def evaluate_true(self, X: Tensor):
         r"""
         Args:
-            X: `num_samples x 2` tensor, where first column is Q and second is R
+            X: `batch_shape x 2` tensor, where first column is Q and second is R
         """
-        Y = []
-        for i, x in enumerate(X):
-            Y.append(self.evaluate_true_single(
-                i, self.x_baseline + self.x_scaling * x))
-        
-        return torch.vstack(Y)
+        QR = self.get_QR(X)
+        inventory = simulate_inventory_trajectories(
+            Q=QR[:, 0],
+            R=QR[:, 1],
+            init_inventory=self.init_inventory,
+            std_normal_draws=self.draw_demand_noise(QR),
+            params=self.params,
+        )
+
+        return torch.tensor(inventory, dtype=torch.double).reshape(
+            *X.shape[:-1], self.outcome_dim)
+
+    def get_QR(self, X: Tensor) -> np.ndarray:
+        r"""Scale `batch_shape x 2` designs to `n x 2` array of (Q, R) values."""
+        X = X.reshape(-1, X.shape[-1])
+        return (self.x_baseline + self.x_scaling * X).detach().cpu().numpy()
+
+    def draw_demand_noise(self, QR: np.ndarray) -> np.ndarray:
+        r"""
+        Draw the `n x duration` standard normal draws driving the demand of
+        the `n` designs in `QR`, in the same order as `evaluate_true_single`
+        consumes them.
+        """
+        if self.seed is None:
+            return np.random.standard_normal((len(QR), self.outcome_dim))
+        return np.stack([
+            np.random.default_rng(
+                [self.seed, *np.ascontiguousarray(qr, dtype=np.float64).view(np.uint32)]
+            ).standard_normal(self.outcome_dim)
+            for qr in QR
+        ])
 
     def evaluate_true_single(self, i: int, x: Tensor):
         r"""
-        Simulate an inventory trajectory for one policy.
+        Simulate an inventory trajectory for one policy, one day at a time.
+        This is the (slow) reference implementation of `evaluate_true`.
         Args:
             i: index of x in all data, used to set random seed
             x: 2-dim tensor, where first entry is Q and second is R
@@ -170,16 +264,23 @@ class InventoryUtil(torch.nn.Module):
             Y: `num_samples x outcome_dim` tensor
         """
 
-        neg_costs = []
+        Y = Y.detach()
+        holding_cost = self.holding_cost_per_unit * torch.clamp(Y, min=0).sum(dim=-1)
+        stockout_cost = self.stockout_penalty_per_unit * torch.clamp(-Y, min=0).sum(dim=-1)
+        # an increase in inventory level means an order has arrived
+        increase = Y[..., 1:] - Y[..., :-1]
+        order_cost = torch.where(
+            increase > 0,
+            self.order_cost_one_time + self.order_cost_per_unit * increase,
+            torch.zeros_like(increase),
+        ).sum(dim=-1)
 
-        for y in Y:
-            neg_costs.append(self.compute_neg_cost(y))
-        
-        return torch.tensor(neg_costs).unsqueeze(1)
+        return -(holding_cost + stockout_cost + order_cost).unsqueeze(-1)
 
     def compute_neg_cost(self, y: Tensor):
         r"""
-        Compute the utility for one inventory time series.
+        Compute the utility for one inventory time series, one day at a time.
+        This is the (slow) reference implementation of `forward`.
         
         Args:
             y: k-dimensional tensor
@@ -209,13 +310,51 @@ class MultipleInventories(SyntheticTestFunction):
         super().__init__()
         self.outcome_dim = sum([problem.outcome_dim for problem in problem_list])
         self.problem_list = problem_list
+
+    @property
+    def deterministic(self) -> bool:
+        return all(problem.deterministic for problem in self.problem_list)
     
     def evaluate_true(self, X:Tensor):
-        Y = []
-        for problem in self.problem_list:
-            Y.append(problem.evaluate_true(X))
-        
-        return torch.hstack(Y)
+        durations = set(problem.outcome_dim for problem in self.problem_list)
+        if len(durations) > 1:
+            Y = []
+            for problem in self.problem_list:
+                Y.append(problem.evaluate_true(X))
+            
+            return torch.cat(Y, dim=-1)
+
+        # simulate all inventories in lockstep, stacking the designs of
+        # the different inventories along the first axis
+        n_problems, duration = len(self.problem_list), durations.pop()
+        QR_list = [problem.get_QR(X) for problem in self.problem_list]
+        QR = np.concatenate(QR_list)
+        n = len(QR) // n_problems
+        # drawn one inventory after another, as evaluate_true() of each
+        # inventory would consume the random stream
+        std_normal_draws = np.concatenate([
+            problem.draw_demand_noise(QR_p)
+            for problem, QR_p in zip(self.problem_list, QR_list)
+        ])
+        params = {
+            key: np.repeat([problem.params[key] for problem in self.problem_list], n)
+            for key in ['demand_mean', 'demand_std', 'lead_time']
+        }
+        init_inventory = np.repeat(
+            [problem.init_inventory for problem in self.problem_list], n)
+
+        inventory = simulate_inventory_trajectories(
+            Q=QR[:, 0],
+            R=QR[:, 1],
+            init_inventory=init_inventory,
+            std_normal_draws=std_normal_draws,
+            params=params,
+        )
+        # `n_problems * n x duration` -> `n x (n_problems * duration)`
+        inventory = inventory.reshape(n_problems, n, duration).transpose(1, 0, 2)
+
+        return torch.tensor(inventory, dtype=torch.double).reshape(
+            *X.shape[:-1], n_problems * duration)
     
 
 class MultipleInventoriesUtil(torch.nn.Module):
@@ -489,15 +489,20 @@ def heuristic_controller(s, W):
     return a
 
 
-def lunar_lander_reward_Heuristic_fun(params):
+def lunar_lander_reward_Heuristic_fun(params, env=None):
     """
     Args:
         params: length-3 list [x, seed, render]
+        env: optional _Lunar_Lander environment to run the episode in; it is
+            reseeded and reset, and left open for the next episode.
+            If None, a new environment is created and closed afterwards.
     """
     x = params[0]
     seed = params[1]
     render = params[2]
-    env = _Lunar_Lander()
+    close_env = env is None
+    if env is None:
+        env = _Lunar_Lander()
     # print('seed', seed)
     np.random.seed(seed)
     env.seed(int(seed))
@@ -514,10 +519,28 @@ def lunar_lander_reward_Heuristic_fun(params):
                 break
         if done:
             break
-    env.close()
+    if close_env:
+        env.close()
     return reward
 
 
+# environment reused by all episodes run in this process
+_PERSISTENT_ENV = None
+
+
+def _get_persistent_env():
+    global _PERSISTENT_ENV
+    if _PERSISTENT_ENV is None:
+        _PERSISTENT_ENV = _Lunar_Lander()
+    return _PERSISTENT_ENV
+
+
+def _run_lunar_lander_episodes(params_batch):
+    r"""Run a batch of [x, seed, render] episodes in this process's environment."""
+    env = _get_persistent_env()
+    return [lunar_lander_reward_Heuristic_fun(params, env=env) for params in params_batch]
+
+
 # outcome function
 class LunarLander:
     def __init__(
@@ -529,14 +552,38 @@ class LunarLander:
         dtype=None,
         device=None,
         render=False,
+        episodes_per_task=None,
     ):
+        r"""
+        Args:
+            envs: seeds of the landing environments, one outcome per seed
+            num_envs: number of environments, used if `envs` is None
+            min_reward: baseline reward subtracted from each environment's reward
+            n_cores: number of worker processes, defaults to the number of cores.
+                The workers are started on first evaluation and each keeps one
+                environment that it reseeds between episodes. If 1 (or if this
+                is already running inside a worker process, e.g. one BOPE trial
+                in a pool of trials), episodes are run serially in this process,
+                so nested parallelism never exceeds the outer pool size.
+            dtype: dtype of the bounds
+            device: device of the bounds
+            render: whether to render the episodes (forces serial evaluation)
+            episodes_per_task: number of episodes sent to a worker at once;
+                defaults to splitting an evaluation into ~4 tasks per worker
+
+        The worker pool is shut down by `close()`, or on exiting a `with` block:
+            with LunarLander(num_envs=50) as problem:
+                ...
+        """
         n_cores = 1 if render else n_cores  # We can't render and run in parallel
         n_cores = multiprocessing.cpu_count() if n_cores is None else n_cores
         envs = np.arange(num_envs) if envs is None else envs
         lb = torch.zeros(12, dtype=dtype, device=device)
         ub = torch.ones(12, dtype=dtype, device=device)
         self.bounds = torch.stack((lb, ub), dim=0)
-        self.pool = multiprocessing.Pool(n_cores) # comment if not using MPC
+        self.n_cores = n_cores
+        self.episodes_per_task = episodes_per_task
+        self._pool = None
         self.min_reward = min_reward
         self.dim = 12
         self.n_constraints = len(envs)
@@ -558,17 +605,26 @@ class LunarLander:
         # print('ns, nx', ns, nx)
         x_tiled = np.tile(x_np, (ns, 1))
         seed_rep = np.repeat(self.envs, nx)
-        render_rep = np.repeat(self.render, ns)
+        render_rep = np.repeat(self.render, ns * nx)
 
         params = [[xi, si, ri] for xi, si, ri in zip(x_tiled, seed_rep, render_rep)]
-        rewards = np.array(
-            self.pool.map(lunar_lander_reward_Heuristic_fun, params)
-        ).reshape((-1))
-        # Alternative: evaluate sequentially so that I can parallelize the BOPE trials
-        # rewards = []
-        # for param in params:
-        #     rewards.append(lunar_lander_reward_Heuristic_fun(param))
-        # rewards = np.array(rewards).reshape((-1))
+        pool = self._get_pool()
+        if pool is not None:
+            # batch episodes per task to amortize the inter-process communication
+            episodes_per_task = self.episodes_per_task or math.ceil(
+                len(params) / (4 * self.n_cores))
+            params_batches = [
+                params[i: i + episodes_per_task]
+                for i in range(0, len(params), episodes_per_task)
+            ]
+            rewards = [
+                reward
+                for batch_rewards in pool.map(_run_lunar_lander_episodes, params_batches)
+                for reward in batch_rewards
+            ]
+        else:
+            rewards = _run_lunar_lander_episodes(params)
+        rewards = np.array(rewards).reshape((-1))
 
         # print('rewards shape: ', rewards.shape)
 
@@ -597,6 +653,40 @@ class LunarLander:
     def evaluate_true(self, x):
         return self.__call__(x)
 
+    def _get_pool(self):
+        r"""
+        Get the pool of worker processes, starting it on first use.
+        Returns None if episodes should be run serially.
+        """
+        if self.n_cores <= 1 or multiprocessing.current_process().daemon:
+            # daemonic processes (e.g., workers running BOPE trials) cannot have children
+            return None
+        if self._pool is None:
+            # spawn, so that workers do not inherit torch / OpenMP thread state
+            self._pool = multiprocessing.get_context("spawn").Pool(
+                processes=self.n_cores, initializer=_get_persistent_env
+            )
+        return self._pool
+
+    def close(self):
+        r"""Shut down the worker processes, if any."""
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __getstate__(self):
+        # the pool cannot be pickled, e.g. when sending the problem to a worker
+        state = self.__dict__.copy()
+        state["_pool"] = None
+        return state
+
 
 # util function
 
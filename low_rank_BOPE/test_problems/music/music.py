@@ -1,3 +1,4 @@
+from functools import lru_cache
 from typing import Optional, List
 
 import numpy as np
@@ -55,6 +56,31 @@ def get_combined_sine_wave(
     return torch.tensor(np.sum(waves, axis=0), dtype=torch.double)
 
 
+@lru_cache(maxsize=None)
+def get_sine_basis(
+    frequencies: tuple, 
+    duration: float, 
+    sample_rate: Optional[int] = 44100,
+) -> Tensor:
+    r"""
+    Get the matrix of unit-amplitude sine waves of the specified frequencies,
+    i.e., `get_combined_sine_wave([freq], [1], ...)` for each frequency.
+    The result is cached, so spectra of many signals can be computed with a
+    single matmul against the same basis.
+
+    Args:
+        frequencies: tuple of `n_frequencies` frequencies in hertz
+        duration: time of measurement in seconds
+        sample_rate: number of measurements per second
+    Returns:
+        `n_frequencies x duration*sample_rate` tensor of wave signals
+    """
+    t = np.linspace(0, duration, int(sample_rate*duration))
+    basis = np.sin(2*np.pi*np.array(frequencies, dtype=float)[:, None]*t)
+
+    return torch.tensor(basis, dtype=torch.double)
+
+
 class HarmonyOneKey(SyntheticTestFunction):
     r"""
     Class for simulating playing two notes together in an octave,
@@ -202,14 +228,56 @@ class Consonance(torch.nn.Module):
         self.similarity_eps = similarity_eps # TODO: make kwargs
     
     def forward(self, Y: Tensor):
+        r"""
+        Compute the consonance of a batch of signals.
 
-        res_all = []
-        for y in Y:
-            res_all.append(self.get_consonance(y))
-        
-        return torch.tensor(res_all).unsqueeze(1)
+        Args:
+            Y: `batch_shape x n_signal` tensor of sound signals
+        Returns:
+            `batch_shape x 1` tensor of consonance values
+        """
+        Y = Y.detach().to(torch.double)
+        n_signal = Y.shape[-1]
+        model_spectra = torch.as_tensor(
+            np.stack([np.asarray(spectrum) for spectrum in self.model_spectra]),
+            dtype=torch.double
+        )
+        trunc_length = model_spectra.shape[-1]
+
+        # magnitudes of the first `trunc_length` frequency bins of all signals;
+        # the real FFT gives the first `n_signal // 2 + 1` bins of the full FFT
+        if trunc_length <= n_signal // 2 + 1:
+            Yf = torch.fft.rfft(Y, dim=-1)[..., :trunc_length]
+        else:
+            Yf = torch.fft.fft(Y, dim=-1)[..., :trunc_length]
+        Yf = 2.0 / n_signal * torch.abs(Yf)
+
+        neg_log_dissonance = -torch.log(
+            torch.tensor(self.dissonance_vals, dtype=torch.double))
+
+        if self.util_type.startswith("inverse_l2"):
+            # `batch_shape x n_model_spectra` distances to all model spectra
+            spectrum_distance = torch.linalg.norm(
+                Yf.unsqueeze(-2) - model_spectra, dim=-1)
+            spectrum_similarity = 1 / (spectrum_distance + self.similarity_eps)
+
+            if self.util_type == "inverse_l2_normalized_wmean":
+                res = (
+                    spectrum_similarity / spectrum_similarity.sum(dim=-1, keepdim=True)
+                ) @ neg_log_dissonance
+            elif self.util_type == "inverse_l2_unnormalized_wmean":
+                res = spectrum_similarity @ neg_log_dissonance
+            elif self.util_type == "inverse_l2_nn":
+                res = neg_log_dissonance[torch.argmax(spectrum_similarity, dim=-1)]
+            else:
+                raise ValueError(f"Unsupported util_type {self.util_type}")
+        else:
+            raise ValueError(f"Unsupported util_type {self.util_type}")
 
+        return res.unsqueeze(-1)
 
+
+    # Reference implementation for one signal
     def get_consonance(self, y: Tensor):
 
         # transform y to an array
@@ -266,14 +334,65 @@ class NewConsonance(torch.nn.Module):
         self.sigma = sigma
     
     def forward(self, Y: Tensor):
+        r"""
+        Compute the pleasantness of a batch of signals.
 
-        res_all = []
-        for y in Y:
-            res_all.append(self.get_pleasantness(y))
-        
-        return torch.tensor(res_all).unsqueeze(1)
+        Args:
+            Y: `batch_shape x n_signal` tensor of sound signals
+        Returns:
+            `batch_shape x 1` tensor of pleasantness values
+        """
+        peaks, amps = self.get_batch_spectra_peaks(Y)
+
+        # pleasantness due to frequency difference 
+        num_keys_apart = torch.floor(
+            torch.abs(torch.log2(peaks[..., 1] / peaks[..., 0])) * 12).long()
+        cons_1 = -torch.log(
+            torch.tensor(self.dissonance_vals, dtype=torch.double)[num_keys_apart])
+
+        # pleasantness due to amplitude difference
+        cons_2 = torch.exp(-(amps[..., 0] - amps[..., 1])**2 / self.sigma**2) \
+            * torch.exp(-(220 - amps.max(dim=-1).values)**2 / self.sigma**2)
+
+        return (cons_1 * cons_2).unsqueeze(-1)
+
+
+    def get_batch_spectra_peaks(self, Y: Tensor):
+        r"""
+        Batched version of `get_spectra_peaks`: get the frequencies and
+        amplitudes of the two largest positive peaks of each signal's spectrum.
+
+        Args:
+            Y: `batch_shape x n_signal` tensor of sound signals
+        Returns:
+            peaks: `batch_shape x 2` tensor of peak frequencies
+            amps: `batch_shape x 2` tensor of peak amplitudes
+        """
+        freqs = tuple(range(420, 900))
+        basis = get_sine_basis(freqs, 0.01)
+
+        # `batch_shape x n_freqs` spectra from a single matmul
+        spec = Y.detach().to(torch.double) @ basis.transpose(-2, -1)
+
+        # peaks are (strict) local maxima of height at least 0.1,
+        # excluding the end points, as in scipy.signal.find_peaks
+        interior = spec[..., 1:-1]
+        is_peak = (interior > spec[..., :-2]) & (interior > spec[..., 2:]) \
+            & (interior >= 0.1)
+        peak_heights = torch.where(
+            is_peak, interior, torch.full_like(interior, -float("inf")))
+
+        top2_amps, top2_idx = torch.topk(peak_heights, 2, dim=-1)
+        if torch.isinf(top2_amps).any():
+            raise ValueError("Found fewer than two peaks in the spectrum of a signal.")
+
+        # same frequency offset as in get_spectra_peaks
+        top2_peaks = 440 + (top2_idx + 1).to(torch.double)
+
+        return top2_peaks, top2_amps
 
 
+    # Reference implementation for one signal
     def get_pleasantness(self, y: Tensor):
 
         # transform y to an array
@@ -1,41 +1,109 @@
-import torch
-from botorch.utils import draw_sobol_samples
-from BoRisk.test_functions.function_picker import function_picker
+r"""
+Evaluate the portfolio simulator on `n` Sobol designs and write the results to
+a memory-mapped store (see port_store.py) in DEFAULT_STORE_DIR.
+
+Usage:
+    python port_eval.py n seed [n_workers] [mini_batch_size]
+
+Mini-batches of designs are sharded across a pool of `n_workers` processes,
+each of which builds the simulator once. The parent process appends the
+results to the store as they arrive, so an interrupted run is resumed by
+re-running the same command: designs marked as done are skipped.
+"""
+
+import multiprocessing as mp
+import os
 import sys
-from math import ceil
 from time import time
 
-out_dir = ""
-n = int(sys.argv[1])  # number of samples
-seed = int(sys.argv[2])  # seed for samples
-out_file = out_dir + "port_n=%d_seed=%d" % (n, seed)
+import numpy as np
+import torch
+from botorch.utils import draw_sobol_samples
 
-bounds = torch.tensor([(0.0, 1.0) for _ in range(5)]).t()
+from port_store import DEFAULT_STORE_DIR, PortEvalStore
 
-X = draw_sobol_samples(bounds, n, 1, seed)
+_FUNCTION = None
 
-function = function_picker("portfolio", noise_std=0.0, negate=True)
 
-mini_batch_size = 5  # number of evals at once
+def _init_worker():
+    r"""Build the simulator once per worker process."""
+    global _FUNCTION
+    from BoRisk.test_functions.function_picker import function_picker
 
-# Try to read the output if exists
-try:
-    out = torch.load(out_file)
-except FileNotFoundError:
-    out = dict()
-    out["X"] = X
-    out["Y"] = torch.zeros(n, 1, 1)
+    # one thread per worker, the parallelism comes from the pool
+    torch.set_num_threads(1)
+    _FUNCTION = function_picker("portfolio", noise_std=0.0, negate=True)
 
-num_batches = ceil(n / mini_batch_size)
 
-for i in range(num_batches):
-    l_ind = i * mini_batch_size
-    r_ind = min(l_ind + mini_batch_size, n)
-    if not torch.all(out["Y"][l_ind:r_ind] == 0):
-        print("i^th mini batch is already evaluated, skipping.")
-        continue
-    print("evaluating i^th mini batch of size %d" % mini_batch_size)
+def _evaluate_mini_batch(args):
+    r"""Evaluate the simulator on a mini-batch of `k x 1 x d` designs."""
+    indices, X = args
     start = time()
-    out["Y"][l_ind:r_ind] = function(X[l_ind:r_ind])
-    torch.save(out, out_file)
-    print("finished i^th mini batch in %s" % (time() - start))
+    Y = _FUNCTION(torch.from_numpy(X))
+    return indices, Y.reshape(-1, 1).numpy(), time() - start
+
+
+def run_port_evals(
+    n: int,
+    seed: int,
+    n_workers: int = 1,
+    mini_batch_size: int = 5,
+    out_dir: str = DEFAULT_STORE_DIR,
+) -> PortEvalStore:
+    r"""
+    Evaluate the portfolio simulator on `n` Sobol designs, resuming from the
+    store `port_store_n={n}_seed={seed}` in `out_dir` if it exists.
+
+    Args:
+        n: number of designs
+        seed: seed for drawing the Sobol designs
+        n_workers: number of worker processes
+        mini_batch_size: number of designs evaluated at once by a worker
+        out_dir: directory of the store, see port_store.py; pass the store
+            to load_port_evals() to use its evaluations in the surrogates
+    Returns:
+        the store
+    """
+    store_dir = os.path.join(out_dir, "port_store_n=%d_seed=%d" % (n, seed))
+    if PortEvalStore.exists(store_dir):
+        store = PortEvalStore(store_dir)
+    else:
+        bounds = torch.tensor([(0.0, 1.0) for _ in range(5)]).t()
+        X = draw_sobol_samples(bounds, n, 1, seed=seed)
+        store = PortEvalStore.create(store_dir, X.squeeze(-2), seed=seed)
+
+    pending = store.pending_indices()
+    print("%d of %d designs already evaluated" % (n - len(pending), n))
+    mini_batches = [
+        (indices, np.array(store.X[indices])[:, None, :])
+        for indices in np.array_split(
+            pending, max(1, int(np.ceil(len(pending) / mini_batch_size))))
+        if len(indices) > 0
+    ]
+
+    if n_workers > 1:
+        ctx = mp.get_context("spawn")
+        with ctx.Pool(n_workers, initializer=_init_worker) as pool:
+            for indices, Y, eval_time in pool.imap_unordered(
+                _evaluate_mini_batch, mini_batches
+            ):
+                store.write(indices, Y)
+                print("finished mini batch of size %d in %s" % (len(indices), eval_time))
+    else:
+        _init_worker()
+        for mini_batch in mini_batches:
+            indices, Y, eval_time = _evaluate_mini_batch(mini_batch)
+            store.write(indices, Y)
+            print("finished mini batch of size %d in %s" % (len(indices), eval_time))
+
+    print("%d of %d designs evaluated" % (store.num_done(), n))
+    return store
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1])  # number of samples
+    seed = int(sys.argv[2])  # seed for samples
+    n_workers = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+    mini_batch_size = int(sys.argv[4]) if len(sys.argv) > 4 else 5
+
+    run_port_evals(n, seed, n_workers=n_workers, mini_batch_size=mini_batch_size)
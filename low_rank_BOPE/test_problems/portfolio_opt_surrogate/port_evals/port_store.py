@@ -0,0 +1,237 @@
+r"""
+Memory-mapped store for the portfolio simulator evaluations used to fit the
+portfolio surrogates.
+
+A store is a directory holding
+    X.npy: `n x d` designs
+    Y.npy: `n x 1` simulator outputs
+    done.npy: `n` completion bitmap, `done[i]` is True iff `Y[i]` is final
+    meta.json: sizes and provenance of the designs
+The arrays are .npy files opened with `mmap_mode`, so that results can be
+written as they arrive and read back without loading every shard. Stores are
+kept in DEFAULT_STORE_DIR (set with the LOW_RANK_BOPE_PORT_STORE_DIR
+environment variable), outside of the package source.
+
+Unlike the legacy `port_n=100_seed=*` files, which used `Y == 0` to mark
+missing evaluations, completion is recorded explicitly: `Y` is flushed to disk
+before the corresponding bits are set, so an interrupted run never marks an
+unfinished evaluation as done.
+"""
+
+import json
+import os
+from typing import Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+from torch import Tensor
+
+# directory of the legacy `port_n=100_seed=*` files
+port_evals_dir = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_STORE_DIR = os.environ.get(
+    "LOW_RANK_BOPE_PORT_STORE_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "low_rank_BOPE", "port_stores"),
+)
+
+LEGACY_STORE_NAME = "port_store_legacy"
+LEGACY_FILE_TEMPLATE = "port_n=100_seed=%d"
+LEGACY_SEEDS = range(1, 31)
+
+
+class PortEvalStore:
+    r"""
+    Chunked, memory-mapped store of (X, Y) portfolio evaluations with an
+    explicit completion bitmap. Only one process should write to a store at a
+    time; the evaluation workers send their results back to the writer.
+    """
+
+    def __init__(self, store_dir: str, mode: str = "r+"):
+        r"""
+        Open an existing store.
+
+        Args:
+            store_dir: directory of the store
+            mode: "r" for read-only or "r+" for read-write access
+        """
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.X = np.load(os.path.join(store_dir, "X.npy"), mmap_mode=mode)
+        self.Y = np.load(os.path.join(store_dir, "Y.npy"), mmap_mode=mode)
+        self.done = np.load(os.path.join(store_dir, "done.npy"), mmap_mode=mode)
+
+    @classmethod
+    def create(
+        cls,
+        store_dir: str,
+        X: Tensor,
+        dtype: np.dtype = np.float32,
+        **meta,
+    ) -> "PortEvalStore":
+        r"""
+        Create a store for the designs `X`, with no evaluation completed.
+
+        Args:
+            store_dir: directory of the store, created if it does not exist
+            X: `n x d` tensor of designs
+            dtype: dtype of the stored designs and outputs
+            meta: additional json-serializable provenance, e.g. the Sobol seed
+        Returns:
+            the store, opened for writing
+        """
+        os.makedirs(store_dir, exist_ok=True)
+        n, d = X.shape
+        X_mmap = np.lib.format.open_memmap(
+            os.path.join(store_dir, "X.npy"), mode="w+", dtype=dtype, shape=(n, d))
+        X_mmap[:] = X.detach().cpu().numpy()
+        X_mmap.flush()
+        np.lib.format.open_memmap(
+            os.path.join(store_dir, "Y.npy"), mode="w+", dtype=dtype, shape=(n, 1)
+        ).flush()
+        np.lib.format.open_memmap(
+            os.path.join(store_dir, "done.npy"), mode="w+", dtype=np.bool_, shape=(n,)
+        ).flush()
+        # meta.json is written last: a store without it is incomplete
+        meta.update({"n": n, "d": d, "dtype": np.dtype(dtype).name})
+        with open(os.path.join(store_dir, "meta.json"), "w") as f:
+            json.dump(meta, f)
+        return cls(store_dir)
+
+    @staticmethod
+    def exists(store_dir: str) -> bool:
+        return os.path.exists(os.path.join(store_dir, "meta.json"))
+
+    def __len__(self):
+        return self.X.shape[0]
+
+    def num_done(self) -> int:
+        return int(self.done.sum())
+
+    def pending_indices(self) -> np.ndarray:
+        r"""Indices of the designs that have not been evaluated yet."""
+        return np.flatnonzero(~self.done)
+
+    def write(self, indices: np.ndarray, Y: np.ndarray):
+        r"""
+        Record the outputs of the designs at `indices` and mark them as done.
+
+        Args:
+            indices: `k` indices of the evaluated designs
+            Y: `k x 1` (or `k`) array of simulator outputs
+        """
+        self.Y[indices] = np.asarray(Y, dtype=self.Y.dtype).reshape(-1, 1)
+        self.Y.flush()
+        self.done[indices] = True
+        self.done.flush()
+
+    def load(self) -> Tuple[np.ndarray, np.ndarray]:
+        r"""
+        Completed evaluations, as views of the memory map when every design
+        is done, else as copies of the completed rows.
+
+        Returns:
+            X: `n_done x d` array of designs
+            Y: `n_done x 1` array of simulator outputs
+        """
+        if self.done.all():
+            return self.X, self.Y
+        return self.X[self.done], self.Y[self.done]
+
+
+def _load_legacy_port_evals(data_dir: str) -> Tuple[Tensor, Tensor]:
+    r"""Concatenate the legacy `port_n=100_seed=*` files in seed order."""
+    data_list = [
+        torch.load(os.path.join(data_dir, LEGACY_FILE_TEMPLATE % seed))
+        for seed in LEGACY_SEEDS
+    ]
+    X = torch.cat([data["X"] for data in data_list], dim=0).squeeze(-2)
+    Y = torch.cat([data["Y"] for data in data_list], dim=0).squeeze(-2)
+    return X, Y
+
+
+def migrate_legacy_port_evals(
+    data_dir: str = port_evals_dir, store_dir: Optional[str] = None
+) -> PortEvalStore:
+    r"""
+    Copy the legacy `port_n=100_seed=*` files into a single store, in seed
+    order. Evaluations stored as exact zeros are treated as not done, as in
+    the legacy evaluation script.
+
+    Args:
+        data_dir: directory of the legacy files
+        store_dir: directory of the store, defaults to
+            `DEFAULT_STORE_DIR/port_store_legacy`
+    Returns:
+        the store
+    """
+    if store_dir is None:
+        store_dir = os.path.join(DEFAULT_STORE_DIR, LEGACY_STORE_NAME)
+    X, Y = _load_legacy_port_evals(data_dir)
+    is_done = (Y != 0).any(dim=-1)
+
+    # write into a temporary directory and rename it, so that concurrent
+    # readers see either no store or a complete one
+    os.makedirs(os.path.dirname(os.path.abspath(store_dir)), exist_ok=True)
+    tmp_dir = "%s.tmp.%d" % (store_dir, os.getpid())
+    store = PortEvalStore.create(
+        tmp_dir, X, sobol_seeds=list(LEGACY_SEEDS), n_per_seed=100)
+    store.write(np.flatnonzero(is_done.numpy()), Y[is_done].numpy())
+    del store
+    try:
+        os.rename(tmp_dir, store_dir)
+    except OSError:
+        # another process migrated the files first
+        for name in os.listdir(tmp_dir):
+            os.remove(os.path.join(tmp_dir, name))
+        os.rmdir(tmp_dir)
+    return PortEvalStore(store_dir, mode="r")
+
+
+def load_port_evals(
+    store_dirs: Sequence[str] = (),
+    data_dir: str = port_evals_dir,
+    legacy_store_dir: Optional[str] = None,
+    dtype: torch.dtype = torch.float32,
+) -> Tuple[Tensor, Tensor]:
+    r"""
+    Load the completed portfolio evaluations of the legacy
+    `port_n=100_seed=*` files, followed by those of the given stores, as one
+    training set for the portfolio surrogates. The legacy files are migrated
+    to a store on first use; if that is not possible (e.g., the store
+    directory is read-only), they are read directly.
+
+    Args:
+        store_dirs: directories of additional stores, e.g. written by
+            `port_eval.py`, loaded in the given order
+        data_dir: directory of the legacy files, defaults to `port_evals/`
+        legacy_store_dir: directory of the migrated legacy store, defaults to
+            `DEFAULT_STORE_DIR/port_store_legacy`
+        dtype: dtype of the returned tensors
+    Returns:
+        X: `n x 5` tensor of designs
+        Y: `n x 1` tensor of simulator outputs
+    """
+    if legacy_store_dir is None:
+        legacy_store_dir = os.path.join(DEFAULT_STORE_DIR, LEGACY_STORE_NAME)
+
+    if PortEvalStore.exists(legacy_store_dir):
+        X_legacy, Y_legacy = PortEvalStore(legacy_store_dir, mode="r").load()
+    else:
+        try:
+            X_legacy, Y_legacy = migrate_legacy_port_evals(
+                data_dir, legacy_store_dir).load()
+        except OSError:
+            X_legacy, Y_legacy = (
+                data.numpy() for data in _load_legacy_port_evals(data_dir))
+
+    X_list, Y_list = [X_legacy], [Y_legacy]
+    for store_dir in store_dirs:
+        X_store, Y_store = PortEvalStore(store_dir, mode="r").load()
+        X_list.append(X_store)
+        Y_list.append(Y_store)
+
+    # a single copy out of the memory maps
+    X = torch.from_numpy(np.concatenate(X_list, axis=0))
+    Y = torch.from_numpy(np.concatenate(Y_list, axis=0))
+    return X.to(dtype), Y.to(dtype)
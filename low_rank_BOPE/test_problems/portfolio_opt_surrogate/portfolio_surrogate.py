@@ -14,10 +14,19 @@ from botorch.models.transforms import Standardize
 from botorch.test_functions.synthetic import SyntheticTestFunction
 from gpytorch import ExactMarginalLogLikelihood
 from gpytorch.constraints import GreaterThan
+from gpytorch.kernels import MaternKernel, ScaleKernel
 from gpytorch.likelihoods import GaussianLikelihood
+from gpytorch.means import ConstantMean
 from gpytorch.priors import GammaPrior
 from torch import Tensor
 
+try:
+    from low_rank_BOPE.test_problems.portfolio_opt_surrogate.port_evals.port_store import \
+        load_port_evals
+except ImportError:
+    # imported from within this directory, e.g. by portfolio_surrogate_test.py
+    from port_evals.port_store import load_port_evals
+
 script_dir = os.path.dirname(os.path.abspath(__file__))
 
 
@@ -68,12 +77,16 @@ class DistributionalPortfolioSurrogate(SyntheticTestFunction):
         # self.w_samples = w_samples_dict[w_distribution]
         self.w_samples = generate_w_samples(bounds=w_bounds, n=n_w_samples, distribution=w_distribution)
         self.outcome_dim = n_w_samples
+        # number of designs whose outcomes are computed at a time
+        self.design_chunk_size = 8
+        self._mean_cache = None
         print('self.w_samples.shape', self.w_samples.shape)
 
     def evaluate_true_one_design(self, x: Tensor) -> Tensor:
         """
         Evaluates the expected return of one design,
         over the distribution of environmental variables w.
+        This is the (slow) reference implementation of `evaluate_true`.
         x: one design, shape 1x3
         """
         if self.model is not None:
@@ -92,15 +105,120 @@ class DistributionalPortfolioSurrogate(SyntheticTestFunction):
 
     def evaluate_true(self, X: Tensor) -> Tensor:
         """
-        X: tensor of designs to evaluate; X.shape[-1]=3
+        Evaluates all designs in X over the same w samples at once.
+        X: `batch_shape x 3` tensor of designs to evaluate
+        Returns: `batch_shape x n_w_samples` tensor of posterior means
+        """
+        if self.model is None:
+            self.fit_model()
+
+        X_flat = X.reshape(-1, X.shape[-1]).to(dtype=torch.double, device="cpu")
+        mean_cache = self._get_mean_cache()
+
+        results = []
+        for X_chunk in torch.split(X_flat, self.design_chunk_size):
+            if mean_cache is not None:
+                results.append(self._cached_posterior_mean(X_chunk, mean_cache))
+            else:
+                results.append(self._grid_posterior_mean(X_chunk))
+
+        return torch.cat(results, dim=0).to(X).reshape(
+            *X.shape[:-1], self.outcome_dim)
+
+    def _grid_posterior_mean(self, X: Tensor) -> Tensor:
+        """
+        Posterior mean over the `(n_designs * n_w) x 5` grid of all
+        (design, w) pairs, from a single posterior call.
+        X: `n_designs x 3` tensor of designs
+        Returns: `n_designs x n_w_samples` tensor
         """
+        n_designs, n_w = X.shape[0], self.w_samples.shape[0]
+        x_w = torch.cat(
+            (
+                X.unsqueeze(-2).expand(n_designs, n_w, X.shape[-1]),
+                self.w_samples.to(X).expand(n_designs, n_w, self.w_samples.shape[-1]),
+            ),
+            dim=-1
+        ).reshape(n_designs * n_w, -1)
+        with torch.no_grad(), gpytorch.settings.max_cg_iterations(10000), \
+                gpytorch.settings.fast_pred_var():
+            posterior_mean = self.model.posterior(x_w).mean
 
-        results = torch.Tensor()
-        for x in X:
-            results = torch.cat(
-                (results, self.evaluate_true_one_design(x)), dim=0)
+        return posterior_mean.reshape(n_designs, n_w)
 
-        return results
+    def _get_mean_cache(self):
+        """
+        Precompute the parts of the posterior mean that do not depend on the
+        designs: the GP's `alpha = (K + noise I)^{-1} (y - m)` and the scaled
+        squared distances between the w samples and the w part of the
+        training inputs. Returns None if the model is not the SingleTaskGP
+        (constant mean, scaled Matern-5/2 kernel, standardized outcome)
+        this shortcut is written for.
+        """
+        if self._mean_cache is not None:
+            return self._mean_cache
+
+        model = self.model
+        covar_module = model.covar_module
+        if not (
+            isinstance(model, SingleTaskGP)
+            and isinstance(model.mean_module, ConstantMean)
+            and isinstance(covar_module, ScaleKernel)
+            and isinstance(covar_module.base_kernel, MaternKernel)
+            and covar_module.base_kernel.nu == 2.5
+            and covar_module.base_kernel.active_dims is None
+            and getattr(model, "input_transform", None) is None
+            and isinstance(getattr(model, "outcome_transform", None), Standardize)
+        ):
+            return None
+
+        model.eval()
+        train_X = model.train_inputs[0]
+        with torch.no_grad(), gpytorch.settings.max_cg_iterations(10000):
+            # populates the prediction strategy and its mean cache
+            model.posterior(train_X[:1])
+            alpha = model.prediction_strategy.mean_cache.detach()
+
+            lengthscale = covar_module.base_kernel.lengthscale.detach().reshape(-1)
+            d_x = train_X.shape[-1] - self.w_samples.shape[-1]
+            train_X_scaled = train_X / lengthscale
+            w_scaled = self.w_samples.to(train_X) / lengthscale[d_x:]
+            # `n_w x n_train` squared distances in the w dimensions
+            sq_dist_w = torch.cdist(w_scaled, train_X_scaled[:, d_x:]) ** 2
+
+        self._mean_cache = {
+            "alpha": alpha,
+            "train_X_scaled": train_X_scaled[:, :d_x],
+            "lengthscale": lengthscale[:d_x],
+            "sq_dist_w": sq_dist_w,
+            "constant": model.mean_module.constant.detach(),
+            "outputscale": covar_module.outputscale.detach(),
+            "Y_mean": model.outcome_transform.means.detach().reshape(-1),
+            "Y_std": model.outcome_transform.stdvs.detach().reshape(-1),
+        }
+        return self._mean_cache
+
+    def _cached_posterior_mean(self, X: Tensor, mean_cache: dict) -> Tensor:
+        """
+        Posterior mean over the grid of all (design, w) pairs as
+        `m + k(x_w, X_train) alpha`, computing the Matern-5/2 kernel from the
+        precomputed w distances, followed by un-standardization.
+        X: `n_designs x 3` tensor of designs
+        Returns: `n_designs x n_w_samples` tensor
+        """
+        sq_dist_x = torch.cdist(
+            X / mean_cache["lengthscale"], mean_cache["train_X_scaled"]) ** 2
+        # `n_designs x n_w x n_train` tensor of sqrt(5) * distance; the kernel
+        # is computed in place as these tensors are large
+        dist = (sq_dist_x.unsqueeze(-2) + mean_cache["sq_dist_w"]).clamp_min_(1e-30)
+        dist.sqrt_().mul_(math.sqrt(5))
+        # (1 + sqrt(5) r + 5/3 r^2) exp(-sqrt(5) r)
+        covar = torch.exp(-dist)
+        covar.mul_(dist.pow(2).div_(3).add_(dist).add_(1))
+        mean = mean_cache["constant"] \
+            + mean_cache["outputscale"] * (covar @ mean_cache["alpha"])
+
+        return mean * mean_cache["Y_std"] + mean_cache["Y_mean"]
 
     def fit_model(self):
         """
@@ -108,19 +226,7 @@ class DistributionalPortfolioSurrogate(SyntheticTestFunction):
         Otherwise, constructs the model but uses the fit given by the state_dict.
         """
         # read the data
-        data_list = list()
-        for i in range(1, 31):
-            data_file = os.path.join(
-                script_dir, "port_evals", "port_n=100_seed=%d" % i)
-            data_list.append(torch.load(data_file))
-
-        # join the data together
-        X = torch.cat(
-            [data_list[i]["X"] for i in range(len(data_list))], dim=0
-        ).squeeze(-2)
-        Y = torch.cat(
-            [data_list[i]["Y"] for i in range(len(data_list))], dim=0
-        ).squeeze(-2)
+        X, Y = load_port_evals()
 
         # fit GP
         noise_prior = GammaPrior(1.1, 0.5)
@@ -158,6 +264,7 @@ class DistributionalPortfolioSurrogate(SyntheticTestFunction):
             )
         self.model = model
         self.model.to(torch.double)
+        self._mean_cache = None
 
 
 # next TODO: utility function
@@ -215,19 +322,7 @@ class PortfolioSurrogate(SyntheticTestFunction):
         Otherwise, constructs the model but uses the fit given by the state_dict.
         """
         # read the data
-        data_list = list()
-        for i in range(1, 31):
-            data_file = os.path.join(
-                script_dir, "port_evals", "port_n=100_seed=%d" % i)
-            data_list.append(torch.load(data_file))
-
-        # join the data together
-        X = torch.cat(
-            [data_list[i]["X"] for i in range(len(data_list))], dim=0
-        ).squeeze(-2)
-        Y = torch.cat(
-            [data_list[i]["Y"] for i in range(len(data_list))], dim=0
-        ).squeeze(-2)
+        X, Y = load_port_evals()
 
         # fit GP
         noise_prior = GammaPrior(1.1, 0.5)
@@ -1,6 +1,7 @@
 import copy
 
-import io
+import multiprocessing
+import os
 import sys
 sys.path.append('/home/yz685/low_rank_BOPE/low_rank_BOPE')
 sys.path.append("/home/yz685/low_rank_BOPE/low_rank_BOPE/aux_software/spot_mini_mini")
@@ -35,6 +36,15 @@ class spotBezierEnv2(spotBezierEnv):
         return observations, reward, done, False, info
 
 
+def make_spot_env():
+    r"""Build a spot mini mini environment."""
+    return spotBezierEnv2(
+        render=False,
+        env_randomizer=SpotEnvRandomizer(),
+        control_time_step=0.0,
+    )
+
+
 def spot_mini_mini_trajectory(
     SwingPeriod: float = 0.2,
     StepVelocity: float = 0.001,
@@ -46,13 +56,17 @@ def spot_mini_mini_trajectory(
     record: bool = False,
     results_path: str = None,
     name_prefix: str = "spot",
-    seed: int = 1000
+    seed: int = 1000,
+    env: Optional[spotBezierEnv2] = None,
 ):
     r"""
     Run one trajectory of a spot mini mini robot (?)
 
     Args:
-
+        env: optional environment to run the episode in. It is reset (with
+            the same seeds) at the start of the episode and left open, so it
+            can be reused across episodes. If None, a new environment is
+            built and closed after the episode.
     Returns:
     """
     seed = seed
@@ -63,11 +77,9 @@ def spot_mini_mini_trajectory(
     yaw = 0.0
     orn = [roll, pitch, yaw]
 
-    env = spotBezierEnv2(
-        render=False,
-        env_randomizer=SpotEnvRandomizer(),
-        control_time_step=0.0,
-    )
+    close_env = env is None
+    if env is None:
+        env = make_spot_env()
     dt = float(env._time_step)
     if record:
         assert results_path is not None
@@ -128,11 +140,37 @@ def spot_mini_mini_trajectory(
         if t % record_pos_every_n == 0:
             pos_trajectory.append(env.spot.GetBasePosition())
         t += 1
-    env.close()
+    if close_env:
+        env.close()
 
     # a list of tuples (x,y,z) indicating the position of the robot's centroid
     return pos_trajectory 
 
+# environment reused across the episodes run in this process
+_PERSISTENT_ENV = None
+
+
+def _get_persistent_env():
+    global _PERSISTENT_ENV
+    if _PERSISTENT_ENV is None:
+        _PERSISTENT_ENV = make_spot_env()
+    return _PERSISTENT_ENV
+
+
+def _init_worker():
+    r"""
+    Pool initializer: silence the simulator's print out in this worker
+    process and build its persistent environment. The caller's stdout is left
+    alone, episodes run serially in the caller's process print as usual.
+    """
+    sys.stdout = open(os.devnull, "w")
+    _get_persistent_env()
+
+
+def _run_spot_episode(kwargs: dict):
+    r"""Run one episode in this process's persistent environment."""
+    return spot_mini_mini_trajectory(env=_get_persistent_env(), **kwargs)
+
 #################################################################################
 #################################################################################
 
@@ -158,6 +196,7 @@ class SpotMiniMiniProblem(BaseTestProblem):
         record_pos_every_n: int = 5,
         noise_std: Optional[float] = None,
         negate: bool = False,
+        n_workers: int = 1,
     ):
         r"""
         Initialize the problem class. 
@@ -173,6 +212,10 @@ class SpotMiniMiniProblem(BaseTestProblem):
             record_pos_every_n: record the position every n timesteps
             noise_std: standard deviation of the noise to add to the objective
             negate: whether to negate the objective (if true, maximize) 
+            n_workers: number of worker processes to run episodes in; each
+                worker keeps its own environment and resets it between
+                episodes. If 1 (or if this is already running inside a
+                worker process), episodes are run serially in this process.
         """
         self.dim=dim
         if dim > 5: 
@@ -183,6 +226,8 @@ class SpotMiniMiniProblem(BaseTestProblem):
         self.max_timesteps = max_timesteps
         self.record_pos_every_n = record_pos_every_n
         self.outcome_dim = max_timesteps // record_pos_every_n * 3
+        self.n_workers = n_workers
+        self._pool = None
 
     def evaluate_true(self, X: Tensor) -> Tensor:
         r"""
@@ -193,30 +238,65 @@ class SpotMiniMiniProblem(BaseTestProblem):
             trajectories: `num_samples x self.outcome_dim` tensor
         """
         print("Evaluating ...")
-        trajectories = []
-        save_stdout = sys.stdout
-        sys.stdout = io.StringIO()  # suppress print out
 
         X_ = self._unstandardize_X(X, bounds = self.original_bounds[:, :self.dim].clone().detach())
 
-        for i, X_i in enumerate(X_):
-            kwargs = {self.param_names[j]: p for j, p in enumerate(X_i)}
-            # list of (x,y,z) tuples, length = max_timesteps // record_pos_every_n
-            trajectory = spot_mini_mini_trajectory(
-                max_timesteps=self.max_timesteps,
-                record_pos_every_n=self.record_pos_every_n,
-                **kwargs
-            )
-            # after flattening it should look like [x1,x2,...,y1,y2,...,z1,z2,...]
-            flat_single_trajectory = torch.transpose(
+        episode_kwargs = [
+            {
+                "max_timesteps": self.max_timesteps,
+                "record_pos_every_n": self.record_pos_every_n,
+                **{self.param_names[j]: p.item() for j, p in enumerate(X_i)}
+            }
+            for X_i in X_
+        ]
+        pool = self._get_pool()
+        if pool is not None:
+            trajectories = pool.map(_run_spot_episode, episode_kwargs)
+        else:
+            trajectories = [_run_spot_episode(kwargs) for kwargs in episode_kwargs]
+
+        # list of (x,y,z) tuples, length = max_timesteps // record_pos_every_n
+        # after flattening it should look like [x1,x2,...,y1,y2,...,z1,z2,...]
+        trajectories = torch.stack([
+            torch.transpose(
                 torch.tensor(trajectory, dtype=X.dtype), -2, -1).flatten()
-            trajectories.append(flat_single_trajectory)
+            for trajectory in trajectories
+        ])
+
+        return trajectories
 
-        sys.stdout = save_stdout  # restore print out
+    def _get_pool(self):
+        r"""
+        Get the pool of worker processes, starting it on first use.
+        Returns None if episodes should be run serially.
+        """
+        if self.n_workers <= 1 or multiprocessing.current_process().daemon:
+            # daemonic processes (e.g., BopeExperiment workers) cannot have children
+            return None
+        if self._pool is None:
+            self._pool = multiprocessing.get_context("spawn").Pool(
+                processes=self.n_workers, initializer=_init_worker
+            )
+        return self._pool
 
-        trajectories = torch.stack(trajectories)
+    def close(self):
+        r"""Shut down the worker processes, if any."""
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
 
-        return trajectories
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __getstate__(self):
+        # the pool cannot be pickled, e.g. when sending the problem to a worker
+        state = self.__dict__.copy()
+        state["_pool"] = None
+        return state
 
     def _unstandardize_X(self, X, bounds):
             
@@ -260,16 +340,26 @@ class RobotUtil(torch.nn.Module):
     def forward(self, Y: Tensor):
         r"""
         Args:
-            Y: `num_samples x outcome_dim` tensor of outcomes
+            Y: `batch_shape x outcome_dim` tensor of outcomes
+        Returns:
+            `batch_shape x 1` tensor of utilities, differentiable w.r.t. Y
         """
 
-        res = []
-        for y in Y:
-            res.append(self.compute_util_one_outcome(y))
+        # deconstruct into x,y,z time series
+        n_steps = Y.shape[-1] // 3
+        x_vec = Y[..., :n_steps]
+        y_vec = Y[..., n_steps:2*n_steps]
+        z_vec = Y[..., 2*n_steps:]
 
-        return torch.tensor(res).unsqueeze(1)
+        util = (x_vec[..., -1] - x_vec[..., 0]) + \
+            self.y_drift_penalty * torch.abs(y_vec[..., -1] - y_vec[..., 0]) + \
+            self.y_var_penalty * torch.std(y_vec, dim=-1, unbiased=False) + \
+            self.final_z_reward * z_vec[..., -1] + \
+            self.z_var_penalty * torch.std(z_vec, dim=-1, unbiased=False)
 
+        return util.unsqueeze(-1)
 
+    # Reference implementation for one outcome
     def compute_util_one_outcome(self, y: Tensor):
         r"""
         Args:
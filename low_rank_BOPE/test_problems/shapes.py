@@ -7,6 +7,29 @@ from torch import Tensor
 
 # outcome function
 
+def _pixel_range_mask(X_ends: Tensor, num_pixels: int) -> Tensor:
+    r"""
+    Compute which rows (or columns) of pixels lie between two end points.
+
+    Args:
+        X_ends: `batch_shape x 2` tensor of end points in [0, 1], in any order
+        num_pixels: number of pixels along the axis
+    Returns:
+        `batch_shape x num_pixels` boolean tensor, True for the pixels from
+            the pixel containing the smaller end point to the pixel containing
+            the larger one (inclusive)
+    """
+    # map real values in X to integer indices of pixels
+    pixel_idcs = torch.div(
+        X_ends.detach().to(torch.double), 1 / num_pixels, rounding_mode="floor"
+    ).clamp(max=num_pixels - 1)
+    start = pixel_idcs.min(dim=-1, keepdim=True).values
+    end = pixel_idcs.max(dim=-1, keepdim=True).values
+
+    pixels = torch.arange(num_pixels, dtype=torch.double, device=X_ends.device)
+    return (pixels >= start) & (pixels <= end)
+
+
 class Image(SyntheticTestFunction):
     r"""
     Class for generating rectangle images
@@ -30,33 +53,18 @@ class Image(SyntheticTestFunction):
     def evaluate_true(self, X):
         r"""
         Args:
-            X: 4-dimensional input
+            X: `batch_shape x 4` tensor of (row_start, col_start, row_end, col_end)
         Returns:
-            Y: (num_pixels^2)-dimensional array representing the images
+            Y: `batch_shape x num_pixels^2` tensor representing the images
         """
 
-        # map real values in X to integer indices of pixels
-        pixel_idcs = torch.div(X, self.pixel_size, rounding_mode="floor")
-
-        Y = torch.zeros((*X.shape[:-1], self.num_pixels**2))
-
-        for sample_idx in range(X.shape[-2]):
-
-            row_start, col_start, row_end, col_end = pixel_idcs[sample_idx].numpy().astype(int)
+        row_mask = _pixel_range_mask(X[..., [0, 2]], self.num_pixels)
+        col_mask = _pixel_range_mask(X[..., [1, 3]], self.num_pixels)
 
-            # swap if needed
-            if row_start > row_end:
-                row_start, row_end = row_end, row_start
-            if col_start > col_end:
-                col_start, col_end = col_end, col_start
-            
-            paint_it_black = [self.num_pixels * r + c \
-                    for r in range(min(row_start, self.num_pixels-1), min(row_end+1, self.num_pixels)) \
-                    for c in range(min(col_start, self.num_pixels-1), min(col_end+1, self.num_pixels))]
-            
-            Y[sample_idx, paint_it_black] = torch.ones(1, len(paint_it_black))
+        # paint pixel (r, c) black iff both row r and column c are covered
+        Y = row_mask.unsqueeze(-1) & col_mask.unsqueeze(-2)
 
-        return Y.to(torch.double)
+        return Y.reshape(*X.shape[:-1], self.num_pixels**2).to(torch.double)
 
 
 class Bars(SyntheticTestFunction):
@@ -82,31 +90,17 @@ class Bars(SyntheticTestFunction):
     def evaluate_true(self, X):
         r"""
         Args:
-            X: 4-dimensional input
+            X: `batch_shape x 2` tensor of the start and end of the rows
         Returns:
-            Y: (num_pixels^2)-dimensional array representing the images
+            Y: `batch_shape x num_pixels^2` tensor representing the images
         """
 
-        # map real values in X to integer indices of pixels
-        pixel_idcs = torch.div(X, self.pixel_size, rounding_mode="floor")
+        row_mask = _pixel_range_mask(X[..., :2], self.num_pixels)
 
-        Y = torch.zeros((*X.shape[:-1], self.num_pixels**2))
+        # paint all columns of the covered rows black
+        Y = row_mask.unsqueeze(-1).expand(*row_mask.shape, self.num_pixels)
 
-        for sample_idx in range(X.shape[-2]):
-
-            row_start, row_end = pixel_idcs[sample_idx].numpy().astype(int)
-
-            # swap if needed
-            if row_start > row_end:
-                row_start, row_end = row_end, row_start
-            
-            paint_it_black = [self.num_pixels * r + c \
-                    for r in range(min(row_start, self.num_pixels-1), min(row_end+1, self.num_pixels)) \
-                    for c in range(self.num_pixels)]
-            
-            Y[sample_idx, paint_it_black] = torch.ones(1, len(paint_it_black))
-
-        return Y.to(torch.double)
+        return Y.reshape(*X.shape[:-1], self.num_pixels**2).to(torch.double)
 
 
 # utility functions
@@ -206,6 +200,7 @@ class LargestRectangleUtil(torch.nn.Module):
         return maxarea
 
 
+    # Reference implementation for one image; see batched_maximal_rectangle
     def maximalRectangle(self, matrix: Tensor) -> int:
 
         if torch.sum(matrix).item() == 0:
@@ -226,18 +221,72 @@ class LargestRectangleUtil(torch.nn.Module):
         return maxarea
     
     def forward(self, Y: Tensor):
-        Y_bin = (Y > 0.5).float() # num_samples x outcome_dim
-        # then need to un-flatten outcome vector into image
-
+        r"""
+        Args:
+            Y: `batch_shape x outcome_dim` tensor of flattened images
+        Returns:
+            `batch_shape x 1` tensor of the areas of the largest all-ones
+                rectangles in the binarized images
+        """
         if self.image_shape is None:
-            num_pixels = np.sqrt(Y.shape[-1])
-            self.image_shape = (num_pixels, num_pixels)
+            num_pixels = int(round(np.sqrt(Y.shape[-1])))
+            image_shape = (num_pixels, num_pixels)
+        else:
+            image_shape = tuple(int(n) for n in self.image_shape)
 
-        result = []
-        for y_bin in Y_bin:
-            result.append(self.maximalRectangle(torch.reshape(y_bin, self.image_shape)))
-        
-        return torch.tensor(result).unsqueeze(1) # TODO: check correctness
+        Y_bin = (Y.detach() > 0.5).reshape(*Y.shape[:-1], *image_shape)
+
+        return batched_maximal_rectangle(Y_bin).unsqueeze(-1)
+
+
+def consecutive_ones_heights(matrix: Tensor) -> Tensor:
+    r"""
+    For each pixel, count the number of consecutive ones ending at it
+    in its column, i.e., the histograms used by `maximalRectangle`.
+
+    Args:
+        matrix: `batch_shape x nrows x ncols` binary tensor
+    Returns:
+        `batch_shape x nrows x ncols` long tensor of histogram heights
+    """
+    nrows = matrix.shape[-2]
+    row_idcs = torch.arange(nrows, device=matrix.device).unsqueeze(-1)
+    # index of the last zero at or above each pixel (-1 if there is none)
+    zero_idcs = torch.where(
+        matrix.bool(), torch.full_like(row_idcs, -1), row_idcs
+    ).expand(matrix.shape)
+    last_zero = torch.cummax(zero_idcs, dim=-2).values
+
+    return row_idcs - last_zero
+
+
+def batched_maximal_rectangle(matrix: Tensor) -> Tensor:
+    r"""
+    Compute the area of the largest all-ones rectangle in a batch of binary
+    images, without Python loops over images or pixels.
+
+    The row histograms are computed with `consecutive_ones_heights`. The
+    largest rectangle over a histogram starting at column l and ending at
+    column r has area (r - l + 1) * min(heights[l:r+1]), so looping over the
+    left column l with a cumulative minimum over the columns to its right
+    evaluates all rectangles in O(ncols) tensor operations.
+
+    Args:
+        matrix: `batch_shape x nrows x ncols` binary tensor
+    Returns:
+        `batch_shape` long tensor of maximal rectangle areas
+    """
+    heights = consecutive_ones_heights(matrix)
+    ncols = heights.shape[-1]
+
+    maxarea = torch.zeros(heights.shape[:-2], dtype=torch.long, device=matrix.device)
+    for left in range(ncols):
+        min_heights = torch.cummin(heights[..., left:], dim=-1).values
+        widths = torch.arange(1, ncols - left + 1, device=matrix.device)
+        areas = (min_heights * widths).amax(dim=(-2, -1))
+        maxarea = torch.maximum(maxarea, areas)
+
+    return maxarea
 
 
 if __name__ == "__main__":
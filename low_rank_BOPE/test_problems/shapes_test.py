@@ -0,0 +1,86 @@
+import sys
+import time
+
+sys.path.append('../..')
+
+import torch
+from low_rank_BOPE.test_problems.shapes import (Image, LargestRectangleUtil,
+                                                batched_maximal_rectangle)
+
+
+def reference_largest_rectangle(util_func, Y, image_shape):
+    r"""Largest rectangle areas computed one image at a time."""
+    Y_bin = (Y > 0.5).float()
+    return torch.tensor([
+        util_func.maximalRectangle(torch.reshape(y_bin, image_shape))
+        for y_bin in Y_bin
+    ]).unsqueeze(1)
+
+
+def test_batched_largest_rectangle():
+    r"""The batched largest rectangle matches the per-image implementation."""
+    torch.manual_seed(0)
+
+    for num_pixels in [1, 2, 5, 8, 16]:
+        image_shape = (num_pixels, num_pixels)
+        util_func = LargestRectangleUtil(image_shape=image_shape)
+
+        # random binary images with different densities of ones,
+        # plus all-zero and all-one images
+        Y = torch.cat([
+            (torch.rand(50, num_pixels ** 2) < p).double()
+            for p in [0.3, 0.6, 0.9]
+        ] + [
+            torch.zeros(1, num_pixels ** 2, dtype=torch.double),
+            torch.ones(1, num_pixels ** 2, dtype=torch.double),
+        ])
+        # rectangles drawn by the Image problem
+        image_problem = Image(num_pixels=num_pixels)
+        Y = torch.cat([Y, image_problem(torch.rand(50, 4, dtype=torch.double))])
+
+        result = util_func(Y)
+        expected = reference_largest_rectangle(util_func, Y, image_shape)
+        assert torch.equal(result, expected), f"mismatch for {num_pixels} pixels"
+
+        # batch shapes, e.g. `b x q x outcome_dim` during acquisition optimization
+        result_batched = util_func(Y[:150].reshape(10, 15, -1))
+        assert torch.equal(result_batched.reshape(-1, 1), expected[:150])
+
+    # non-square images
+    Y = (torch.rand(50, 3 * 7) < 0.7).double()
+    assert torch.equal(
+        batched_maximal_rectangle((Y > 0.5).reshape(-1, 3, 7)).unsqueeze(1),
+        reference_largest_rectangle(LargestRectangleUtil(), Y, (3, 7))
+    )
+
+
+def benchmark_batched_largest_rectangle(n_samples=128):
+    r"""Time the batched largest rectangle against the per-image implementation."""
+    torch.manual_seed(0)
+
+    for num_pixels in [8, 16, 32]:
+        image_shape = (num_pixels, num_pixels)
+        util_func = LargestRectangleUtil(image_shape=image_shape)
+        Y = Image(num_pixels=num_pixels)(torch.rand(n_samples, 4, dtype=torch.double))
+
+        start_time = time.time()
+        util_func(Y)
+        batched_time = time.time() - start_time
+
+        start_time = time.time()
+        reference_largest_rectangle(util_func, Y, image_shape)
+        reference_time = time.time() - start_time
+
+        print(
+            f"{num_pixels}x{num_pixels}, {n_samples} images: "
+            f"batched {batched_time:.4f}s, per-image {reference_time:.4f}s, "
+            f"speedup {reference_time / batched_time:.0f}x"
+        )
+
+
+if __name__ == "__main__":
+
+    test_batched_largest_rectangle()
+    print("batched largest rectangle matches the per-image implementation")
+
+    benchmark_batched_largest_rectangle()
@@ -9,7 +9,7 @@ sys.path.append(['..', '../..', '../../..'])
 import torch
 import yaml
 
-from low_rank_BOPE.bope_class import BopeExperiment
+from low_rank_BOPE.bope_class import BopeExperiment, run_batched_BOPE_loops
 from low_rank_BOPE.bope_class_retraining import RetrainingBopeExperiment
 from low_rank_BOPE.test_problems.shapes import (AreaUtil, Bars,
                                                 GradientAwareAreaUtil, Image,
@@ -23,8 +23,11 @@ def run_pipeline(
     retrain,
     methods = ["st", "pca", "pcr"],
     pe_strategies = ["EUBO-zeta", "Random-f"],
+    n_batched_trials = 1,
     **kwargs):
 
+    # only seeds the setup below; each BopeExperiment seeds its own data and
+    # tasks by its trial_idx, also when several trials run batched
     torch.manual_seed(trial_idx)
     kwargs.update({"standardize": False}) # don't standardize for shapes due to numerical issues
 
@@ -55,16 +58,33 @@ def run_pipeline(
         output_path = "/home/yz685/low_rank_BOPE/experiments/shapes/" + \
             f"{n_pixels}by{n_pixels}_{outcome_func_name}_{util_func_name}/"
 
-    experiment = experiment_class(
-        problem, 
-        util_func, 
-        methods = methods,
-        pe_strategies = pe_strategies,
-        trial_idx = trial_idx,
-        output_path = output_path,
-        **kwargs
-    )
-    experiment.run_BOPE_loop()
+    if n_batched_trials > 1 and not retrain:
+        # run trials trial_idx, ..., trial_idx + n_batched_trials - 1 together,
+        # fitting their outcome models as one batched model
+        experiments = [
+            experiment_class(
+                problem, 
+                util_func, 
+                methods = methods,
+                pe_strategies = pe_strategies,
+                trial_idx = trial_idx + i,
+                output_path = output_path,
+                **kwargs
+            )
+            for i in range(n_batched_trials)
+        ]
+        run_batched_BOPE_loops(experiments)
+    else:
+        experiment = experiment_class(
+            problem, 
+            util_func, 
+            methods = methods,
+            pe_strategies = pe_strategies,
+            trial_idx = trial_idx,
+            output_path = output_path,
+            **kwargs
+        )
+        experiment.run_BOPE_loop()
 
 
 if __name__ == "__main__":
@@ -90,4 +110,5 @@ if __name__ == "__main__":
         penalty_param = args["penalty_param"],
         binarize_area = args.get("binarize", True),
         n_BO_iters = args.get("n_BO_iters", 10),
+        n_batched_trials = args.get("n_batched_trials", 1),
     )
\ No newline at end of file
@@ -9,7 +9,7 @@ sys.path.append(['..', '../..', '../../..'])
 import torch
 import yaml
 
-from low_rank_BOPE.bope_class import BopeExperiment
+from low_rank_BOPE.bope_class import BopeExperiment, run_batched_BOPE_loops
 from low_rank_BOPE.bope_class_retraining import RetrainingBopeExperiment
 from low_rank_BOPE.test_problems.synthetic_problem import (
     LinearUtil, generate_principal_axes, make_controlled_coeffs, make_problem)
@@ -20,6 +20,7 @@ def run_pipeline(
     retrain,
     methods = ["st", "pca", "pcr", "true_proj"],
     pe_strategies = ["EUBO-zeta", "Random-f"],
+    n_batched_trials = 1,
     alphas = [0, 0.2, 0.4, 0.6, 0.8, 1.0],
     problem_seed = None,
     **kwargs):
@@ -79,16 +80,33 @@ def run_pipeline(
 
         print("methods to plug into BopeExperiment: ", methods)
 
-        experiment = experiment_class(
-            problem, 
-            util_func, 
-            methods = methods,
-            pe_strategies = pe_strategies,
-            trial_idx = trial_idx,
-            output_path = output_path,
-            **kwargs
-        )
-        experiment.run_BOPE_loop()
+        if n_batched_trials > 1 and not retrain:
+            # run trials trial_idx, ..., trial_idx + n_batched_trials - 1 together,
+            # fitting their outcome models as one batched model
+            experiments = [
+                experiment_class(
+                    problem, 
+                    util_func, 
+                    methods = methods,
+                    pe_strategies = pe_strategies,
+                    trial_idx = trial_idx + i,
+                    output_path = output_path,
+                    **kwargs
+                )
+                for i in range(n_batched_trials)
+            ]
+            run_batched_BOPE_loops(experiments)
+        else:
+            experiment = experiment_class(
+                problem, 
+                util_func, 
+                methods = methods,
+                pe_strategies = pe_strategies,
+                trial_idx = trial_idx,
+                output_path = output_path,
+                **kwargs
+            )
+            experiment.run_BOPE_loop()
 
 
 if __name__ == "__main__":
@@ -116,6 +134,8 @@ if __name__ == "__main__":
             alphas=args["alphas"],
             pca_var_threshold = args["pca_var_threshold"],
             initial_experimentation_batch = args["init_exp_batch"],
-            problem_seed = args["problem_seed"] 
+            problem_seed = args["problem_seed"],
             # prblem_seed should be set the same for all trials in one problem instance
+            n_workers = args.get("n_workers", 1),
+            n_batched_trials = args.get("n_batched_trials", 1),
         )